@@ -0,0 +1,203 @@
+import datetime
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from config import config
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (no false negatives, ~error_rate false positives)."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class AccessCodeIndex:
+    """
+    Every Wi-Fi access code (voucher code or M-Pesa receipt) in one collection,
+    unique on `code`, pointing at its voucher and/or session.
+
+    Lookups first consult an in-memory Bloom filter of all codes, so invalid
+    codes (typos, brute-force guesses) are rejected without a database round
+    trip. Codes created by other workers reach the filter through an
+    incremental sync on created_at. A code is only rejected from memory once
+    a sync that started after its miss has run, so a code paid for a moment
+    ago on another worker is still found; concurrent misses wait for and
+    share one sync, so guessing traffic costs one indexed query at a time,
+    not one per guess. Codes that pass the filter but are not in the database
+    (false positives) are remembered briefly in a negative cache.
+    """
+
+    SYNC_MARGIN = datetime.timedelta(seconds=5)  # Tolerates clock skew and late inserts between workers
+
+    def __init__(self, collection, capacity=100000, negative_ttl=60, negative_size=10000):
+        self.col = collection
+        self.capacity = capacity
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self.stats = {"lookups": 0, "filter_rejects": 0, "negative_hits": 0, "db_lookups": 0, "db_misses": 0, "syncs": 0}
+        self._filter = None       # None until load() finishes: lookups go straight to MongoDB
+        self._watermark = None    # Newest created_at seen
+        self._synced_from = 0.0   # Start (monotonic) of the last finished sync
+        self._rebuilding = False
+        self._negative = OrderedDict()  # code -> expires_at (monotonic)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    # --- Filter maintenance ---
+
+    def load(self):
+        """Build the filter from every stored code (one projected scan)."""
+        count = self.col.estimated_document_count()
+        bloom = BloomFilter(max(self.capacity, count * 2))
+        watermark = None
+        for doc in self.col.find({}, {"code": 1, "created_at": 1, "_id": 0}):
+            bloom.add(doc["code"])
+            if doc.get("created_at") and (watermark is None or doc["created_at"] > watermark):
+                watermark = doc["created_at"]
+        with self._lock:
+            self._filter = bloom
+            self._watermark = watermark
+            self._rebuilding = False
+        if config.DEBUG: print(f"[ACCESS-CODES] Filter loaded with {bloom.count} codes")
+
+    def load_async(self):
+        threading.Thread(target=self.load, name="access-code-filter", daemon=True).start()
+
+    def _add_local(self, code):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(code)
+                if self._filter.count > self._filter.capacity and not self._rebuilding:
+                    # Past capacity the false positive rate climbs; rebuild twice as large
+                    self._rebuilding = True
+                    self.capacity = self._filter.capacity * 2
+                    self.load_async()
+            self._negative.pop(code, None)
+
+    def sync(self, after=None):
+        """
+        Pull codes created since the last sync (indexed on created_at).
+        With `after` (a time.monotonic() value), nothing is read if a sync that
+        started after it has finished meanwhile: waiting misses share one query.
+        """
+        if self._filter is None:
+            return
+        with self._sync_lock:
+            if after is not None and self._synced_from > after:
+                return
+            started = time.monotonic()
+            query = {"created_at": {"$gte": self._watermark - self.SYNC_MARGIN}} if self._watermark else {}
+            newest = self._watermark
+            for doc in self.col.find(query, {"code": 1, "created_at": 1, "_id": 0}):
+                self._add_local(doc["code"])
+                if doc.get("created_at") and (newest is None or doc["created_at"] > newest):
+                    newest = doc["created_at"]
+            self._watermark = newest
+            self._synced_from = started
+            self.stats["syncs"] += 1
+
+    # --- Writes ---
+
+    def register(self, code, kind, **refs):
+        """Record a new access code. Returns False if the code already exists."""
+        doc = dict(refs, code=code, kind=kind, created_at=datetime.datetime.now())
+        try:
+            self.col.insert_one(doc)
+            created = True
+        except DuplicateKeyError:
+            created = False
+        self._add_local(code)
+        return created
+
+    def remember(self, codes):
+        """Add codes inserted elsewhere in bulk (e.g. a voucher batch) to the filter."""
+        for code in codes:
+            self._add_local(code)
+
+    def attach_session(self, code, session_id):
+        self.col.update_one({"code": code}, {"$set": {"session_id": session_id}})
+
+    # --- Reads ---
+
+    def lookup(self, code):
+        """The access_codes document for `code`, or None. Invalid codes rarely reach MongoDB."""
+        self.stats["lookups"] += 1
+
+        if self._filter is not None and code not in self._filter:
+            self.sync(after=time.monotonic())  # Maybe created moments ago by another worker
+            if code not in self._filter:
+                self.stats["filter_rejects"] += 1
+                return None
+
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._negative.get(code)
+            if expires_at and expires_at > now:
+                self.stats["negative_hits"] += 1
+                return None
+
+        self.stats["db_lookups"] += 1
+        doc = self.col.find_one({"code": code})
+        if doc is None:
+            self.stats["db_misses"] += 1
+            with self._lock:
+                self._negative[code] = now + self.negative_ttl
+                self._negative.move_to_end(code)
+                while len(self._negative) > self.negative_size:
+                    self._negative.popitem(last=False)
+        return doc
+
+    def metrics(self):
+        with self._lock:
+            loaded = self._filter is not None
+            codes = self._filter.count if loaded else 0
+            negative = len(self._negative)
+        return dict(self.stats, filter_loaded=loaded, filter_codes=codes, negative_cached=negative)
+
+
+def backfill_access_codes(index, vouchers_col, sessions_col):
+    """One-off: map codes issued before access_codes existed. Idempotent (upserts keyed by code)."""
+    ops = []
+    now = datetime.datetime.now()
+    for session in sessions_col.find({"$or": [{"mpesa_code": {"$type": "string"}}, {"code": {"$type": "string"}}]},
+                                     {"mpesa_code": 1, "code": 1, "session_id": 1, "type": 1}):
+        code = session.get("mpesa_code") or session.get("code")
+        kind = "voucher" if session.get("type") == "voucher" else "mpesa"
+        ops.append(UpdateOne({"code": code}, {
+            "$set": {"session_id": session.get("session_id")},
+            "$setOnInsert": {"kind": kind, "created_at": now}
+        }, upsert=True))
+    for voucher in vouchers_col.find({}, {"code": 1}):
+        ops.append(UpdateOne({"code": voucher["code"]}, {
+            "$set": {"voucher_id": voucher["_id"]},
+            "$setOnInsert": {"kind": "voucher", "created_at": now}
+        }, upsert=True))
+
+    for i in range(0, len(ops), 1000):
+        index.col.bulk_write(ops[i:i + 1000], ordered=False)
+    return len(ops)
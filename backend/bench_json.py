@@ -0,0 +1,107 @@
+"""
+Micro-benchmark for JSON responses of MongoDB documents.
+
+Compares the old two-pass path (copy every document with json_serializer,
+then encode with Flask's default provider) against the single-pass
+providers in json_utils.py, on synthetic order documents shaped like the
+orders collection. No database or running backend needed.
+
+Usage:
+    python bench_json.py --docs 5000 --repeat 5
+"""
+import argparse
+import datetime
+import random
+import time
+import tracemalloc
+from bson import ObjectId
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from json_utils import MongoJSONProvider, OrjsonProvider, orjson
+
+
+def json_serializer(data):
+    """The copy-then-encode helper main.py used before MongoJSONProvider (baseline)."""
+    if isinstance(data, list):
+        return [json_serializer(i) for i in data]
+    if isinstance(data, dict):
+        new_data = {}
+        for k, v in data.items():
+            if isinstance(v, ObjectId):
+                new_data[k] = str(v)
+            elif isinstance(v, datetime.datetime):
+                new_data[k] = v.isoformat()
+            elif isinstance(v, dict) or isinstance(v, list):
+                new_data[k] = json_serializer(v)
+            else:
+                new_data[k] = v
+        return new_data
+    return data
+
+
+def make_orders(count):
+    now = datetime.datetime.now()
+    orders = []
+    for i in range(count):
+        created = now - datetime.timedelta(minutes=random.randint(0, 100000))
+        orders.append({
+            "_id": ObjectId(),
+            "order_id": f"ORD-{i:08d}",
+            "user_id": str(ObjectId()),
+            "status": random.choice(["pending", "paid", "shipped", "delivered"]),
+            "items": [{"product_id": str(ObjectId()), "name": f"Product {n}", "price": random.randint(100, 50000),
+                       "quantity": random.randint(1, 5)} for n in range(random.randint(1, 6))],
+            "total": random.randint(100, 200000),
+            "shipping": {"name": "Jane Doe", "phone": "254712345678", "address": "Moi Avenue, Nairobi"},
+            "payment": {"method": "mpesa", "status": "completed", "receipt": f"QK{i:08d}",
+                        "paid_at": created + datetime.timedelta(minutes=2)},
+            "created_at": created,
+            "updated_at": created + datetime.timedelta(hours=1)
+        })
+    return orders
+
+
+def measure(encode, docs, repeat):
+    """Best wall time over `repeat` runs, and peak traced memory of one run."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode(docs)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    encode(docs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON provider micro-benchmark")
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    legacy, single = DefaultJSONProvider(app), MongoJSONProvider(app)
+    contenders = [
+        ("json_serializer + jsonify", lambda docs: legacy.dumps({"success": True, "data": json_serializer(docs)})),
+        ("MongoJSONProvider", lambda docs: single.dumps({"success": True, "data": docs})),
+    ]
+    if orjson is not None:
+        fast = OrjsonProvider(app)
+        contenders.append(("OrjsonProvider", lambda docs: fast.dumps({"success": True, "data": docs})))
+    else:
+        print("orjson not installed; skipping OrjsonProvider")
+
+    docs = make_orders(args.docs)
+    baseline = None
+    print(f"{args.docs} order documents, best of {args.repeat}")
+    for name, encode in contenders:
+        seconds, peak, size = measure(encode, docs, args.repeat)
+        baseline = baseline or seconds
+        print(f"  {name:28} {seconds * 1000:8.1f} ms  {baseline / seconds:5.2f}x  "
+              f"peak {peak / 1e6:6.1f} MB  body {size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
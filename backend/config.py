@@ -75,7 +75,30 @@ class Config:
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER', MAIL_USERNAME)
+    MAIL_WORKERS = int(os.getenv('MAIL_WORKERS', 2)) # Sender threads per process, each with its own SMTP connection
+    MAIL_QUEUE_SIZE = int(os.getenv('MAIL_QUEUE_SIZE', 1000)) # Emails waiting beyond this are dropped
+    MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 20)) # Emails a worker sends per wakeup
+    MAIL_IDLE_TIMEOUT = float(os.getenv('MAIL_IDLE_TIMEOUT', 30)) # Seconds an idle SMTP connection is kept open
+    MAIL_DRAIN_TIMEOUT = float(os.getenv('MAIL_DRAIN_TIMEOUT', 10)) # Seconds to flush the queue on shutdown
     
+    # ============== SMS CONFIGURATION ==============
+    SMS_PROVIDER = os.getenv('SMS_PROVIDER', 'console') # console (log only) | http (bulk HTTP gateway, see sms_simulator.py)
+    SMS_API_URL = os.getenv('SMS_API_URL', 'http://localhost:5057') # Gateway base URL for the http provider
+    SMS_API_KEY = os.getenv('SMS_API_KEY', '')
+    SMS_SENDER_ID = os.getenv('SMS_SENDER_ID', 'TINDITECH')
+    SMS_CALLBACK_URL = os.getenv('SMS_CALLBACK_URL', '') # Our /sms/delivery URL for delivery reports ('' = none)
+    SMS_CALLBACK_TOKEN = os.getenv('SMS_CALLBACK_TOKEN', '') # If set, delivery reports must carry ?token=<this>
+    SMS_COUNTRY_CODE = os.getenv('SMS_COUNTRY_CODE', '254') # For local numbers like 0712345678
+    SMS_WORKERS = int(os.getenv('SMS_WORKERS', 1)) # Sender threads per process (0 = queue only)
+    SMS_RATE = float(os.getenv('SMS_RATE', 10)) # Messages per second per process
+    SMS_BATCH_SIZE = int(os.getenv('SMS_BATCH_SIZE', 100)) # Messages per bulk API call
+    SMS_MAX_ATTEMPTS = int(os.getenv('SMS_MAX_ATTEMPTS', 5)) # Then the message is marked failed
+    SMS_RETENTION = int(os.getenv('SMS_RETENTION', 7 * 86400)) # Seconds sms_outbox keeps a message
+
+    # ============== JSON RESPONSES ==============
+    JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto') # auto (orjson if installed) | orjson | stdlib
+    STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 200)) # Documents per cursor batch / response chunk for unpaginated lists
+
     # ============== FRONTEND CONFIGURATION ==============
     FRONTEND_URL = os.getenv('FRONTEND_URL', 'https://tinditech-frontend.onrender.com')
 
@@ -85,13 +108,25 @@ class Config:
     MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET')
     MPESA_SHORTCODE = os.getenv('MPESA_SHORTCODE', '174379') # Sandbox default
     MPESA_PASSKEY = os.getenv('MPESA_PASSKEY', 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919') # Sandbox default
-    MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL', 'https://your-domain.com/mpesa/callback') 
+    MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL', 'https://your-domain.com/mpesa/callback')
+    MPESA_API_URL = os.getenv('MPESA_API_URL', 'https://sandbox.safaricom.co.ke') # Daraja base URL (sandbox/production/local stand-in)
+    MPESA_POOL_MAXSIZE = int(os.getenv('MPESA_POOL_MAXSIZE', 10)) # Keep-alive connections per Daraja host
+    MPESA_RECONCILE_ENABLED = os.getenv('MPESA_RECONCILE_ENABLED', 'true').lower() == 'true' # STK Query for lost callbacks
+    MPESA_RECONCILE_INTERVAL = int(os.getenv('MPESA_RECONCILE_INTERVAL', 30)) # Seconds between reconciliation passes
+    MPESA_RECONCILE_RATE = float(os.getenv('MPESA_RECONCILE_RATE', 2)) # STK Query calls per second
+    WEB_THREADS = int(os.getenv('WEB_THREADS', 64)) # gunicorn --threads per worker (the Procfile reads the same variable)
+    STATUS_STREAM_TIMEOUT = int(os.getenv('STATUS_STREAM_TIMEOUT', 25)) # Seconds an SSE status stream stays open (keepalives every 10s)
+    STATUS_STREAM_MAX = int(os.getenv('STATUS_STREAM_MAX', max(1, WEB_THREADS - 8))) # Streams waiting at once per worker; the rest of the threads serve other requests
+    STATUS_WATCH_INTERVAL = float(os.getenv('STATUS_WATCH_INTERVAL', 1)) # Seconds between each worker's check of the statuses its streams wait on
 
     # ============== MIKROTIK CONFIGURATION ==============
     MIKROTIK_HOST = os.getenv('MIKROTIK_HOST', '192.168.88.1')
     MIKROTIK_PORT = int(os.getenv('MIKROTIK_PORT', 8728)) # API Port
     MIKROTIK_USER = os.getenv('MIKROTIK_USER', 'admin')
     MIKROTIK_PASS = os.getenv('MIKROTIK_PASS', '')
+    MIKROTIK_POOL_SIZE = int(os.getenv('MIKROTIK_POOL_SIZE', 4)) # Persistent API connections per router
+    MIKROTIK_TIMEOUT = float(os.getenv('MIKROTIK_TIMEOUT', 10)) # Seconds per API operation
+    MIKROTIK_KEEPALIVE = int(os.getenv('MIKROTIK_KEEPALIVE', 60)) # Ping connections idle this long
 
     # ============== TP-LINK OMADA CONFIGURATION ==============
     # Type: 'mikrotik' or 'tplink'
@@ -101,6 +136,37 @@ class Config:
     TPLINK_SITE_ID = os.getenv('TPLINK_SITE_ID', 'default') 
     TPLINK_USER = os.getenv('TPLINK_USER', 'admin')
     TPLINK_PASS = os.getenv('TPLINK_PASS', '')
+    TPLINK_TIMEOUT = float(os.getenv('TPLINK_TIMEOUT', 10)) # Read timeout (seconds) per controller call
+    TPLINK_POOL_SIZE = int(os.getenv('TPLINK_POOL_SIZE', 8)) # Keep-alive connections / concurrent batch authorizations
+
+    # ============== ROUTER FLEET ==============
+    ROUTERS = os.getenv('ROUTERS', '') # JSON list of sites (see router_fleet.py); empty = single router above
+    DEFAULT_SITE = os.getenv('DEFAULT_SITE', 'default') # Site for sessions that do not name one
+    FLEET_WORKERS = int(os.getenv('FLEET_WORKERS', 8)) # Threads for fleet-wide fan-out
+    FLEET_TIMEOUT = float(os.getenv('FLEET_TIMEOUT', 15)) # Seconds before a slow site is reported as timed out
+
+    # ============== ROUTER PROVISIONING QUEUE ==============
+    PROVISIONING_WORKERS = int(os.getenv('PROVISIONING_WORKERS', 4)) # Worker threads per process (0 = enqueue only)
+    PROVISIONING_PER_ROUTER = int(os.getenv('PROVISIONING_PER_ROUTER', 2)) # Concurrent calls per router
+    PROVISIONING_MAX_ATTEMPTS = int(os.getenv('PROVISIONING_MAX_ATTEMPTS', 5)) # Then the job is marked failed
+    HOTSPOT_DEFAULT_RATE_LIMIT = os.getenv('HOTSPOT_DEFAULT_RATE_LIMIT', '') # rx/tx for plans without their own, e.g. "2M/5M" ('' = unlimited)
+    HOTSPOT_VOUCHER_PROFILE = os.getenv('HOTSPOT_VOUCHER_PROFILE', 'tinditech-voucher') # Hotspot user profile for voucher logins
+    WIFI_EXPIRY_ENABLED = os.getenv('WIFI_EXPIRY_ENABLED', 'true').lower() == 'true' # Expire sessions and remove hotspot users on time
+    HOTSPOT_RECONCILE_ENABLED = os.getenv('HOTSPOT_RECONCILE_ENABLED', 'true').lower() == 'true' # Router <-> DB drift repair
+    HOTSPOT_RECONCILE_INTERVAL = int(os.getenv('HOTSPOT_RECONCILE_INTERVAL', 300)) # Seconds between passes
+    HOTSPOT_RECONCILE_DRY_RUN = os.getenv('HOTSPOT_RECONCILE_DRY_RUN', 'false').lower() == 'true' # Report drift only
+    WIFI_PLANS_POLL_INTERVAL = float(os.getenv('WIFI_PLANS_POLL_INTERVAL', 5)) # Seconds between plan catalog version checks
+    WIFI_PENDING_TTL = int(os.getenv('WIFI_PENDING_TTL', 86400)) # Unpaid (and failed) Wi-Fi sessions are removed after this many seconds
+    WIFI_SESSION_RETENTION_DAYS = int(os.getenv('WIFI_SESSION_RETENTION_DAYS', 7)) # Finished sessions stay browsable this long, then are rolled up
+    WIFI_ROLLUP_INTERVAL = int(os.getenv('WIFI_ROLLUP_INTERVAL', 3600)) # Seconds between rollup passes (0 = off)
+    WIFI_COUNTERS_REBUILD_INTERVAL = int(os.getenv('WIFI_COUNTERS_REBUILD_INTERVAL', 3600)) # Recount /admin/wifi-stats totals (0 = off)
+    TELEMETRY_ENABLED = os.getenv('TELEMETRY_ENABLED', 'true').lower() == 'true' # Poll /ip/hotspot/active for live usage
+    TELEMETRY_INTERVAL = int(os.getenv('TELEMETRY_INTERVAL', 60)) # Seconds between polls (one API call per router)
+    TELEMETRY_SAMPLE_RETENTION = int(os.getenv('TELEMETRY_SAMPLE_RETENTION', 7 * 86400)) # Keep per-poll samples this long
+    TELEMETRY_HOURLY_RETENTION = int(os.getenv('TELEMETRY_HOURLY_RETENTION', 90 * 86400)) # Keep hourly per-user rollups this long
+    HEARTBEAT_FLUSH_INTERVAL = float(os.getenv('HEARTBEAT_FLUSH_INTERVAL', 5)) # Seconds heartbeats are buffered before one bulk write
+    ACCESS_CODE_FILTER_CAPACITY = int(os.getenv('ACCESS_CODE_FILTER_CAPACITY', 100000)) # Codes per Bloom filter before it is rebuilt larger
+    VOUCHER_BATCH_MAX = int(os.getenv('VOUCHER_BATCH_MAX', 1000)) # Vouchers per bulk batch
 
  
 
@@ -0,0 +1,211 @@
+"""
+Local Daraja (M-Pesa) stand-in for development and load testing.
+
+Implements OAuth, STK Push, STK Push Query and the asynchronous callback to
+our /api/mpesa/callback, with configurable latency, failure rates, lost and
+duplicate callbacks.
+
+Usage:
+    python daraja_simulator.py --port 5055 --latency-ms 150 --duplicate-rate 0.1
+
+Point the backend at it (keys just need to look real, >= 10 chars):
+    MPESA_API_URL=http://localhost:5055
+    MPESA_CONSUMER_KEY=simulatorkey123 MPESA_CONSUMER_SECRET=simulatorsecret
+    MPESA_CALLBACK_URL=http://localhost:5000/api/mpesa/callback
+"""
+import argparse
+import base64
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+settings = {
+    "latency_ms": 0,          # Added to every API response
+    "callback_delay": 2.0,    # Seconds until the customer "enters the PIN"
+    "failure_rate": 0.0,      # STK push rejected with HTTP 500
+    "cancel_rate": 0.1,       # Customer cancels (ResultCode 1032)
+    "duplicate_rate": 0.0,    # Callback delivered twice
+    "drop_rate": 0.0,         # Callback never delivered (recover via STK Query)
+    "token_ttl": 3599,
+    "callback_url": None      # Override the CallBackURL sent in the push
+}
+
+tokens = {}        # access_token -> expires_at
+transactions = {}  # CheckoutRequestID -> transaction
+stats = {"oauth": 0, "stk_push": 0, "stk_query": 0, "callbacks_sent": 0,
+         "callbacks_failed": 0, "duplicates_sent": 0, "dropped": 0, "rejected": 0, "unauthorized": 0}
+lock = threading.Lock()
+callback_pool = ThreadPoolExecutor(max_workers=32)
+callback_session = requests.Session()
+
+
+def _count(key, n=1):
+    with lock:
+        stats[key] += n
+
+
+def _simulate_latency():
+    if settings["latency_ms"]:
+        time.sleep(random.uniform(0.5, 1.5) * settings["latency_ms"] / 1000)
+
+
+def _authorized():
+    header = request.headers.get("Authorization", "")
+    token = header[7:] if header.startswith("Bearer ") else None
+    with lock:
+        expires_at = tokens.get(token)
+    if not expires_at or expires_at < time.time():
+        _count("unauthorized")
+        return False
+    return True
+
+
+@app.route("/oauth/v1/generate", methods=["GET"])
+def oauth():
+    _simulate_latency()
+    if not request.authorization:
+        return jsonify({"errorCode": "400.008.01", "errorMessage": "Invalid Authentication passed"}), 400
+
+    token = base64.b64encode(uuid.uuid4().bytes).decode()[:28]
+    with lock:
+        tokens[token] = time.time() + settings["token_ttl"]
+    _count("oauth")
+    return jsonify({"access_token": token, "expires_in": str(settings["token_ttl"])})
+
+
+@app.route("/mpesa/stkpush/v1/processrequest", methods=["POST"])
+def stk_push():
+    _simulate_latency()
+    if not _authorized():
+        return jsonify({"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}), 401
+
+    data = request.get_json() or {}
+    missing = [k for k in ("BusinessShortCode", "Password", "Timestamp", "Amount", "PhoneNumber", "CallBackURL") if not data.get(k)]
+    if missing:
+        return jsonify({"errorCode": "400.002.02", "errorMessage": f"Bad Request - Invalid {missing[0]}"}), 400
+
+    if random.random() < settings["failure_rate"]:
+        _count("rejected")
+        return jsonify({"errorCode": "500.001.1001", "errorMessage": "Unable to lock subscriber, a transaction is already in process for the current subscriber"}), 500
+
+    _count("stk_push")
+    checkout_id = f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:10]}"
+    merchant_id = f"{random.randint(10000, 99999)}-{random.randint(10000000, 99999999)}-1"
+    txn = {
+        "checkout_id": checkout_id,
+        "merchant_id": merchant_id,
+        "amount": data["Amount"],
+        "phone": data["PhoneNumber"],
+        "callback_url": settings["callback_url"] or data["CallBackURL"],
+        "result_code": None,
+        "receipt": None
+    }
+    with lock:
+        transactions[checkout_id] = txn
+    callback_pool.submit(_complete_transaction, txn)
+
+    return jsonify({
+        "MerchantRequestID": merchant_id,
+        "CheckoutRequestID": checkout_id,
+        "ResponseCode": "0",
+        "ResponseDescription": "Success. Request accepted for processing",
+        "CustomerMessage": "Success. Request accepted for processing"
+    })
+
+
+@app.route("/mpesa/stkpushquery/v1/query", methods=["POST"])
+def stk_query():
+    _simulate_latency()
+    if not _authorized():
+        return jsonify({"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}), 401
+
+    _count("stk_query")
+    checkout_id = (request.get_json() or {}).get("CheckoutRequestID")
+    with lock:
+        txn = transactions.get(checkout_id)
+    if not txn:
+        return jsonify({"requestId": str(uuid.uuid4()), "errorCode": "400.002.02", "errorMessage": "Bad Request - Invalid CheckoutRequestID"}), 400
+    if txn["result_code"] is None:
+        return jsonify({"requestId": str(uuid.uuid4()), "errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"}), 500
+
+    return jsonify({
+        "ResponseCode": "0",
+        "ResponseDescription": "The service request has been accepted successsfully",
+        "MerchantRequestID": txn["merchant_id"],
+        "CheckoutRequestID": checkout_id,
+        "ResultCode": str(txn["result_code"]),
+        "ResultDesc": _result_desc(txn["result_code"])
+    })
+
+
+@app.route("/sim/stats", methods=["GET"])
+def sim_stats():
+    with lock:
+        return jsonify({"settings": settings, "stats": stats, "transactions": len(transactions)})
+
+
+def _result_desc(result_code):
+    return "The service request is processed successfully." if result_code == 0 else "Request cancelled by user"
+
+
+def _complete_transaction(txn):
+    """Customer answers the prompt after callback_delay, then Safaricom calls us back."""
+    time.sleep(random.uniform(0.5, 1.5) * settings["callback_delay"])
+
+    result_code = 1032 if random.random() < settings["cancel_rate"] else 0
+    txn["receipt"] = f"SIM{uuid.uuid4().hex[:7].upper()}" if result_code == 0 else None
+    txn["result_code"] = result_code
+
+    if random.random() < settings["drop_rate"]:
+        _count("dropped")
+        return
+
+    callback = {
+        "MerchantRequestID": txn["merchant_id"],
+        "CheckoutRequestID": txn["checkout_id"],
+        "ResultCode": result_code,
+        "ResultDesc": _result_desc(result_code)
+    }
+    if result_code == 0:
+        callback["CallbackMetadata"] = {"Item": [
+            {"Name": "Amount", "Value": txn["amount"]},
+            {"Name": "MpesaReceiptNumber", "Value": txn["receipt"]},
+            {"Name": "TransactionDate", "Value": int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+            {"Name": "PhoneNumber", "Value": int(txn["phone"])}
+        ]}
+
+    deliveries = 2 if random.random() < settings["duplicate_rate"] else 1
+    for attempt in range(deliveries):
+        if attempt:
+            _count("duplicates_sent")
+            time.sleep(random.uniform(0.05, 0.5))
+        try:
+            res = callback_session.post(txn["callback_url"], json={"Body": {"stkCallback": callback}}, timeout=10)
+            _count("callbacks_sent" if res.ok else "callbacks_failed")
+        except requests.RequestException:
+            _count("callbacks_failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Daraja (M-Pesa) stand-in")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency-ms", type=int, default=settings["latency_ms"])
+    parser.add_argument("--callback-delay", type=float, default=settings["callback_delay"])
+    parser.add_argument("--failure-rate", type=float, default=settings["failure_rate"])
+    parser.add_argument("--cancel-rate", type=float, default=settings["cancel_rate"])
+    parser.add_argument("--duplicate-rate", type=float, default=settings["duplicate_rate"])
+    parser.add_argument("--drop-rate", type=float, default=settings["drop_rate"])
+    parser.add_argument("--token-ttl", type=int, default=settings["token_ttl"])
+    parser.add_argument("--callback-url", default=None, help="Override the CallBackURL sent by the backend")
+    args = parser.parse_args()
+
+    settings.update({k: v for k, v in vars(args).items() if k != "port"})
+    print(f"[DARAJA-SIM] Listening on :{args.port} with {settings}")
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,171 @@
+import atexit
+import datetime
+import threading
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from config import config
+
+
+def acquire_lease(collection, name, owner, seconds):
+    """
+    Take or renew a named lease (one document per name in `collection`).
+    Returns True while `owner` holds it; another owner can only take it once it lapses.
+    """
+    now = datetime.datetime.now()
+    try:
+        collection.update_one(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + datetime.timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Document exists and is held by someone else
+        return False
+
+
+def release_lease(collection, name, owner):
+    """Give up a lease early so another worker can take over immediately."""
+    try:
+        collection.update_one({"_id": name, "owner": owner}, {"$set": {"expires_at": datetime.datetime.min}})
+    except PyMongoError:
+        pass
+
+
+class BulkWriter:
+    """
+    Write-behind buffer for MongoDB.
+    Operations are keyed: a later write for the same key replaces the pending one,
+    so bursts coalesce. Buffered ops are sent with one unordered bulk_write per
+    collection every `interval` seconds, or as soon as `max_ops` are waiting.
+
+    on_flushed callbacks run only for writes that took effect. Ops must be
+    single-document (InsertOne, UpdateOne, ...): when the bulk result shows
+    fewer hits than ops, some op matched nothing, and each op with callbacks
+    is then checked with its `applied` filter (one that matches once the
+    write has landed). Without such a filter its callbacks are skipped.
+    """
+
+    def __init__(self, name, interval=0.25, max_ops=500):
+        self.name = name
+        self.interval = interval
+        self.max_ops = max_ops
+        self._pending = {}  # (collection name, key) -> (collection, op, callbacks, applied filter)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"queued": 0, "coalesced": 0, "written": 0, "flushes": 0, "errors": 0, "not_applied": 0}
+        atexit.register(self.stop)
+
+    def add(self, collection, key, op, on_flushed=None, applied=None):
+        """Queue a pymongo write op (UpdateOne, InsertOne, ...) under `key`."""
+        with self._lock:
+            slot = (collection.name, key)
+            callbacks = []
+            if slot in self._pending:
+                callbacks = self._pending[slot][2]
+                self._stats["coalesced"] += 1
+            if on_flushed:
+                callbacks.append(on_flushed)
+            self._pending[slot] = (collection, op, callbacks, applied)
+            self._stats["queued"] += 1
+            size = len(self._pending)
+
+        if self._stop.is_set():
+            # Shutting down: no flusher thread any more, write through
+            self.flush()
+            return
+
+        self._ensure_started()
+        if size >= self.max_ops:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything buffered so far. Safe to call from any thread."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        by_collection = {}
+        for collection, op, callbacks, applied in pending.values():
+            entry = by_collection.setdefault(collection.name, (collection, [], []))
+            entry[1].append(op)
+            entry[2].append((callbacks, applied))
+
+        written = 0
+        for collection, ops, callbacks in by_collection.values():
+            failed = set()
+            try:
+                result = collection.bulk_write(ops, ordered=False).bulk_api_result
+            except BulkWriteError as e:
+                # Unordered: everything except the reported errors was attempted
+                result = e.details
+                errors = result.get("writeErrors", [])
+                failed = {err["index"] for err in errors}
+                self._record_error(f"{collection.name}: {errors[:3]}")
+            except PyMongoError as e:
+                self._record_error(f"{collection.name}: {e}")
+                continue
+
+            written += len(ops) - len(failed)
+            # Each single-document op that hit a document counts once here
+            hits = sum(result.get(n, 0) for n in ("nInserted", "nUpserted", "nMatched", "nRemoved"))
+            missed = hits < len(ops) - len(failed)
+            for index, (op_callbacks, applied) in enumerate(callbacks):
+                if index in failed or not op_callbacks: continue
+                if missed and not self._landed(collection, applied):
+                    with self._lock:
+                        self._stats["not_applied"] += 1
+                    continue
+                for callback in op_callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        self._record_error(f"callback: {e}")
+
+        with self._lock:
+            self._stats["written"] += written
+            self._stats["flushes"] += 1
+        return written
+
+    @staticmethod
+    def _landed(collection, applied):
+        if applied is None:
+            return False
+        try:
+            return collection.count_documents(applied, limit=1) > 0
+        except PyMongoError:
+            return False
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
+
+    def stop(self):
+        """Stop the flusher thread and write whatever is still buffered."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _record_error(self, message):
+        with self._lock:
+            self._stats["errors"] += 1
+        if config.DEBUG: print(f"[DB] {self.name} bulk write error: {message}")
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
@@ -0,0 +1,117 @@
+import datetime
+from config import config
+from mikrotik_utils import MANAGED_COMMENT, uptime_limit
+
+
+class HotspotReconciler:
+    """
+    Brings a router's /ip/hotspot/user table back in line with the database.
+
+    One API call fetches every hotspot user and one query fetches every
+    active session; the drift is two set differences computed in memory:
+      missing = active codes not on the router   -> added in one pipelined batch
+      stale   = our users on the router that no active session owns -> removed in one call
+    Only users this backend created (MANAGED_COMMENT) or that belong to a
+    known session are ever removed; hand-made router users are left alone.
+    With `site`, only sessions pinned to that site count as expected; the
+    default site also owns sessions recorded before sites existed.
+    Unused vouchers pre-provisioned to the site (vouchers_col) are expected too.
+    Missing users are re-added with their plan's profile (`profile_for(plan_id)`)
+    and the remaining time as limit-uptime, as at login.
+    """
+
+    def __init__(self, sessions_col, bridge, site=None, include_unassigned=False, vouchers_col=None, batch_size=100,
+                 profile_for=None):
+        self.sessions = sessions_col
+        self.vouchers = vouchers_col
+        self.profile_for = profile_for or (lambda plan_id: "default")
+        self.bridge = bridge
+        self.site = site
+        self.include_unassigned = include_unassigned
+        self.batch_size = batch_size
+        self.stats = {"runs": 0, "missing": 0, "stale": 0, "added": 0, "removed": 0, "errors": 0}
+        self.last_result = None
+
+    @staticmethod
+    def _login_code(session):
+        return session.get("mpesa_code") or session.get("code")
+
+    def expected_users(self):
+        """Login code -> (remaining seconds, profile) for every session that should have router access now."""
+        now = datetime.datetime.now()
+        query = {"status": "active", "expiry_time": {"$gt": now}}
+        if self.site:
+            query["site"] = {"$in": [self.site, None]} if self.include_unassigned else self.site
+        cursor = self.sessions.find(query, {"code": 1, "mpesa_code": 1, "expiry_time": 1, "plan_id": 1})
+        expected = {self._login_code(s): ((s["expiry_time"] - now).total_seconds(), self.profile_for(s.get("plan_id")))
+                    for s in cursor if self._login_code(s)}
+
+        if self.vouchers is not None and self.site:
+            for v in self.vouchers.find({"provisioned_site": self.site, "status": {"$ne": "used"}},
+                                        {"code": 1, "duration_hours": 1}):
+                expected.setdefault(v["code"], (v.get("duration_hours", 1) * 3600, self.profile_for(None)))
+        return expected
+
+    def _known_codes(self, names):
+        """Which of these router usernames belong to a session we issued (any status)."""
+        known = set()
+        names = list(names)
+        for i in range(0, len(names), 1000):
+            chunk = names[i:i + 1000]
+            for s in self.sessions.find({"$or": [{"code": {"$in": chunk}}, {"mpesa_code": {"$in": chunk}}]},
+                                        {"code": 1, "mpesa_code": 1}):
+                known.update(c for c in (s.get("code"), s.get("mpesa_code")) if c)
+        return known
+
+    def run_once(self, dry_run=False):
+        started = datetime.datetime.now()
+        router_users = {u["name"]: u for u in self.bridge.list_hotspot_users() if u.get("name")}
+        expected = self.expected_users()
+
+        missing = sorted(set(expected) - set(router_users))
+
+        unexpected = set(router_users) - set(expected)
+        unmarked = [name for name in unexpected if router_users[name].get("comment") != MANAGED_COMMENT]
+        known = self._known_codes(unmarked) if unmarked else set()
+        stale = sorted(name for name in unexpected
+                       if router_users[name].get("comment") == MANAGED_COMMENT or name in known)
+
+        result = {
+            "router_users": len(router_users),
+            "expected": len(expected),
+            "missing": len(missing),
+            "stale": len(stale),
+            "added": 0,
+            "removed": 0,
+            "failed": [],
+            "dry_run": dry_run
+        }
+
+        if not dry_run:
+            for i in range(0, len(missing), self.batch_size):
+                batch = [{"name": code, "password": code, "profile": expected[code][1],
+                          "limit_uptime": uptime_limit(expected[code][0])}
+                         for code in missing[i:i + self.batch_size]]
+                failed = self.bridge.add_hotspot_users(batch)
+                result["added"] += len(batch) - len(failed)
+                result["failed"].extend(failed)
+
+            stale_ids = [router_users[name]["id"] for name in stale]
+            for i in range(0, len(stale_ids), self.batch_size):
+                batch = stale_ids[i:i + self.batch_size]
+                self.bridge.remove_hotspot_users(batch)
+                result["removed"] += len(batch)
+
+        self.stats["runs"] += 1
+        self.stats["missing"] += result["missing"]
+        self.stats["stale"] += result["stale"]
+        self.stats["added"] += result["added"]
+        self.stats["removed"] += result["removed"]
+        self.stats["errors"] += len(result["failed"])
+        result["duration_ms"] = int((datetime.datetime.now() - started).total_seconds() * 1000)
+        result["checked_at"] = started.isoformat()
+        self.last_result = result
+
+        if config.DEBUG and (missing or stale):
+            print(f"[RECONCILE] Hotspot drift: {len(missing)} missing, {len(stale)} stale (dry_run={dry_run})")
+        return result
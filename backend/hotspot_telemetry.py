@@ -0,0 +1,130 @@
+import datetime
+import re
+from pymongo import UpdateOne
+
+UPTIME_PART = re.compile(r"(\d+)([wdhms])")
+UPTIME_SECONDS = {"w": 604800, "d": 86400, "h": 3600, "m": 60, "s": 1}
+
+
+def parse_uptime(value):
+    """RouterOS duration ("1w2d3h4m5s", "00:05:10") -> seconds."""
+    if not value:
+        return 0
+    if ":" in value:
+        seconds = 0
+        for part in value.split(":"):
+            seconds = seconds * 60 + int(part or 0)
+        return seconds
+    return sum(int(n) * UPTIME_SECONDS[unit] for n, unit in UPTIME_PART.findall(value))
+
+
+class HotspotTelemetry:
+    """
+    Samples /ip/hotspot/active on each MikroTik (one API call per site per
+    interval) and keeps three compact views of it:
+
+      live    one document per site: the latest counters and throughput of
+              every connected user (what /admin/wifi-sessions reads)
+      samples one document per site per hour; each poll appends a site
+              total {t, hosts, rate_in, rate_out} to its array
+      hourly  one document per user per hour: byte deltas summed and peak
+              rates kept with $inc / $max, so raw samples are downsampled at
+              ingest and never need re-aggregating
+
+    Throughput is the byte counter delta since the previous poll; a counter
+    that went backwards means the user logged in again and restarts from zero.
+    The previous poll is always read back from the live collection, never
+    from memory, so when the lease moves between workers and back each delta
+    is still counted once. A poll costs one read and three writes per site
+    however many users are online.
+    """
+
+    def __init__(self, live_col, samples_col, hourly_col):
+        self.live = live_col
+        self.samples = samples_col
+        self.hourly = hourly_col
+        self.stats = {"polls": 0, "hosts": 0, "writes": 0}
+        self._sites = set()  # Sites polled by this worker
+
+    @staticmethod
+    def _host_totals(rows):
+        """Sum the active rows per hotspot user (a user can hold several hosts)."""
+        hosts = {}
+        for row in rows:
+            user = row.get("user")
+            if not user:
+                continue
+            host = hosts.setdefault(user, {"code": user, "bytes_in": 0, "bytes_out": 0, "uptime": 0,
+                                           "mac": row.get("mac-address"), "address": row.get("address")})
+            host["bytes_in"] += int(row.get("bytes-in") or 0)
+            host["bytes_out"] += int(row.get("bytes-out") or 0)
+            host["uptime"] = max(host["uptime"], parse_uptime(row.get("uptime")))
+        return hosts
+
+    def ingest(self, site, rows, now=None):
+        """Record one poll of /ip/hotspot/active for `site`. Returns the live document."""
+        now = now or datetime.datetime.now()
+        hosts = self._host_totals(rows)
+        previous = self.live.find_one({"_id": site}) or {}  # Whichever worker wrote it
+        before = {u["code"]: u for u in previous.get("users", [])}
+        elapsed = (now - previous["at"]).total_seconds() if previous.get("at") else 0
+
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        ops = []
+        rate_in = rate_out = 0
+        for code, host in hosts.items():
+            last = before.get(code)
+            if last and elapsed > 0 and host["bytes_in"] >= last["bytes_in"] and host["bytes_out"] >= last["bytes_out"]:
+                delta_in, delta_out, window = host["bytes_in"] - last["bytes_in"], host["bytes_out"] - last["bytes_out"], elapsed
+            else:
+                delta_in, delta_out, window = host["bytes_in"], host["bytes_out"], host["uptime"] or elapsed
+            host["rate_in"] = int(delta_in / window) if window else 0
+            host["rate_out"] = int(delta_out / window) if window else 0
+            rate_in += host["rate_in"]
+            rate_out += host["rate_out"]
+
+            if delta_in or delta_out:
+                ops.append(UpdateOne(
+                    {"site": site, "code": code, "hour": hour},
+                    {"$inc": {"bytes_in": delta_in, "bytes_out": delta_out, "samples": 1},
+                     "$max": {"peak_rate_in": host["rate_in"], "peak_rate_out": host["rate_out"]}},
+                    upsert=True
+                ))
+
+        snapshot = {"_id": site, "site": site, "at": now, "hosts": len(hosts),
+                    "rate_in": rate_in, "rate_out": rate_out, "users": list(hosts.values())}
+        self.live.replace_one({"_id": site}, snapshot, upsert=True)
+        self.samples.update_one(
+            {"_id": f"{site}:{hour:%Y%m%d%H}"},
+            {"$setOnInsert": {"site": site, "hour": hour},
+             "$push": {"samples": {"t": now, "hosts": len(hosts), "rate_in": rate_in, "rate_out": rate_out}}},
+            upsert=True
+        )
+        if ops:
+            self.hourly.bulk_write(ops, ordered=False)
+
+        self._sites.add(site)
+        self.stats["polls"] += 1
+        self.stats["hosts"] += len(hosts)
+        self.stats["writes"] += 2 + (1 if ops else 0)
+        return snapshot
+
+    def poll(self, router):
+        """Fan-out target: one /ip/hotspot/active call, then ingest. Returns a summary."""
+        snapshot = self.ingest(router.site, router.bridge.list_hotspot_active())
+        return {"hosts": snapshot["hosts"], "rate_in": snapshot["rate_in"], "rate_out": snapshot["rate_out"]}
+
+    def current_usage(self, sites=None, max_age=None):
+        """Login code -> latest usage from the live snapshots (no router calls)."""
+        query = {"_id": {"$in": list(sites)}} if sites else {}
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=max_age) if max_age else None
+        usage = {}
+        for snapshot in self.live.find(query):
+            if oldest and snapshot["at"] < oldest:
+                continue  # Poller stopped for this site; stale rates would mislead
+            for user in snapshot.get("users", []):
+                usage[user["code"]] = dict(user, site=snapshot["_id"], at=snapshot["at"])
+        return usage
+
+    def metrics(self):
+        return dict(self.stats, sites=sorted(self._sites))
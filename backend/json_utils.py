@@ -0,0 +1,88 @@
+import datetime
+import uuid
+from bson import ObjectId
+from flask import Response, current_app
+from flask.json.provider import DefaultJSONProvider
+from config import config
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib encoder is used instead
+    orjson = None
+
+
+class MongoJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that encodes MongoDB documents directly: ObjectId
+    becomes its hex string and datetime/date its ISO 8601 form, in the same
+    pass that writes the JSON. Route handlers can jsonify() documents as
+    they come from PyMongo, without copying them first.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, (datetime.datetime, datetime.date)):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)  # Decimal, UUID, dataclasses, ...
+
+
+class OrjsonProvider(MongoJSONProvider):
+    """MongoJSONProvider on orjson's C encoder (datetimes are encoded natively, in the same ISO form)."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def stream_json(items, envelope=None, key="data", chunk_size=None):
+    """
+    JSON response of `envelope` with `items` as the array under `key`, e.g.
+    stream_json(cursor, {"success": True}) -> {"data": [...], "success": true}.
+
+    Items are encoded and sent `chunk_size` at a time as they are read, so
+    memory stays flat however long the array is (give a cursor a matching
+    batch_size). An error part way through ends the body early, leaving
+    invalid JSON rather than a partial list that looks complete.
+    """
+    provider = current_app.json
+    dumps = lambda obj: provider.dumps(obj, separators=(",", ":"))  # Compact, like jsonify() outside debug
+    chunk_size = chunk_size or config.STREAM_CHUNK_SIZE
+    marker = uuid.uuid4().hex
+    head, tail = dumps(dict(envelope or {}, **{key: marker})).split(f'"{marker}"')
+
+    def generate():
+        try:
+            yield head + "["
+            chunk, separator = [], ""
+            for item in items:
+                chunk.append(dumps(item))
+                if len(chunk) >= chunk_size:
+                    yield separator + ",".join(chunk)
+                    chunk, separator = [], ","
+            if chunk:
+                yield separator + ",".join(chunk)
+            yield "]" + tail + "\n"
+        finally:
+            if hasattr(items, "close"):
+                items.close()  # Releases the server-side cursor at once, also when the client went away
+
+    return Response(generate(), mimetype="application/json")
+
+
+def json_provider(app, encoder=None):
+    """The provider selected by JSON_ENCODER: auto (orjson if installed), orjson or stdlib."""
+    encoder = encoder or config.JSON_ENCODER
+    if encoder == "orjson" or (encoder == "auto" and orjson is not None):
+        if orjson is None:
+            raise RuntimeError("JSON_ENCODER=orjson but orjson is not installed")
+        return OrjsonProvider(app)
+    return MongoJSONProvider(app)
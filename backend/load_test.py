@@ -0,0 +1,158 @@
+"""
+Checkout load generator: create-order -> stk-push -> M-Pesa callback.
+
+Run the backend against the Daraja stand-in (see daraja_simulator.py), then:
+    python load_test.py --api http://localhost:5000 --flows 200 --concurrency 20
+    python load_test.py --flow wifi --plan 1h --flows 500 --concurrency 50
+
+Each flow waits for the payment result on the SSE status stream and the
+report shows throughput plus p50/p99 latency per stage.
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+_local = threading.local()
+
+
+def session():
+    # One keep-alive session per worker thread
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def wait_for_result(url, is_final, timeout):
+    """Follow an SSE status stream (reconnecting like EventSource) until a final status."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with session().get(url, stream=True, timeout=timeout) as res:
+            for line in res.iter_lines(decode_unicode=True):
+                if line and line.startswith("data: "):
+                    payload = json.loads(line[6:])
+                    if is_final(payload):
+                        return payload
+                if time.time() > deadline:
+                    break
+    return None
+
+
+def order_flow(args, product):
+    timings = {}
+    s = session()
+
+    start = time.time()
+    res = s.post(f"{args.api}/create-order", json={
+        "items": [{"name": product["name"], "quantity": 1, "price": product["price"]}],
+        "customer": {"name": "Load Test", "phone": args.phone, "email": "loadtest@example.com"},
+        "total": product["price"]
+    }, timeout=30).json()
+    timings["create_order"] = time.time() - start
+    if not res.get("success"):
+        raise RuntimeError(f"create-order: {res.get('error')}")
+    order_id = res["orderId"]
+
+    t = time.time()
+    res = s.post(f"{args.api}/stk-push", json={"orderId": order_id, "phone": args.phone}, timeout=30).json()
+    timings["stk_push"] = time.time() - t
+    if not res.get("success"):
+        raise RuntimeError(f"stk-push: {res.get('error')}")
+
+    t = time.time()
+    result = wait_for_result(f"{args.api}/order/{order_id}/events",
+                             lambda p: p.get("payment_status") in ("paid", "failed"), args.timeout)
+    timings["callback"] = time.time() - t
+    timings["end_to_end"] = time.time() - start
+    if not result:
+        raise RuntimeError("no payment result before timeout")
+    return result["payment_status"], timings
+
+
+def wifi_flow(args, _product):
+    timings = {}
+    s = session()
+
+    start = time.time()
+    res = s.post(f"{args.api}/wifi/pay", json={"phone": args.phone, "plan_id": args.plan}, timeout=30).json()
+    timings["stk_push"] = time.time() - start
+    if not res.get("success"):
+        raise RuntimeError(f"wifi/pay: {res.get('error')}")
+
+    t = time.time()
+    result = wait_for_result(f"{args.api}/wifi/status/{res['checkout_request_id']}/events",
+                             lambda p: p.get("status") not in ("pending_payment", None), args.timeout)
+    timings["callback"] = time.time() - t
+    timings["end_to_end"] = time.time() - start
+    if not result:
+        raise RuntimeError("no payment result before timeout")
+    return result["status"], timings
+
+
+def pick_product(args):
+    if args.flow != "order":
+        return None
+    products = requests.get(f"{args.api}/products", timeout=10).json().get("data", [])
+    for product in products:
+        if (not args.product or product["name"] == args.product) and int(product.get("stock", 0)) >= args.flows:
+            return product
+    raise SystemExit(f"No product with stock >= {args.flows} (use --product and top up stock first)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checkout load generator")
+    parser.add_argument("--api", default="http://localhost:5000")
+    parser.add_argument("--flow", choices=["order", "wifi"], default="order")
+    parser.add_argument("--flows", type=int, default=100, help="Total checkout flows to run")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--phone", default="0712345678")
+    parser.add_argument("--product", default=None, help="Product name for order flows")
+    parser.add_argument("--plan", default="1h", help="Wi-Fi plan for wifi flows")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for each callback")
+    args = parser.parse_args()
+
+    product = pick_product(args)
+    flow = order_flow if args.flow == "order" else wifi_flow
+    outcomes, errors, samples = {}, [], {}
+    lock = threading.Lock()
+
+    def run(_):
+        try:
+            outcome, timings = flow(args, product)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        with lock:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            for stage, seconds in timings.items():
+                samples.setdefault(stage, []).append(seconds * 1000)
+
+    print(f"Running {args.flows} {args.flow} flows against {args.api} with concurrency {args.concurrency}...")
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run, range(args.flows)))
+    elapsed = time.time() - started
+
+    completed = sum(outcomes.values())
+    print(f"\nCompleted {completed}/{args.flows} flows in {elapsed:.1f}s "
+          f"({completed / elapsed:.1f} flows/s), outcomes: {outcomes}, errors: {len(errors)}")
+    print(f"\n{'stage':<14}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, values in samples.items():
+        print(f"{stage:<14}{percentile(values, 50):>10.0f}{percentile(values, 99):>10.0f}{max(values):>10.0f}")
+    for error in sorted(set(errors))[:5]:
+        print(f"error: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import atexit
+import queue
+import smtplib
+import threading
+import time
+from flask_mail import Message
+from config import config
+
+# The SMTP session itself is gone; reconnect and try the message again
+DISCONNECTS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class MailQueue:
+    """
+    Sends outgoing email from a fixed pool of worker threads fed by a bounded
+    in-memory queue, so request handlers never wait on SMTP.
+
+    Each worker keeps one SMTP connection (Flask-Mail's mail.connect()) open
+    between messages: it takes everything queued (up to `batch_size`) and
+    sends it over that connection, and only hangs up after `idle_timeout`
+    seconds without mail. A dropped connection is reopened once per message.
+    When the queue is full send() returns False instead of blocking.
+    stop() lets the workers finish what is queued, up to `drain_timeout`.
+    """
+
+    def __init__(self, app, mail, workers=2, max_size=1000, batch_size=20, idle_timeout=30, drain_timeout=10):
+        self.app = app
+        self.mail = mail
+        self.workers = workers
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.drain_timeout = drain_timeout
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "dropped": 0, "batches": 0, "connections": 0}
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = False
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def send(self, subject, recipients, body, sender=None):
+        """Queue a plain-text email. Returns False if it could not be queued."""
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if self._stopping:
+            return False
+        try:
+            self._queue.put_nowait({"subject": subject, "recipients": recipients, "body": body,
+                                    "sender": sender, "queued_at": time.time()})
+        except queue.Full:
+            self._count("dropped")
+            if config.DEBUG: print(f"[MAIL] Queue full, dropped: {subject} to {recipients}")
+            return False
+        self._count("queued")
+        return True
+
+    # --- Workers ---
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"mail-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop accepting mail and wait (up to drain_timeout) for the queue to empty."""
+        if self._stopping:
+            return
+        self._stopping = True
+        deadline = time.monotonic() + self.drain_timeout
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if config.DEBUG and self._queue.qsize(): print(f"[MAIL] Shutdown left {self._queue.qsize()} emails unsent")
+
+    def _next_batch(self, connected):
+        """Block for the next email (or the idle timeout), then take whatever else is queued."""
+        try:
+            first = self._queue.get(timeout=self.idle_timeout if connected else None)
+        except queue.Empty:
+            return None
+        batch = [first]
+        while first is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if batch[-1] is None:
+                break
+        return batch
+
+    def _connect(self):
+        connection = self.mail.connect().__enter__()
+        self._count("connections")
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass  # Server already hung up
+
+    def _run(self):
+        connection = None
+        while True:
+            batch = self._next_batch(connection is not None)
+            if batch is None:
+                # Idle: hang up rather than let the server time us out mid-send
+                self._close(connection)
+                connection = None
+                continue
+
+            stop = batch[-1] is None
+            emails = [email for email in batch if email is not None]
+            if emails:
+                with self.app.app_context():  # Message() and Connection.send need the app
+                    connection = self._send_batch(connection, emails)
+                self._count("batches")
+            if stop:
+                break
+
+        if connection is not None:
+            self._close(connection)
+
+    def _send_batch(self, connection, emails):
+        for email in emails:
+            msg = Message(email["subject"], recipients=email["recipients"], body=email["body"],
+                          sender=email["sender"] or config.MAIL_DEFAULT_SENDER)
+            for attempt in range(2):
+                try:
+                    if connection is None:
+                        connection = self._connect()
+                    connection.send(msg)
+                    self._count("sent")
+                    if config.DEBUG: print(f"[MAIL] Sent: {email['subject']} to {email['recipients']}")
+                    break
+                except DISCONNECTS as e:
+                    connection = None
+                    if attempt:
+                        self._count("failed")
+                        if config.DEBUG: print(f"[MAIL] Failed to send {email['subject']} to {email['recipients']}: {e}")
+                except Exception as e:
+                    # Refused recipient, bad auth, ... - retrying this message will not help
+                    self._count("failed")
+                    if config.DEBUG: print(f"[MAIL] Failed to send {email['subject']} to {email['recipients']}: {e}")
+                    if not isinstance(e, smtplib.SMTPRecipientsRefused) and connection is not None:
+                        self._close(connection)
+                        connection = None
+                    break
+        return connection
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return dict(stats, depth=self._queue.qsize(), workers=sum(1 for t in self._threads if t.is_alive()))
@@ -1,18 +1,20 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from datetime import timedelta
 import math
-from mikrotik_utils import mikrotik
-from tplink_utils import tplink
 import bcrypt
 import uuid
 import datetime
 from bson import ObjectId
 from config import config
-from flask_mail import Mail, Message
-from pymongo import MongoClient
+from flask_mail import Mail
+from mail_queue import MailQueue
+from sms_utils import SmsDispatcher, build_provider
+from json_utils import json_provider, stream_json
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import re
 import random
 
@@ -23,7 +25,22 @@ import jwt
 import threading
 import os
 import certifi
-from mpesa_utils import initiate_stk_push
+from mpesa_utils import initiate_stk_push, daraja, MongoTokenStore
+from db_utils import BulkWriter
+from payment_reconciler import StkReconciler
+from status_bus import StatusBus, sse_stream
+from provisioning_queue import ProvisioningQueue
+from session_expiry import SessionExpiryScheduler
+from hotspot_reconciler import HotspotReconciler
+from router_fleet import RouterFleet
+from mikrotik_utils import uptime_limit
+from worker_utils import PeriodicWorker
+from access_codes import AccessCodeIndex, backfill_access_codes
+from voucher_batches import create_batch, stream_csv, stream_sheet
+from hotspot_telemetry import HotspotTelemetry
+from wifi_counters import WifiCounters
+from wifi_plans import PlanCatalog, PLAN_ID, validate_plan
+from wifi_rollups import SessionRollup
 from flask_talisman import Talisman
 
 
@@ -31,6 +48,8 @@ from flask_talisman import Talisman
 app = Flask(__name__, static_folder="../frontend", static_url_path="")
 # Load configuration from config.py
 app.config.from_object(config)
+# jsonify() encodes ObjectId and datetime itself, so documents are returned as-is
+app.json = json_provider(app)
 
 # Security Headers (Talisman)
 csp = {
@@ -61,17 +80,71 @@ limiter = Limiter(
 # Initialize Mail
 mail = Mail(app)
 
+# Outgoing email is sent by a few long-lived SMTP workers, never inside a request
+mail_queue = MailQueue(
+    app, mail,
+    workers=config.MAIL_WORKERS,
+    max_size=config.MAIL_QUEUE_SIZE,
+    batch_size=config.MAIL_BATCH_SIZE,
+    idle_timeout=config.MAIL_IDLE_TIMEOUT,
+    drain_timeout=config.MAIL_DRAIN_TIMEOUT
+)
+mail_queue.start()
+
 
 # Ensure Indexes (Performance)
 def init_db_indexes():
-    try:
-        users_col.create_index("email", unique=True)
-        users_col.create_index("username", unique=True)
-        orders_col.create_index("order_id", unique=True)
-        # print("[DB] Indexes ensured for high performance")
-    except Exception as e:
-        if config.DEBUG:
-            print(f"[DB] Index warning: {e}")
+    # (collection, keys, options) - each index is ensured independently so one
+    # failure (e.g. legacy duplicates) does not block the rest
+    indexes = [
+        (users_col, "email", {"unique": True}),
+        (users_col, "username", {"unique": True}),
+        (orders_col, "order_id", {"unique": True}),
+        (payments_col, "checkout_request_id", {"unique": True}),
+        (payments_col, [("status", 1), ("created_at", 1)], {}),
+        # Reconciler scan for completed payments whose target write never landed; only those are indexed
+        (payments_col, "completed_at", {"partialFilterExpression": {"applied": False}}),
+        (wifi_sessions_col, "session_id", {}),
+        (wifi_sessions_col, "checkout_request_id", {"sparse": True}),
+        (wifi_sessions_col, [("status", 1), ("expiry_time", 1)], {}),
+        (wifi_sessions_col, [("mpesa_code", 1), ("_id", -1)], {}),
+        (wifi_sessions_col, [("code", 1), ("_id", -1)], {}),
+        # Abandoned STK pushes: removed by MongoDB once WIFI_PENDING_TTL has passed
+        (wifi_sessions_col, "created_at", {"expireAfterSeconds": config.WIFI_PENDING_TTL,
+                                           "partialFilterExpression": {"status": "pending_payment"}}),
+        (wifi_sessions_col, "rollup_batch", {"sparse": True}),
+        # Admin session browser: each filter walks its own index in _id order
+        (wifi_sessions_col, [("status", 1), ("_id", -1)], {}),
+        (wifi_sessions_col, [("type", 1), ("_id", -1)], {}),
+        (wifi_sessions_col, [("plan_id", 1), ("_id", -1)], {}),
+        (wifi_sessions_col, [("site", 1), ("_id", -1)], {}),
+        # Session search: prefix scans that also serve exact lookups by these fields
+        (wifi_sessions_col, [("phone", 1), ("_id", -1)], {}),
+        (wifi_sessions_col, [("mac_address", 1), ("_id", -1)], {}),
+        (access_codes_col, "code", {"unique": True}),
+        (vouchers_col, "code", {"unique": True}),
+        (vouchers_col, "batch_id", {"sparse": True}),
+        (voucher_batches_col, "batch_id", {"unique": True}),
+        (access_codes_col, "created_at", {}),
+        (provisioning_jobs_col, [("status", 1), ("next_run_at", 1)], {}),
+        (provisioning_jobs_col, [("code", 1), ("updated_at", -1)], {}),
+        (provisioning_jobs_col, "finished_at", {"expireAfterSeconds": 86400}),
+        (hotspot_usage_samples_col, "hour", {"expireAfterSeconds": config.TELEMETRY_SAMPLE_RETENTION}),
+        (hotspot_usage_hourly_col, [("code", 1), ("hour", 1), ("site", 1)], {"unique": True}),
+        (hotspot_usage_hourly_col, "hour", {"expireAfterSeconds": config.TELEMETRY_HOURLY_RETENTION}),
+        (sms_outbox_col, [("status", 1), ("next_run_at", 1)], {}),
+        (sms_outbox_col, "batch_id", {"sparse": True}),
+        (sms_outbox_col, "provider_message_id", {"sparse": True}),
+        (sms_outbox_col, "created_at", {"expireAfterSeconds": config.SMS_RETENTION}),
+        # Reports for ids the gateway never confirmed (or unknown ones) are dropped after a day
+        (sms_reports_col, "created_at", {"expireAfterSeconds": 86400}),
+    ]
+    for col, keys, options in indexes:
+        try:
+            col.create_index(keys, **options)
+        except Exception as e:
+            if config.DEBUG:
+                print(f"[DB] Index warning ({col.name}): {e}")
 
 
 # Run indexing trigger moved to after DB init
@@ -89,47 +162,184 @@ messages_col = db["messages"]  # For contact form submissions
 quotes_col = db["quotes"]  # For quote requests
 wifi_sessions_col = db["wifi_sessions"]  # For active Wi-Fi users
 vouchers_col = db["vouchers"]  # For generated vouchers
+mpesa_tokens_col = db["mpesa_tokens"]  # Daraja OAuth token shared by all workers
+payments_col = db["payments"]  # CheckoutRequestID -> order / Wi-Fi session registry
+worker_leases_col = db["worker_leases"]  # Keeps background jobs to one worker per deployment
+provisioning_jobs_col = db["provisioning_jobs"]  # Pending router authorizations for Wi-Fi logins
+access_codes_col = db["access_codes"]  # Every Wi-Fi login code -> its voucher / session
+voucher_batches_col = db["voucher_batches"]  # Bulk voucher runs (printable sheets for resellers)
+hotspot_usage_live_col = db["hotspot_usage_live"]  # Latest /ip/hotspot/active snapshot per site
+hotspot_usage_samples_col = db["hotspot_usage_samples"]  # Per-site throughput samples, one document per hour
+hotspot_usage_hourly_col = db["hotspot_usage_hourly"]  # Per-user bytes and peak rates per hour
+wifi_counters_col = db["wifi_counters"]  # Running Wi-Fi totals (active users, revenue)
+wifi_plans_col = db["wifi_plans"]  # Wi-Fi plan catalog (plan_id -> name, duration, price)
+catalog_versions_col = db["catalog_versions"]  # Bumped on every catalog change; workers poll it
+wifi_daily_col = db["wifi_daily"]  # Per-day summary of Wi-Fi sessions removed from wifi_sessions
+sms_outbox_col = db["sms_outbox"]  # Outgoing SMS and their delivery status
+sms_reports_col = db["sms_delivery_reports"]  # Delivery reports that arrived before their message was marked sent
+
+# Share one Daraja access token across every gunicorn worker
+daraja.token_store = MongoTokenStore(mpesa_tokens_col)
 
 # Run indexing on startup (in separate thread to not block)
 threading.Thread(target=init_db_indexes).start()
 
-# --- ISP CONSTANTS ---
-
-WIFI_PLANS = {
-    "1h": {"duration": 1, "price": 20, "name": "1 Hour Access"},
-    "2h": {"duration": 2, "price": 30, "name": "2 Hours Access"},
-    "3h": {"duration": 3, "price": 40, "name": "3 Hours Access"},
-    "6h": {"duration": 6, "price": 70, "name": "6 Hours Access"},
-    "12h": {"duration": 12, "price": 100, "name": "12 Hours Access"},
-    "24h": {"duration": 24, "price": 150, "name": "24 Hours Access"},
-    "1w": {"duration": 168, "price": 800, "name": "1 Week Access"},
-    "1m": {"duration": 720, "price": 2500, "name": "1 Month Access"}  # 30 days
-}
+# /admin/wifi-stats totals, maintained with $inc as sessions change state
+wifi_counters = WifiCounters(wifi_counters_col)
+
+# Wi-Fi login codes, with an in-memory filter that rejects unknown codes without a query
+access_codes = AccessCodeIndex(access_codes_col, capacity=config.ACCESS_CODE_FILTER_CAPACITY)
+
+
+def init_access_codes():
+    try:
+        # Codes issued before access_codes existed are mapped once
+        if access_codes_col.estimated_document_count() == 0:
+            backfill_access_codes(access_codes, vouchers_col, wifi_sessions_col)
+        access_codes.load()
+    except Exception as e:
+        if config.DEBUG: print(f"[ACCESS-CODES] Filter not loaded, lookups go to MongoDB: {e}")
+
+
+threading.Thread(target=init_access_codes, daemon=True).start()
+
+# --- ISP PLANS ---
+
+# Plans live in wifi_plans; each worker serves them from memory and polls for changes
+wifi_plans = PlanCatalog(wifi_plans_col, catalog_versions_col)
+PeriodicWorker("wifi-plans", wifi_plans.refresh, config.WIFI_PLANS_POLL_INTERVAL).start()
 
 
 # --- Helpers ---
 
-def authorize_router_user(code, mac_address, duration_hours=1):
-    """Dispatch authorization to the configured router (MikroTik or TP-Link)."""
-    router_type = config.ROUTER_TYPE
+# Hotspot routers by site (one connection pool per MikroTik)
+fleet = RouterFleet.from_config()
+
+
+def authorize_router_user(code, mac_address, duration_hours=1, site=None, profile=None):
+    """Dispatch authorization to the session's router (MikroTik or TP-Link)."""
+    router = fleet.get(site)
 
-    if router_type == 'mikrotik':
+    if router.type == 'mikrotik':
         # MikroTik Logic (User/Pass = Code)
-        # Duration is handled by User Profile in Router or Backend Heartbeat
-        return mikrotik.add_hotspot_user(code, code)
+        # The plan's profile sets the rate limit. limit-uptime counts connected time only, so it is
+        # just a backstop: session_expiry removes the user when the paid time is up
+        return router.bridge.add_hotspot_user(code, code, profile=profile or "default",
+                                              limit_uptime=uptime_limit(duration_hours * 3600))
 
-    elif router_type == 'tplink':
+    elif router.type == 'tplink':
         # TP-Link Logic (Authorize MAC)
         # Note: TP-Link relies on MAC address, not code-based login for Controller API usually
         if not mac_address or mac_address == "00:00:00:00:00:00":
             return False, "MAC Address required for TP-Link"
 
         duration_minutes = int(duration_hours * 60)
-        return tplink.authorize_client(mac_address, duration_minutes)
+        return router.bridge.authorize_client(mac_address, duration_minutes)
 
     return False, "Unknown Router Type"
 
 
+# Router calls run on worker threads; /wifi/login only enqueues.
+# Jobs are keyed by site, so the per-router concurrency limit applies per site.
+provisioning_queue = ProvisioningQueue(
+    provisioning_jobs_col,
+    lambda job: authorize_router_user(job["code"], job["mac_address"], job["duration_hours"], job["router"],
+                                      job.get("profile")),
+    workers=config.PROVISIONING_WORKERS,
+    per_router=config.PROVISIONING_PER_ROUTER,
+    max_attempts=config.PROVISIONING_MAX_ATTEMPTS
+)
+if config.PROVISIONING_WORKERS > 0:
+    provisioning_queue.start()
+
+
+def revoke_router_user(session):
+    """Take an expired session off its site's router."""
+    router = fleet.get(session.get("site"))
+    if router.type == 'mikrotik':
+        # Hotspot username is the code the customer logged in with
+        router.bridge.remove_user(session.get("mpesa_code") or session.get("code"))
+    # TP-Link authorizations carry their own period and lapse on the controller
+
+
+session_expiry = SessionExpiryScheduler(wifi_sessions_col, revoke_router_user, lease_col=worker_leases_col,
+                                        on_expired=lambda count: wifi_counters.add(active_users=-count))
+if config.WIFI_EXPIRY_ENABLED:
+    session_expiry.start()
+
+# Repair drift between wifi_sessions and each MikroTik's hotspot user table
+hotspot_reconcilers = {
+    site: HotspotReconciler(wifi_sessions_col, fleet.get(site).bridge, site=site,
+                            include_unassigned=(site == fleet.default_site), vouchers_col=vouchers_col,
+                            profile_for=wifi_plans.profile_for)
+    for site in fleet.sites('mikrotik')
+}
+
+
+def sync_hotspot_profiles(router):
+    """Create or update the per-plan hotspot user profiles on one MikroTik."""
+    return router.bridge.ensure_hotspot_profiles(wifi_plans.hotspot_profiles())
+
+
+def reconcile_router(router, dry_run=False):
+    if not dry_run:
+        # Profiles first, so users re-added below get their plan's rate limit
+        sync_hotspot_profiles(router)
+    return hotspot_reconcilers[router.site].run_once(dry_run)
+
+
+def reconcile_fleet(dry_run=False, sites=None):
+    """Reconcile every MikroTik site in parallel; a slow or unreachable site only fails its own entry."""
+    sites = list(hotspot_reconcilers) if sites is None else sites
+    if not sites:
+        return {}  # No MikroTik sites: nothing to reconcile (the fleet would otherwise mean every site)
+    return fleet.fan_out(lambda router: reconcile_router(router, dry_run), sites=sites, kind="reconcile")
+
+
+if hotspot_reconcilers and config.HOTSPOT_RECONCILE_ENABLED:
+    PeriodicWorker("hotspot-reconcile", lambda: reconcile_fleet(config.HOTSPOT_RECONCILE_DRY_RUN),
+                   config.HOTSPOT_RECONCILE_INTERVAL, worker_leases_col).start()
+
+# Correct any drift in the Wi-Fi stats counters
+if config.WIFI_COUNTERS_REBUILD_INTERVAL > 0:
+    PeriodicWorker("wifi-counters-rebuild", lambda: wifi_counters.rebuild(wifi_sessions_col, wifi_daily_col),
+                   config.WIFI_COUNTERS_REBUILD_INTERVAL, worker_leases_col).start()
+
+# Summarize finished sessions per day, then remove them from wifi_sessions
+wifi_rollup = SessionRollup(wifi_sessions_col, wifi_daily_col, retention_days=config.WIFI_SESSION_RETENTION_DAYS,
+                            failed_ttl=config.WIFI_PENDING_TTL)
+if config.WIFI_ROLLUP_INTERVAL > 0:
+    PeriodicWorker("wifi-session-rollup", wifi_rollup.run_once, config.WIFI_ROLLUP_INTERVAL, worker_leases_col).start()
+
+# Live usage: one /ip/hotspot/active call per MikroTik per interval, stored as compact samples
+hotspot_telemetry = HotspotTelemetry(hotspot_usage_live_col, hotspot_usage_samples_col, hotspot_usage_hourly_col)
+if fleet.sites('mikrotik') and config.TELEMETRY_ENABLED:
+    PeriodicWorker("hotspot-telemetry",
+                   lambda: fleet.fan_out(hotspot_telemetry.poll, sites=fleet.sites('mikrotik'), kind="telemetry"),
+                   config.TELEMETRY_INTERVAL, worker_leases_col).start()
+
+
+def register_payment(result, target, target_id, amount, phone, site=None):
+    """Record an initiated STK push so its callback resolves with one indexed lookup."""
+    checkout_id = result.get("checkout_request_id")
+    if not checkout_id: return
+    payment = {
+        "checkout_request_id": checkout_id,
+        "merchant_request_id": result.get("merchant_request_id"),
+        "target": target,  # "order" | "wifi_session"
+        "target_id": target_id,
+        "amount": amount,
+        "phone": phone,
+        "status": "pending",
+        "created_at": datetime.datetime.now()
+    }
+    if site: payment["site"] = site  # Hotspot site of a Wi-Fi purchase
+    try:
+        payments_col.insert_one(payment)
+    except DuplicateKeyError:
+        if config.DEBUG: print(f"[M-PESA] Payment {checkout_id} already registered")
+
+
 def hash_password(plain_text_password: str) -> bytes:
     return bcrypt.hashpw(plain_text_password.encode("utf-8"), bcrypt.gensalt())
 
@@ -171,56 +381,22 @@ def normalize_phone(phone: str) -> str:
     return re.sub(r"\D", "", str(phone))
 
 
-def json_serializer(data):
-    """Helper to convert PyMongo objects (like ObjectId, datetime) to JSON serializable format."""
-    if isinstance(data, list):
-        return [json_serializer(i) for i in data]
-    if isinstance(data, dict):
-        new_data = {}
-        for k, v in data.items():
-            if isinstance(v, ObjectId):
-                new_data[k] = str(v)
-            elif isinstance(v, datetime.datetime):
-                new_data[k] = v.isoformat()
-            elif isinstance(v, dict) or isinstance(v, list):
-                new_data[k] = json_serializer(v)
-            else:
-                new_data[k] = v
-        return new_data
-    return data
-
-
 def generate_otp():
     """Generate a 6-digit OTP."""
     return ''.join(random.choices('0123456789', k=6))
 
 
-def send_sms_mock(phone, message):
-    """Mock SMS sender - logs to console for dev/testing if DEBUG enabled."""
-    if config.DEBUG:
-        print(f"\n[MOCK SMS] To: {phone}")
-        print(f"[MOCK SMS] Message: {message}\n")
-    return True
-
-
-def send_async_email(subject, recipient, body):
-    """Send email asynchronously in background thread to prevent blocking."""
-    def _send():
-        try:
-            with app.app_context():  # Required for Flask-Mail in threads
-                msg = Message(subject, recipients=[recipient])
-                msg.body = body
-                mail.send(msg)
-                if config.DEBUG:
-                    print(f"[MAIL] Sent: {subject} to {recipient}")
-        except Exception as e:
-            if config.DEBUG:
-                print(f"[MAIL] Failed to send {subject} to {recipient}: {e}")
-    
-    # Start thread and return immediately
-    thread = threading.Thread(target=_send)
-    thread.daemon = True  # Don't block app shutdown
-    thread.start()
+# Outgoing SMS (OTPs): queued in sms_outbox, sent in batches by worker threads
+sms = SmsDispatcher(
+    sms_outbox_col,
+    build_provider(),
+    workers=config.SMS_WORKERS,
+    rate=config.SMS_RATE,
+    max_attempts=config.SMS_MAX_ATTEMPTS,
+    reports_col=sms_reports_col
+)
+if config.SMS_WORKERS > 0:
+    sms.start()
 
 
 # --- PAGINATION HELPER ---
@@ -232,27 +408,27 @@ def get_pagination_params():
 
 
 def get_paginated_response(collection, query, sort_key="created_at", sort_order=-1):
+    """{"success": true, "data": ...} response: one page with totals, or every match as a streamed list."""
     page, limit, search = get_pagination_params()
 
-    # Get Total Count
-    total = collection.count_documents(query)
-
     cursor = collection.find(query).sort(sort_key, sort_order)
 
     if page:
+        # Get Total Count
+        total = collection.count_documents(query)
         cursor = cursor.skip((page - 1) * limit).limit(limit)
         items = list(cursor)
-        return {
-            "items": json_serializer(items),
+        return jsonify({"success": True, "data": {
+            "items": items,
             "total": total,
             "page": page,
             "pages": (total + limit - 1) // limit,
             "has_next": page * limit < total,
             "has_prev": page > 1
-        }
+        }})
     else:
-        # Backward compatibility: return list directly
-        return json_serializer(list(cursor))
+        # Backward compatibility: return list directly (streamed, so memory does not grow with the collection)
+        return stream_json(cursor.batch_size(config.STREAM_CHUNK_SIZE), {"success": True})
 
 
 # ================= AUTHENTICATION =================
@@ -300,8 +476,8 @@ def register():
     try:
         users_col.insert_one(user)
         
-        # Send Email OTP (Async - non-blocking)
-        send_async_email(
+        # Send Email OTP (queued - non-blocking)
+        mail_queue.send(
             "Verify your Email - Tindi Tech",
             data["email"],
             f"Your Email Verification Code is: {email_otp}"
@@ -309,7 +485,7 @@ def register():
 
         # Send Phone OTP (Mock)
         if user["phone"]:
-            send_sms_mock(user["phone"], f"Your Tindi Tech Verification Code is: {phone_otp}")
+            sms.send(user["phone"], f"Your Tindi Tech Verification Code is: {phone_otp}", kind="otp")
 
         return jsonify({
             "success": True, 
@@ -500,39 +676,29 @@ def forgot_password():
         {"$set": {"reset_token": reset_token, "reset_token_expiration": expiration}}
     )
 
-    # Send Email
+    # Send Email (queued; the response does not wait for SMTP)
     email_sent = False
-    try:
-        reset_link = f"{config.FRONTEND_URL}/reset_password.html?token={reset_token}"
-
-        if config.MAIL_USERNAME:
-            msg = Message(
-                subject="Password Reset Request - Tindi Tech",
-                sender=config.MAIL_DEFAULT_SENDER,
-                recipients=[email],
-                body=f"Hi {user['fname']},\n\nYou requested to reset your password. Click the link below to reset it:\n\n{reset_link}\n\nIf you did not request this, please ignore this email.\n\nLink expires in 1 hour."
-            )
-            mail.send(msg)
-            if config.DEBUG:
-                print(f"[MAIL] Sent reset link to {email}")
-            email_sent = True
-        else:
-            if config.DEBUG:
-                print("[MAIL] Mail not configured. Reset Key:", reset_token)
+    reset_link = f"{config.FRONTEND_URL}/reset_password.html?token={reset_token}"
 
-        # DEBUG MODE HELPER
-        if config.DEBUG and not email_sent:
-            return jsonify({
-                "success": True,
-                "message": "Debug Mode: Email config missing. Using debug link.",
-                "debug_link": reset_link
-            })
-
-    except Exception as e:
+    if config.MAIL_USERNAME:
+        email_sent = mail_queue.send(
+            "Password Reset Request - Tindi Tech",
+            email,
+            f"Hi {user['fname']},\n\nYou requested to reset your password. Click the link below to reset it:\n\n{reset_link}\n\nIf you did not request this, please ignore this email.\n\nLink expires in 1 hour."
+        )
         if config.DEBUG:
-            print(f"[MAIL] Error sending email: {e}")
+            print(f"[MAIL] Reset link for {email} {'queued' if email_sent else 'not queued (queue full)'}")
+    else:
         if config.DEBUG:
-            return jsonify({"success": False, "error": f"Mail Error: {str(e)}"})
+            print("[MAIL] Mail not configured. Reset Key:", reset_token)
+
+    # DEBUG MODE HELPER
+    if config.DEBUG and not email_sent:
+        return jsonify({
+            "success": True,
+            "message": "Debug Mode: Email not sent. Using debug link.",
+            "debug_link": reset_link
+        })
 
     # Production response (Standard)
     return jsonify({"success": True, "message": "If that email exists, a reset link has been sent."})
@@ -598,30 +764,29 @@ def get_all_users():
 
     # Custom pagination flow because of field projection and 'is_logged_in' logic
     page, limit, _ = get_pagination_params()
-    total = users_col.count_documents(query)
     cursor = users_col.find(query, {"password": 0}).sort("created_at", -1)
 
-    if page:
-        cursor = cursor.skip((page - 1) * limit).limit(limit)
-
-    users = list(cursor)
-    for u in users:
-        # Check token validity (expiration) not just existence
-        u['is_logged_in'] = is_token_valid(u)
+    def with_login_status(users):
+        for u in users:
+            # Check token validity (expiration) not just existence
+            u['is_logged_in'] = is_token_valid(u)
+            yield u
 
-    data = json_serializer(users)
+    if not page:
+        # Every user: streamed in batches instead of held in memory
+        return stream_json(with_login_status(cursor.batch_size(config.STREAM_CHUNK_SIZE)), {"success": True})
 
-    if page:
-        return jsonify({
-            "success": True,
-            "data": {
-                "items": data,
-                "total": total,
-                "page": page,
-                "pages": (total + limit - 1) // limit
-            }
-        })
-    return jsonify({"success": True, "data": data})
+    total = users_col.count_documents(query)
+    users = list(with_login_status(cursor.skip((page - 1) * limit).limit(limit)))
+    return jsonify({
+        "success": True,
+        "data": {
+            "items": users,
+            "total": total,
+            "page": page,
+            "pages": (total + limit - 1) // limit
+        }
+    })
 
 
 @app.route("/users/<id>/logout", methods=["POST"])
@@ -773,15 +938,15 @@ def resend_otp():
         users_col.update_one({"_id": user["_id"]}, {"$set": updates})
         
         if "email_otp" in updates:
-            # Send email asynchronously
-            send_async_email(
+            # Queue the email; a mail worker sends it
+            mail_queue.send(
                 "New Verification Code - Tindi Tech",
                 email,
                 f"Your New Email Code is: {email_otp}"
             )
         
         if "phone_otp" in updates and user.get("phone"):
-            send_sms_mock(user["phone"], f"Your New Phone Code is: {phone_otp}")
+            sms.send(user["phone"], f"Your New Phone Code is: {phone_otp}", kind="otp")
 
     return jsonify({"success": True, "message": "OTPs resent"})
 
@@ -798,8 +963,7 @@ def get_products():
         # Optional: search category too
         # query["$or"] = [{"name": ...}, {"category": ...}]
 
-    data = get_paginated_response(products_col, query)
-    return jsonify({"success": True, "data": data})
+    return get_paginated_response(products_col, query)
 
 
 @app.route("/products", methods=["POST"])
@@ -920,8 +1084,7 @@ def get_orders():
             {"customer.phone": {"$regex": search, "$options": "i"}}
         ]
 
-    data = get_paginated_response(orders_col, query)
-    return jsonify({"success": True, "data": data})
+    return get_paginated_response(orders_col, query)
 
 
 @app.route("/create-order", methods=["POST"])
@@ -1033,6 +1196,7 @@ def stk_push():
         if order_id:
             orders_col.update_one({"order_id": order_id}, 
                 {"$set": {"payment.checkout_id": result.get("checkout_request_id")}})
+            register_payment(result, "order", order_id, amount, phone)
         
         return jsonify({"success": True, "message": "STK Push sent to phone",
                         "checkout_request_id": result.get("checkout_request_id")})
@@ -1044,98 +1208,364 @@ def stk_push():
         return jsonify(result), 400
 
 
-@app.route("/api/mpesa/callback", methods=["POST"])
-def mpesa_callback():
-    """
-    Handle M-Pesa IPN (Instant Payment Notification)
-    Safaricom sends a POST request here when a transaction completes or fails.
-    """
-    data = request.get_json() or {}
-    if config.DEBUG:
-        print(f"[M-PESA] Callback Received: {data}")
-    
-    # Check if Body exists
-    body = data.get("Body", {})
-    stkCallback = body.get("stkCallback", {})
-    
-    checkout_id = stkCallback.get("CheckoutRequestID")
-    result_code = stkCallback.get("ResultCode")
-    result_desc = stkCallback.get("ResultDesc")
-    
-    if not checkout_id:
-        return jsonify({"success": False, "message": "Invalid Callback payload"}), 400
+# Callback target updates are coalesced and written with bulk_write during bursts
+callback_writer = BulkWriter("mpesa-callback", interval=0.2)
 
-    if config.DEBUG:
-        print(f"[M-PESA] Processing Callback. ID: {checkout_id}, Code: {result_code}, Desc: {result_desc}")
+# Wakes clients waiting on /wifi/status/<id>/events and /order/<id>/events
+status_bus = StatusBus()
 
-    # Determine status
-    payment_status = "failed"
-    order_status = "canceled" # Default if failed
-    
-    # ResultCode 0 means SUCCESS
-    if result_code == 0:
-        payment_status = "paid"
-        order_status = "processing"
-        
+
+def apply_stk_result(stk_callback):
+    """
+    Apply an STK result (callback body or reconciled query) exactly once.
+    Returns "applied", "duplicate", "mismatch" or "legacy".
+    """
+    checkout_id = stk_callback.get("CheckoutRequestID")
+    merchant_id = stk_callback.get("MerchantRequestID")
+    result_code = stk_callback.get("ResultCode")
+    result_desc = stk_callback.get("ResultDesc")
+
+    # ResultCode 0 means SUCCESS (Daraja sends an int in callbacks, a string in queries)
+    paid = str(result_code) == "0"
+    receipt_number = phone = amount_paid = None
+    if paid:
         # Extract metadata (Amount, Receipt Check, etc.)
-        meta_items = stkCallback.get("CallbackMetadata", {}).get("Item", [])
+        meta_items = stk_callback.get("CallbackMetadata", {}).get("Item", [])
         receipt_number = next((item.get("Value") for item in meta_items if item.get("Name") == "MpesaReceiptNumber"), None)
         phone = next((item.get("Value") for item in meta_items if item.get("Name") == "PhoneNumber"), None)
         amount_paid = next((item.get("Value") for item in meta_items if item.get("Name") == "Amount"), None)
-        
         if config.DEBUG:
             print(f"[M-PESA] Success! Receipt: {receipt_number}, Amount: {amount_paid}")
-        
-        # Update details map
+    elif config.DEBUG:
+        print(f"[M-PESA] Payment Failed/Cancelled.")
+
+    now = datetime.datetime.now()
+    # The reconciler releases payments it never got an answer for as failed (ResultCode -1)
+    gave_up = stk_callback.get("Source") == "stk_query" and str(result_code) == "-1"
+
+    # 1. Claim the pending registry entry atomically - duplicates find nothing to claim
+    claim = {"checkout_request_id": checkout_id, "merchant_request_id": {"$in": [merchant_id, None]}}
+    result = {
+        "status": "paid" if paid else "failed",
+        "gave_up": gave_up,
+        "result_code": result_code,
+        "result_desc": result_desc,
+        "receipt_number": receipt_number,
+        "paid_phone": phone,
+        "amount_paid": amount_paid,
+        # Wi-Fi login code, fixed here so a re-queued target write reuses it. The receipt
+        # doubles as the code; results recovered via STK Query carry none, so those get a generated one.
+        "access_code": (receipt_number or generate_access_code()) if paid else None,
+        "completed_at": now,
+        "applied": False
+    }
+    payment = payments_col.find_one_and_update(dict(claim, status="pending"), {"$set": result},
+                                               return_document=ReturnDocument.AFTER)
+    if not payment and paid:
+        # The customer paid after the reconciler gave up on the payment: the money was taken, so the
+        # success wins over the give-up. Flagged for review - they may have paid again meanwhile.
+        payment = payments_col.find_one_and_update(
+            dict(claim, status="failed", gave_up=True),
+            {"$set": dict(result, overrode_give_up=True)},
+            return_document=ReturnDocument.AFTER
+        )
+        if payment and config.DEBUG: print(f"[M-PESA] Success for {checkout_id} after the reconciler gave up; applying it.")
+
+    if not payment:
+        existing = payments_col.find_one({"checkout_request_id": checkout_id}, {"status": 1, "merchant_request_id": 1})
+        if existing:
+            if existing.get("status") == "pending":
+                if config.DEBUG: print(f"[M-PESA] MerchantRequestID mismatch for {checkout_id}. Ignored.")
+                return "mismatch"
+            if config.DEBUG: print(f"[M-PESA] Duplicate callback for {checkout_id}. Ignored.")
+            return "duplicate"
+        apply_legacy_stk_result(checkout_id, paid, receipt_number, phone, result_desc, stk_callback)
+        return "legacy"
+
+    # 2. Update the target (order or Wi-Fi session) through the batched writer
+    queue_payment_update(payment)
+    return "applied"
+
+
+def generate_access_code():
+    return "TT" + uuid.uuid4().hex[:8].upper()
+
+
+def assign_access_code(payment):
+    """Store a login code on a payment claimed before codes were set at claim time; first writer wins."""
+    payments_col.update_one({"_id": payment["_id"], "access_code": None},
+                            {"$set": {"access_code": generate_access_code()}})
+    return payments_col.find_one({"_id": payment["_id"]}, {"access_code": 1})["access_code"]
+
+
+def queue_payment_update(payment):
+    """Queue the order / Wi-Fi session update for a completed registry entry."""
+    checkout_id = payment["checkout_request_id"]
+    paid = payment["status"] == "paid"
+
+    if payment["target"] == "order":
+        if paid:
+            payment_details = {
+                "payment.status": "paid",
+                "status": "processing",
+                "payment.receipt_number": payment.get("receipt_number"),
+                "payment.phone": payment.get("paid_phone"),
+                "payment.paid_at": payment.get("completed_at")
+            }
+        else:
+            # Note: We do NOT auto-cancel the order, just mark payment as failed so they can retry.
+            payment_details = {
+                "payment.status": "failed",
+                "payment.failure_reason": payment.get("result_desc")
+            }
+        access_code = None
+        target_col = orders_col
+        op = UpdateOne({"order_id": payment["target_id"]}, {"$set": payment_details})
+        applied = {"order_id": payment["target_id"], "payment.status": payment_details["payment.status"]}
+    else:
+        access_code = payment.get("access_code") or payment.get("receipt_number")
+        if paid and not access_code:
+            access_code = assign_access_code(payment)
+        # A success that overrode a give-up finds the session already released as failed
+        awaiting = {"$in": ["pending_payment", "failed"]} if payment.get("overrode_give_up") else "pending_payment"
+        target_col = wifi_sessions_col
+        op = UpdateOne(
+            {"session_id": payment["target_id"], "status": awaiting},
+            {"$set": {
+                "status": "paid" if paid else "failed",
+                "mpesa_code": access_code if paid else None,
+                "paid_at": payment.get("completed_at")
+            }}
+        )
+        applied = {"session_id": payment["target_id"], "status": "paid" if paid else "failed"}
+        if paid:
+            applied["mpesa_code"] = access_code
+
+    # Runs only once the target shows this result - also when an earlier, unconfirmed write put it there
+    callback_writer.add(target_col, checkout_id, op, on_flushed=lambda: payment_applied(payment, access_code),
+                        applied=applied)
+    if config.DEBUG: print(f"[M-PESA] {payment['target']} {payment['target_id']} queued for update.")
+
+
+def payment_applied(payment, access_code=None):
+    """The target write has landed: finish the payment once, then wake any client streaming its status."""
+    marked = payments_col.update_one({"_id": payment["_id"], "status": payment["status"], "applied": False},
+                                     {"$set": {"applied": True}})
+    if not marked.modified_count:
+        return  # A re-queued write for a payment that was already finished
+    paid = payment["status"] == "paid"
+    if payment["target"] == "order":
+        # The order's own status (processing, or whatever it had when the payment failed)
+        status_bus.publish(f"order:{payment['target_id']}", order_status_payload(payment["target_id"]))
+    else:
+        if paid:
+            # Counted here, once the session is paid: the applied flag above lets only one call through
+            wifi_counters.add(total_revenue=payment.get("amount") or 0, paid_sessions=1)
+            # Map the login code before the portal is told about it
+            access_codes.register(access_code, "mpesa", session_id=payment["target_id"])
+        status_bus.publish(f"wifi:{payment['checkout_request_id']}", {
+            "success": True,
+            "status": "paid" if paid else "failed",
+            "code": access_code if paid else None,
+            "router_type": fleet.router_type(payment.get("site"))
+        })
+
+
+def requeue_payment_update(payment):
+    """Reconciler hook: re-queue a completed payment's target update unless the target can no longer take it."""
+    paid = payment["status"] == "paid"
+    if payment["target"] == "order":
+        target = orders_col.find_one({"order_id": payment["target_id"]}, {"_id": 1})
+    else:
+        states = ["pending_payment", "paid" if paid else "failed"]
+        if payment.get("overrode_give_up"):
+            states.append("failed")
+        target = wifi_sessions_col.find_one({"session_id": payment["target_id"], "status": {"$in": states}}, {"_id": 1})
+    if not target:
+        # Deleted, or a Wi-Fi session that expired while waiting: re-queuing would never land
+        payments_col.update_one({"_id": payment["_id"]}, {"$set": {
+            "applied": True, "apply_error": f"{payment['target']} {payment['target_id']} can no longer be updated"
+        }})
+        if config.DEBUG: print(f"[M-PESA] {payment['target']} {payment['target_id']} gone; payment {payment['checkout_request_id']} closed.")
+        return
+    queue_payment_update(payment)
+
+
+def apply_legacy_stk_result(checkout_id, paid, receipt_number, phone, result_desc, stk_callback):
+    """Pushes initiated before the payments registry existed: match by checkout ID directly."""
+    if paid:
         payment_details = {
-            "payment.status": payment_status,
-            "status": order_status,
+            "payment.status": "paid",
+            "status": "processing",
             "payment.receipt_number": receipt_number,
             "payment.phone": phone,
             "payment.paid_at": datetime.datetime.now()
         }
     else:
-        # User Cancelled or Failed
-        if config.DEBUG:
-            print(f"[M-PESA] Payment Failed/Cancelled.")
         payment_details = {
             "payment.status": "failed",
             "payment.failure_reason": result_desc
         }
-        # Note: We might NOT want to auto-cancel the order immediately, 
-        # just mark payment as failed so they can retry. 
-        # But user asked for logic where it's only paid if actually paid.
-        
-    # UPDATE ORDER
+
     # We search by 'payment.checkout_id' which we saved during stk_push
     result = orders_col.update_one(
         {"payment.checkout_id": checkout_id},
         {"$set": payment_details}
     )
-    
+
     if result.matched_count > 0:
         if config.DEBUG: print(f"[M-PESA] Order updated via callback.")
+        return
+
+    # Could be a Wi-Fi Session?
+    if config.DEBUG: print(f"[M-PESA] No order found for CheckoutID {checkout_id}. Checking Wi-Fi sessions...")
+    wifi_session = wifi_sessions_col.find_one_and_update(
+         {"checkout_request_id": checkout_id, "status": "pending_payment"},
+         {"$set": {
+             "status": "paid" if paid else "failed",
+             "mpesa_code": (receipt_number or "FAILED") if paid else None,
+             "paid_at": datetime.datetime.now()
+         }},
+         projection={"session_id": 1, "mpesa_code": 1, "amount": 1},
+         return_document=ReturnDocument.AFTER
+    )
+    if wifi_session:
+         if paid:
+             access_codes.register(wifi_session["mpesa_code"], "mpesa", session_id=wifi_session.get("session_id"))
+             wifi_counters.add(total_revenue=wifi_session.get("amount") or 0, paid_sessions=1)
+         if config.DEBUG: print("[M-PESA] Wi-Fi Session updated.")
     else:
-        # Could be a Wi-Fi Session?
-        if config.DEBUG: print(f"[M-PESA] No order found for CheckoutID {checkout_id}. Checking Wi-Fi sessions...")
-        # (Optional: Add logic to update Wi-Fi session if that's also using this callback)
-        wifi_result = wifi_sessions_col.update_one(
-             {"checkout_request_id": checkout_id},
-             {"$set": {
-                 "status": "paid" if result_code == 0 else "failed",
-                 "mpesa_code": next((item.get("Value") for item in meta_items if item.get("Name") == "MpesaReceiptNumber"), "FAILED") if result_code == 0 else None,
-                 "paid_at": datetime.datetime.now()
-             }}
-        )
-        if wifi_result.matched_count > 0:
-             if config.DEBUG: print("[M-PESA] Wi-Fi Session updated.")
-        else:
-             if config.DEBUG: print("[M-PESA] No matching record found for callback.")
+         if config.DEBUG: print("[M-PESA] No matching record found for callback.")
 
-    return jsonify({"success": True})
 
+@app.route("/api/mpesa/callback", methods=["POST"])
+def mpesa_callback():
+    """
+    Handle M-Pesa IPN (Instant Payment Notification)
+    Safaricom sends a POST request here when a transaction completes or fails.
+    Safaricom may deliver the same callback more than once; repeats are acknowledged and ignored.
+    """
+    data = request.get_json() or {}
+    if config.DEBUG:
+        print(f"[M-PESA] Callback Received: {data}")
+    
+    # Check if Body exists
+    body = data.get("Body", {})
+    stkCallback = body.get("stkCallback", {})
+    
+    checkout_id = stkCallback.get("CheckoutRequestID")
+    if not checkout_id:
+        return jsonify({"success": False, "message": "Invalid Callback payload"}), 400
+
+    if config.DEBUG:
+        print(f"[M-PESA] Processing Callback. ID: {checkout_id}, Code: {stkCallback.get('ResultCode')}, Desc: {stkCallback.get('ResultDesc')}")
+
+    outcome = apply_stk_result(stkCallback)
+    return jsonify({"success": True, "result": outcome})
+
+
+# Recover payments whose callback never arrived (STK Push Query)
+stk_reconciler = StkReconciler(payments_col, apply_stk_result, requeue_payment_update,
+                               rate=config.MPESA_RECONCILE_RATE)
+if config.MPESA_RECONCILE_ENABLED:
+    stk_reconciler.worker(worker_leases_col, config.MPESA_RECONCILE_INTERVAL).start()
+
+
+@app.route("/admin/mpesa/reconcile", methods=["POST"])
+def run_mpesa_reconciliation():
+    """Run one STK Query reconciliation pass now (Super Admin Only)."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    outcome = stk_reconciler.run_once()
+    # Successes that arrived after a give-up: the customer may also have paid again meanwhile
+    review = list(payments_col.find(
+        {"overrode_give_up": True},
+        {"_id": 0, "checkout_request_id": 1, "target": 1, "target_id": 1, "amount": 1, "phone": 1, "completed_at": 1}
+    ).sort("completed_at", -1).limit(50))
+    return jsonify({"success": True, "result": outcome, "totals": stk_reconciler.stats, "review": review})
+
+
+@app.route("/admin/mpesa/metrics", methods=["GET"])
+def get_mpesa_metrics():
+    """Daraja connection pool / reuse metrics (Super Admin Only)."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    return jsonify({"success": True, "metrics": daraja.metrics()})
+
+
+@app.route("/sms/delivery", methods=["POST"])
+def sms_delivery_report():
+    """Delivery report from the SMS gateway: {"message_id": ..., "status": "delivered" | "failed", "error": ...}"""
+    if config.SMS_CALLBACK_TOKEN and request.args.get("token") != config.SMS_CALLBACK_TOKEN:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    data = request.get_json(silent=True) or {}
+    if not data.get("message_id"):
+        return jsonify({"success": False, "error": "message_id required"}), 400
+    known = sms.record_delivery(data["message_id"], data.get("status") == "delivered", data.get("error"))
+    return jsonify({"success": known}), 200 if known else 404
+
+
+@app.route("/admin/sms/metrics", methods=["GET"])
+def get_sms_metrics():
+    """SMS dispatcher counters and sms_outbox messages by status (Super Admin Only)."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    outbox = {row["_id"]: row["count"] for row in sms_outbox_col.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ])}
+    return jsonify({"success": True, "metrics": sms.metrics(), "outbox": outbox})
+
+
+@app.route("/admin/mail/metrics", methods=["GET"])
+def get_mail_metrics():
+    """Outgoing mail queue depth and SMTP connection reuse (Super Admin Only)."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    return jsonify({"success": True, "metrics": mail_queue.metrics()})
 
 
+def order_status_payload(order_id, order=None):
+    """Payment status summary streamed to checkout / receipt pages."""
+    order = order or orders_col.find_one({"order_id": order_id}, {"status": 1, "payment.status": 1})
+    if not order:
+        return {"success": False, "status": "not_found"}
+    return {
+        "success": True,
+        "status": order.get("status"),
+        "payment_status": order.get("payment", {}).get("status")
+    }
+
+
+def stream_unavailable():
+    """All stream slots of this worker are taken: the client falls back to polling."""
+    res = jsonify({"success": False, "error": "Too many status streams, poll instead"})
+    res.headers["Retry-After"] = "3"
+    return res, 503
+
+
+@app.route("/order/<order_id>/events", methods=["GET"])
+def stream_order_status(order_id):
+    """SSE: push the order's payment status when it changes (polling /order/<id> remains as fallback)."""
+    if status_bus.waiting() >= config.STATUS_STREAM_MAX:
+        return stream_unavailable()
+    stream = sse_stream(
+        status_bus, f"order:{order_id}",
+        lambda: order_status_payload(order_id),
+        lambda p: p.get("payment_status") in ("paid", "failed"),
+        timeout=config.STATUS_STREAM_TIMEOUT,
+        max_waiting=config.STATUS_STREAM_MAX
+    )
+    return Response(stream, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/order/<order_id>", methods=["GET"])
@@ -1149,7 +1579,7 @@ def get_order_status(order_id):
 
     return jsonify({
         "success": True,
-        "order": json_serializer(order)
+        "order": order
     })
 
 
@@ -1220,7 +1650,7 @@ def get_order_details(order_id):
     if not is_admin and not is_owner:
         return jsonify({"success": False, "error": "Forbidden"}), 403
 
-    return jsonify({"success": True, "data": json_serializer(order)})
+    return jsonify({"success": True, "data": order})
 
 
 # ================= USER ORDERS =================
@@ -1235,16 +1665,16 @@ def get_user_orders():
     # Find orders by username, email or normalized phone
     phone_norm = normalize_phone(user.get("phone", ""))
     
-    orders = list(orders_col.find({
+    orders = orders_col.find({
         "$or": [
             {"username": user.get("username")},
             {"customer.email": user.get("email")},
             {"phone_normalized": phone_norm},
             {"customer.phone": user.get("phone")} # Fallback for old orders
         ]
-    }).sort("created_at", -1))
+    }).sort("created_at", -1).batch_size(config.STREAM_CHUNK_SIZE)
 
-    return jsonify({"success": True, "data": json_serializer(orders)})
+    return stream_json(orders, {"success": True})
 
 
 @app.route("/my-orders/<order_id>/cancel", methods=["PATCH"])
@@ -1403,8 +1833,7 @@ def get_messages():
             {"email": {"$regex": safe_search, "$options": "i"}},
             {"subject": {"$regex": safe_search, "$options": "i"}}
         ]
-    data = get_paginated_response(messages_col, query)
-    return jsonify({"success": True, "data": data})
+    return get_paginated_response(messages_col, query)
 
 
 @app.route("/quotes", methods=["GET"])
@@ -1418,8 +1847,7 @@ def get_quotes():
             {"email": {"$regex": safe_search, "$options": "i"}},
             {"details": {"$regex": safe_search, "$options": "i"}}
         ]
-    data = get_paginated_response(quotes_col, query)
-    return jsonify({"success": True, "data": data})
+    return get_paginated_response(quotes_col, query)
 
 
 
@@ -1427,8 +1855,8 @@ def get_quotes():
 
 @app.route("/wifi/plans", methods=["GET"])
 def get_wifi_plans():
-    """Return hardcoded/dynamic Wi-Fi plans."""
-    return jsonify({"success": True, "plans": WIFI_PLANS})
+    """Return the Wi-Fi plans on sale (from the in-memory catalog)."""
+    return jsonify({"success": True, "plans": wifi_plans.active()})
 
 
 @app.route("/wifi/pay", methods=["POST"])
@@ -1437,12 +1865,13 @@ def wifi_pay():
     data = request.get_json() or {}
     phone = data.get("phone")
     plan_id = data.get("plan_id")
-    mac_address = data.get("mac_address")
+    mac_address = str(data.get("mac_address") or "").strip().upper() or None  # One case, so search needs one regex
+    site = fleet.resolve(data.get("site"))
 
-    if not phone or not plan_id or plan_id not in WIFI_PLANS:
+    plan = wifi_plans.get(plan_id) if plan_id else None
+    if not phone or not plan:
         return jsonify({"success": False, "error": "Invalid phone or plan"}), 400
 
-    plan = WIFI_PLANS[plan_id]
     amount = plan["price"]
 
     # 1. Initiate STK Push
@@ -1453,17 +1882,20 @@ def wifi_pay():
 
     # 2. Store Session in MongoDB (Status: pending_payment)
     session_id = str(uuid.uuid4())
+    register_payment(result, "wifi_session", session_id, amount, phone, site=site)
     wifi_sessions_col.insert_one({
         "session_id": session_id,
         "phone": phone,
         "plan_id": plan_id,
         "amount": amount,
+        "duration_hours": plan["duration"],  # Fixed at purchase; later catalog edits do not change it
         "status": "pending_payment", 
         "created_at": datetime.datetime.now(),
         "checkout_request_id": result.get("checkout_request_id"),
         "mpesa_code": None,
         "type": "mpesa",
         "mac_address": mac_address,
+        "site": site,  # Hotspot the customer bought from
         "start_time": None,
         "expiry_time": None
     })
@@ -1475,25 +1907,68 @@ def wifi_pay():
     })
 
 
+def wifi_status_payload(checkout_id, session=None):
+    """Payment status of a Wi-Fi session, shared by polling and SSE."""
+    session = session or wifi_sessions_col.find_one({"checkout_request_id": checkout_id},
+                                                    {"status": 1, "mpesa_code": 1, "site": 1})
+    if not session:
+        return {"success": False, "status": "not_found"}
+
+    # Status updates only via callback (or STK Query reconciliation).
+    return {
+        "success": True,
+        "status": session.get("status"),
+        "code": session.get("mpesa_code"),
+        "router_type": fleet.router_type(session.get("site"))
+    }
+
+
 @app.route("/wifi/status/<checkout_id>", methods=["GET"])
 def wifi_check_status(checkout_id):
-    """Check payment status from MongoDB. Demo Only: Auto-complete."""
-    session = wifi_sessions_col.find_one({"checkout_request_id": checkout_id})
-    if not session:
-        return jsonify({"success": False, "status": "not_found"}), 404
+    """Check payment status from MongoDB (polling fallback for /wifi/status/<id>/events)."""
+    payload = wifi_status_payload(checkout_id)
+    if not payload["success"]:
+        return jsonify(payload), 404
+    return jsonify(payload)
+
+
+@app.route("/wifi/status/<checkout_id>/events", methods=["GET"])
+def wifi_stream_status(checkout_id):
+    """SSE: one read on connect, then wait on the status bus until the callback lands."""
+    if status_bus.waiting() >= config.STATUS_STREAM_MAX:
+        return stream_unavailable()
+    stream = sse_stream(
+        status_bus, f"wifi:{checkout_id}",
+        lambda: wifi_status_payload(checkout_id),
+        lambda p: p.get("status") not in ("pending_payment", None),
+        timeout=config.STATUS_STREAM_TIMEOUT,
+        max_waiting=config.STATUS_STREAM_MAX
+    )
+    return Response(stream, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
-    status = session.get("status")
+def publish_status_changes():
+    """
+    Wake this worker's streams for payments applied in another worker: one query per
+    collection for every key waited on here, publishing only final statuses.
+    """
+    checkout_ids = status_bus.keys("wifi:")
+    if checkout_ids:
+        for session in wifi_sessions_col.find(
+                {"checkout_request_id": {"$in": checkout_ids}, "status": {"$ne": "pending_payment"}},
+                {"checkout_request_id": 1, "status": 1, "mpesa_code": 1, "site": 1}):
+            checkout_id = session["checkout_request_id"]
+            status_bus.publish(f"wifi:{checkout_id}", wifi_status_payload(checkout_id, session))
+    order_ids = status_bus.keys("order:")
+    if order_ids:
+        for order in orders_col.find({"order_id": {"$in": order_ids}, "payment.status": {"$in": ["paid", "failed"]}},
+                                     {"order_id": 1, "status": 1, "payment.status": 1}):
+            status_bus.publish(f"order:{order['order_id']}", order_status_payload(order["order_id"], order))
 
-    # --- DEMO AUTO-COMPLETION LOGIC ---
-    # logic for auto-completing payment has been removed.
-    # Status updates only via callback.
 
-    return jsonify({
-        "success": True,
-        "status": status,
-        "code": session.get("mpesa_code"),
-        "router_type": config.ROUTER_TYPE
-    })
+# Every worker runs its own (no lease): each has its own waiting clients
+PeriodicWorker("status-watch", publish_status_changes, config.STATUS_WATCH_INTERVAL).start()
 
 
 @app.route("/wifi/login", methods=["POST"])
@@ -1501,50 +1976,67 @@ def wifi_login():
     """Login with M-Pesa Code or Voucher (MongoDB Verified)."""
     data = request.get_json() or {}
     code = data.get("code", "").strip().upper()
-    mac_address = data.get("mac_address", "00:00:00:00:00:00")
+    mac_address = str(data.get("mac_address") or "00:00:00:00:00:00").strip().upper()  # Stored upper case
+    requested_site = data.get("site")  # Hotspot the portal was opened from
 
     if not code: return jsonify({"success": False, "error": "Code required"}), 400
 
     now = datetime.datetime.now()
 
-    # 1. CHECK VOUCHERS
-    voucher = vouchers_col.find_one({"code": code})
+    # 0. RESOLVE CODE (unknown codes are usually rejected in memory, without a query)
+    entry = access_codes.lookup(code)
+    if not entry:
+        return jsonify({"success": False, "error": "Invalid Code"}), 401
+
+    # 1. CHECK VOUCHERS (not yet activated)
+    voucher = None
+    if entry.get("voucher_id") and not entry.get("session_id"):
+        # Claim atomically so two devices cannot activate the same voucher
+        voucher = vouchers_col.find_one_and_update(
+            {"_id": entry["voucher_id"], "status": {"$ne": "used"}},
+            {"$set": {"status": "used", "used_at": now}}
+        )
     if voucher:
-        if voucher.get("status") == "used":
-            # Re-login allowed if consistent MAC and not expired? 
-            # Simplified: Once used, it becomes a session. Check sessions instead.
-            pass 
-        else:
-             # Activate new voucher
-            duration = voucher.get("duration_hours", 1)
-            expiry = now + datetime.timedelta(hours=duration)
-            
-            # Create Session
-            wifi_sessions_col.insert_one({
-                "session_id": str(uuid.uuid4()),
-                "type": "voucher",
-                "code": code,
-                "mac_address": mac_address,
-                "start_time": now,
-                "expiry_time": expiry,
-                "last_heartbeat": now,
-                "status": "active",
-                "duration_hours": duration
-            })
-            # Mark Used
-            vouchers_col.update_one({"_id": voucher["_id"]}, {"$set": {"status": "used", "used_at": now}})
-            
-            authorize_router_user(code, mac_address, duration)
-            return jsonify({
-                "success": True, 
-                "message": "Voucher Activated", 
-                "router_type": config.ROUTER_TYPE,
-                "expiry": expiry.isoformat()
-            })
+        # Activate new voucher
+        duration = voucher.get("duration_hours", 1)
+        expiry = now + datetime.timedelta(hours=duration)
+        site = fleet.resolve(requested_site)
+        
+        # Create Session
+        session_id = str(uuid.uuid4())
+        inserted = wifi_sessions_col.insert_one({
+            "session_id": session_id,
+            "type": "voucher",
+            "code": code,
+            "created_at": now,
+            "mac_address": mac_address,
+            "site": site,
+            "start_time": now,
+            "expiry_time": expiry,
+            "last_heartbeat": now,
+            "status": "active",
+            "duration_hours": duration
+        })
+        access_codes.attach_session(code, session_id)
+        session_expiry.schedule(inserted.inserted_id, expiry)
+        wifi_counters.add(active_users=1)
+        
+        provisioning = provisioning_queue.enqueue(code, mac_address, duration, router=site,
+                                                  profile=wifi_plans.profile_for(None))
+        return jsonify({
+            "success": True, 
+            "message": "Voucher Activated", 
+            "router_type": fleet.router_type(site),
+            "expiry": expiry.isoformat(),
+            "provisioning": provisioning
+        })
 
     # 2. CHECK SESSIONS (M-Pesa or Used Voucher)
-    # Search by mpesa_code OR voucher code
-    session = wifi_sessions_col.find_one({"$or": [{"mpesa_code": code}, {"code": code}]})
+    if entry.get("session_id"):
+        session = wifi_sessions_col.find_one({"session_id": entry["session_id"]})
+    else:
+        # Used voucher whose session predates access_codes
+        session = wifi_sessions_col.find_one({"$or": [{"mpesa_code": code}, {"code": code}]})
     
     if not session:
          return jsonify({"success": False, "error": "Invalid Code"}), 401
@@ -1552,29 +2044,43 @@ def wifi_login():
     if session.get("status") == "pending_payment":
         return jsonify({"success": False, "error": "Payment not completed"}), 401
 
+    # Access follows the customer to the site they are logging in from
+    site = fleet.resolve(requested_site or session.get("site"))
+
     # If first time login for M-Pesa
     if session.get("status") == "paid":
-        plan_id = session.get("plan_id")
-        plan = WIFI_PLANS.get(plan_id)
-        duration = plan["duration"] if plan else 1
+        duration = session.get("duration_hours")
+        if duration is None:
+            # Bought before sessions recorded their duration
+            plan = wifi_plans.get(session.get("plan_id"), active_only=False)
+            duration = plan["duration"] if plan else 1
         expiry = now + datetime.timedelta(hours=duration)
 
-        wifi_sessions_col.update_one({"_id": session["_id"]}, {
+        activated = wifi_sessions_col.update_one({"_id": session["_id"], "status": "paid"}, {
             "$set": {
                 "status": "active",
                 "start_time": now,
                 "expiry_time": expiry,
                 "last_heartbeat": now,
-                "mac_address": mac_address
+                "mac_address": mac_address,
+                "site": site
             }
         })
-        authorize_router_user(code, mac_address, duration)
-        return jsonify({
-            "success": True, 
-            "message": "Login Successful", 
-            "router_type": config.ROUTER_TYPE,
-            "expiry": expiry.isoformat()
-        })
+        if activated.modified_count:
+            session_expiry.schedule(session["_id"], expiry)
+            wifi_counters.add(active_users=1)
+            provisioning = provisioning_queue.enqueue(code, mac_address, duration, router=site,
+                                                      profile=wifi_plans.profile_for(session.get("plan_id")))
+            return jsonify({
+                "success": True, 
+                "message": "Login Successful", 
+                "router_type": fleet.router_type(site),
+                "expiry": expiry.isoformat(),
+                "provisioning": provisioning
+            })
+
+        # A concurrent login activated it first: continue as a re-login of that session
+        session = wifi_sessions_col.find_one({"_id": session["_id"]}) or {}
 
     # If already active (Re-login/Reconnect)
     if session.get("status") == "active":
@@ -1586,31 +2092,172 @@ def wifi_login():
         remaining_hours = remaining_seconds / 3600
         
         # update heartbeat
-        wifi_sessions_col.update_one({"_id": session["_id"]}, {"$set": {"last_heartbeat": now, "mac_address": mac_address}})
+        wifi_sessions_col.update_one({"_id": session["_id"]}, {"$set": {"last_heartbeat": now, "mac_address": mac_address, "site": site}})
         
-        authorize_router_user(code, mac_address, remaining_hours)
+        # Only the time left goes to the router as limit-uptime (backstop; session_expiry ends the session)
+        provisioning = provisioning_queue.enqueue(code, mac_address, remaining_hours, router=site,
+                                                  profile=wifi_plans.profile_for(session.get("plan_id")))
         return jsonify({
             "success": True, 
             "message": "Welcome Back", 
-            "router_type": config.ROUTER_TYPE,
-            "expiry": session["expiry_time"].isoformat()
+            "router_type": fleet.router_type(site),
+            "expiry": session["expiry_time"].isoformat(),
+            "provisioning": provisioning
         })
 
     return jsonify({"success": False, "error": "Unknown Error"}), 500
 
 
+@app.route("/wifi/provisioning/<code>", methods=["GET"])
+def wifi_provisioning_status(code):
+    """Poll until the router has the user (done) before submitting the hotspot login."""
+    job = provisioning_queue.status(code.strip().upper())
+    if not job:
+        return jsonify({"success": False, "error": "No provisioning job for this code"}), 404
+
+    # Public: router errors stay on /admin/wifi/provisioning
+    return jsonify({
+        "success": True,
+        "status": job["status"],  # queued | running | done | failed
+        "attempts": job.get("attempts", 0),
+        "router_type": fleet.router_type(job.get("router"))
+    })
+
+
+@app.route("/admin/wifi/provisioning", methods=["GET"])
+def get_provisioning_metrics():
+    """Provisioning queue counters and the latest failed jobs with their router errors."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    failed = list(provisioning_jobs_col.find(
+        {"status": "failed"},
+        {"_id": 0, "code": 1, "mac_address": 1, "router": 1, "attempts": 1, "error": 1, "updated_at": 1}
+    ).sort("updated_at", -1).limit(50))
+    return jsonify({"success": True, "metrics": provisioning_queue.metrics(), "failed": failed})
+
+
+# Heartbeats are the most frequent write: keep only the latest per code and
+# flush them together every few seconds (and at shutdown)
+heartbeat_writer = BulkWriter("wifi-heartbeat", interval=config.HEARTBEAT_FLUSH_INTERVAL, max_ops=1000)
+
+
 @app.route("/wifi/heartbeat", methods=["POST"])
 def wifi_heartbeat():
     data = request.get_json() or {}
-    code = data.get("code")
+    code = str(data.get("code") or "").strip().upper()  # Stored upper-case, as /wifi/login does
     if code:
-        wifi_sessions_col.update_one(
+        heartbeat_writer.add(wifi_sessions_col, code, UpdateOne(
             {"$or": [{"mpesa_code": code}, {"code": code}]},
             {"$set": {"last_heartbeat": datetime.datetime.now()}}
-        )
+        ))
     return jsonify({"success": True})
 
 
+@app.route("/admin/wifi/reconcile", methods=["GET", "POST"])
+def reconcile_hotspot_users():
+    """
+    GET: drift metrics and the last reconciliation result per site.
+    POST: reconcile now; {"dry_run": true} only reports the drift,
+    {"site": "..."} limits the pass to one site (Super Admin Only).
+    """
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    if request.method == "GET":
+        return jsonify({"success": True, "sites": {
+            site: {"totals": r.stats, "last_result": r.last_result} for site, r in hotspot_reconcilers.items()
+        }})
+
+    if not hotspot_reconcilers:
+        return jsonify({"success": False, "error": "Hotspot reconciliation requires a MikroTik router"}), 400
+
+    data = request.get_json(silent=True) or {}
+    dry_run = bool(data.get("dry_run")) or request.args.get("dry_run") == "1"
+    site = data.get("site") or request.args.get("site")
+    if site and site not in hotspot_reconcilers:
+        return jsonify({"success": False, "error": "Unknown MikroTik site"}), 404
+
+    results = reconcile_fleet(dry_run=dry_run, sites=[site] if site else None)
+    return jsonify({"success": True, "sites": results})
+
+
+@app.route("/admin/wifi/revoke", methods=["POST"])
+def bulk_revoke_wifi_sessions():
+    """
+    Revoke many sessions at once (Super Admin Only).
+    Body: {"codes": [...]} and/or {"site": "..."} to revoke every active session at a site.
+    Sessions are marked revoked in one update; router removals run per site in parallel.
+    """
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    data = request.get_json() or {}
+    codes = [c.strip().upper() for c in data.get("codes", []) if c]
+    query = {"status": {"$in": ["active", "paid"]}}
+    if codes:
+        query["$or"] = [{"code": {"$in": codes}}, {"mpesa_code": {"$in": codes}}]
+    if data.get("site"):
+        query["site"] = data["site"]
+    if len(query) == 1:
+        return jsonify({"success": False, "error": "Provide codes or a site"}), 400
+
+    sessions = list(wifi_sessions_col.find(query, {"code": 1, "mpesa_code": 1, "site": 1, "status": 1}))
+    if not sessions:
+        return jsonify({"success": True, "revoked": 0, "sites": {}})
+
+    revoke = {"$set": {"status": "revoked", "revoked_at": datetime.datetime.now(), "revoked_by": admin.get("username")}}
+    # Status-guarded so a session the expiry scheduler takes first is not counted down twice
+    for status in ("active", "paid"):
+        ids = [s["_id"] for s in sessions if s["status"] == status]
+        if ids:
+            result = wifi_sessions_col.update_many({"_id": {"$in": ids}, "status": status}, revoke)
+            if status == "active":
+                wifi_counters.add(active_users=-result.modified_count)
+
+    by_site = {}
+    for session in sessions:
+        by_site.setdefault(fleet.resolve(session.get("site")), []).append(session.get("mpesa_code") or session.get("code"))
+
+    def revoke_site(router):
+        if router.type != 'mikrotik':
+            return {"removed": 0, "note": "TP-Link authorizations lapse on the controller"}
+        return {"removed": router.bridge.remove_hotspot_users_by_name(by_site[router.site])}
+
+    results = fleet.fan_out(revoke_site, sites=list(by_site))
+    return jsonify({"success": True, "revoked": len(sessions), "sites": results})
+
+
+@app.route("/admin/wifi/fleet", methods=["GET"])
+def get_fleet_status():
+    """Per-site router counters (queried in parallel) next to active sessions from the database."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    pipeline = [
+        {"$match": {"status": "active", "expiry_time": {"$gt": datetime.datetime.now()}}},
+        {"$group": {"_id": "$site", "count": {"$sum": 1}}}
+    ]
+    active_by_site = {}
+    for row in wifi_sessions_col.aggregate(pipeline):
+        site = fleet.resolve(row["_id"])
+        active_by_site[site] = active_by_site.get(site, 0) + row["count"]
+
+    def router_stats(router):
+        return router.bridge.hotspot_stats() if router.type == 'mikrotik' else None
+
+    routers = fleet.fan_out(router_stats)
+    sites = {
+        site: {"type": fleet.router_type(site), "active_sessions": active_by_site.get(site, 0), "router": routers.get(site)}
+        for site in fleet.sites()
+    }
+    return jsonify({"success": True, "default_site": fleet.default_site, "sites": sites, "fleet": fleet.metrics()})
+
+
 @app.route("/wifi/claim-compensation", methods=["POST"])
 def claim_compensation():
     """Check for downtime and issue voucher if needed."""
@@ -1625,15 +2272,10 @@ def get_wifi_stats():
     if not admin or admin.get("role") not in ["admin", "super_admin"]:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
 
-    active_count = wifi_sessions_col.count_documents({"status": "active", "expiry_time": {"$gt": datetime.datetime.now()}})
-    
-    # Revenue aggregation
-    pipeline = [
-        {"$match": {"status": {"$in": ["active", "expired", "paid"]}}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
-    res = list(wifi_sessions_col.aggregate(pipeline))
-    revenue = res[0]["total"] if res else 0
+    # One document read; the totals are maintained as sessions change state
+    counters = wifi_counters.read() or wifi_counters.rebuild(wifi_sessions_col, wifi_daily_col)
+    active_count = max(counters.get("active_users", 0), 0)
+    revenue = counters.get("total_revenue", 0)
 
     # Privacy: Hide revenue from regular admins
     if admin.get("role") != "super_admin":
@@ -1642,13 +2284,194 @@ def get_wifi_stats():
     return jsonify({"success": True, "active_users": active_count, "total_revenue": revenue})
 
 
+@app.route("/admin/wifi/plans", methods=["GET"])
+def admin_list_wifi_plans():
+    """Every plan, including retired ones."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    return jsonify({"success": True, "plans": wifi_plans.list_all(), "version": wifi_plans.version})
+
+
+@app.route("/admin/wifi/plans", methods=["POST"])
+def admin_create_wifi_plan():
+    """Body: {"plan_id": "30m", "name": "30 Minutes Access", "duration": 0.5, "price": 10}"""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    data = request.get_json() or {}
+    plan_id = str(data.get("plan_id", "")).strip().lower()
+    if not PLAN_ID.match(plan_id):
+        return jsonify({"success": False, "error": "plan_id must be 1-20 of a-z, 0-9, - or _"}), 400
+    plan, error = validate_plan(data)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    if not wifi_plans.create(plan_id, plan):
+        return jsonify({"success": False, "error": "Plan already exists"}), 409
+    return jsonify({"success": True, "plan_id": plan_id, "version": wifi_plans.version})
+
+
+@app.route("/admin/wifi/plans/<plan_id>", methods=["PUT"])
+def admin_update_wifi_plan(plan_id):
+    """
+    Change any of name, duration, price, rate_limit, profile, active.
+    Sessions already bought keep their duration; a new rate_limit reaches the
+    routers on the next reconcile or /admin/wifi/plans/sync-profiles.
+    """
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    fields, error = validate_plan(request.get_json() or {}, partial=True)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+    if not fields:
+        return jsonify({"success": False, "error": "Nothing to update"}), 400
+
+    if not wifi_plans.update(plan_id, fields):
+        return jsonify({"success": False, "error": "Plan not found"}), 404
+    return jsonify({"success": True, "version": wifi_plans.version})
+
+
+@app.route("/admin/wifi/plans/<plan_id>", methods=["DELETE"])
+def admin_delete_wifi_plan(plan_id):
+    """Take a plan off sale. It is kept (inactive) so older sessions still resolve."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    if not wifi_plans.update(plan_id, {"active": False}):
+        return jsonify({"success": False, "error": "Plan not found"}), 404
+    return jsonify({"success": True, "version": wifi_plans.version})
+
+
+@app.route("/admin/wifi/plans/sync-profiles", methods=["POST"])
+def admin_sync_hotspot_profiles():
+    """Push the per-plan hotspot user profiles (rate limits) to every MikroTik now."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    sites = fleet.sites('mikrotik')
+    if not sites:
+        return jsonify({"success": False, "error": "Hotspot profiles require a MikroTik router"}), 400
+    return jsonify({"success": True, "profiles": wifi_plans.hotspot_profiles(),
+                    "sites": fleet.fan_out(sync_hotspot_profiles, sites=sites)})
+
+
+@app.route("/admin/wifi/daily", methods=["GET"])
+def get_wifi_daily():
+    """Per-day totals (sessions, revenue, plan mix) of finished sessions that were rolled up."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    days = wifi_rollup.days(min(int(request.args.get("days", 30)), 366))
+    if admin.get("role") != "super_admin":
+        for day in days:
+            day.pop("revenue", None)  # Same privacy rule as /admin/wifi-stats
+    return jsonify({"success": True, "data": days})
+
+
+@app.route("/admin/wifi-stats/rebuild", methods=["POST"])
+def rebuild_wifi_stats():
+    """Recount the Wi-Fi totals from wifi_sessions (also runs every WIFI_COUNTERS_REBUILD_INTERVAL)."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") != "super_admin":
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    before = wifi_counters.read() or {}
+    after = wifi_counters.rebuild(wifi_sessions_col, wifi_daily_col)
+    drift = {k: after[k] - before.get(k, 0) for k in ("active_users", "total_revenue", "paid_sessions")}
+    return jsonify({"success": True, "counters": after, "drift": drift})
+
+
 @app.route("/admin/wifi-sessions", methods=["GET"])
 def get_wifi_sessions():
+    """
+    Browse Wi-Fi sessions, newest first, with cursor pagination on _id.
+    ?status=active|paid|pending_payment|expired|revoked|failed  ?type=mpesa|voucher  ?plan=1h
+    ?active_now=1  ?site=...  ?search=<phone, code or MAC prefix>  ?search_by=phone|code|mac
+    ?limit=50  ?cursor=<next_cursor>
+    Every filter is served by a (field, _id) index, so a page costs `limit` index entries
+    however many sessions exist. A search is different: each searched field's (field, _id)
+    index is range-scanned for the prefix and the matches sorted by _id in memory, so it
+    costs as many entries as the prefix matches. search_by limits it to one field.
+    """
     admin = get_authenticated_user()
     if not admin: return jsonify({"success": False}), 403
-    
-    sessions = list(wifi_sessions_col.find().sort("created_at", -1).limit(50))
-    return jsonify({"success": True, "data": json_serializer(sessions)})
+
+    limit = min(max(request.args.get("limit", default=50, type=int), 1), 200)
+    query = {}
+    for param, field in (("status", "status"), ("type", "type"), ("plan", "plan_id"), ("site", "site")):
+        if request.args.get(param):
+            query[field] = request.args[param]
+    if request.args.get("active_now") in ("1", "true"):
+        query["status"] = "active"
+        query["expiry_time"] = {"$gt": datetime.datetime.now()}
+
+    search = request.args.get("search", "").strip()
+    if search:
+        prefix = "^" + re.escape(search)
+        # Anchored prefixes are index range scans; codes and MACs are stored upper case
+        fields = {
+            "phone": [{"phone": {"$regex": prefix}}],
+            "code": [{"mpesa_code": {"$regex": prefix.upper()}}, {"code": {"$regex": prefix.upper()}}],
+            "mac": [{"mac_address": {"$regex": prefix.upper()}}]
+        }
+        search_by = request.args.get("search_by")
+        if search_by and search_by not in fields:
+            return jsonify({"success": False, "error": "search_by must be phone, code or mac"}), 400
+        clauses = fields[search_by] if search_by else [c for group in fields.values() for c in group]
+        query["$or"] = clauses
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        if not ObjectId.is_valid(cursor):
+            return jsonify({"success": False, "error": "Invalid cursor"}), 400
+        query["_id"] = {"$lt": ObjectId(cursor)}
+
+    sessions = list(wifi_sessions_col.find(query).sort("_id", -1).limit(limit + 1))
+    has_more = len(sessions) > limit
+    sessions = sessions[:limit]
+    next_cursor = str(sessions[-1]["_id"]) if has_more else None
+
+    # Throughput from the telemetry poller's last snapshot; the routers are not queried here
+    usage = hotspot_telemetry.current_usage(max_age=config.TELEMETRY_INTERVAL * 3)
+    for s in sessions:
+        live = usage.get(s.get("mpesa_code") or s.get("code"))
+        if live:
+            s["usage"] = {k: live[k] for k in ("rate_in", "rate_out", "bytes_in", "bytes_out", "uptime", "at")}
+    return jsonify({"success": True, "data": sessions, "next_cursor": next_cursor})
+
+
+@app.route("/admin/wifi/usage", methods=["GET"])
+def get_wifi_usage():
+    """
+    Hotspot usage from stored telemetry.
+    ?hours=24 - per-site throughput samples for the last N hours
+    ?code=XYZ - that user's hourly bytes and peak rates
+    """
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    hours = max(1, min(request.args.get("hours", default=24, type=int), 24 * 7))
+    since = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=hours - 1)
+    live = list(hotspot_usage_live_col.find({}, {"users": 0}))
+    samples = {}
+    for bucket in hotspot_usage_samples_col.find({"hour": {"$gte": since}}).sort("hour", 1):
+        samples.setdefault(bucket["site"], []).extend(bucket["samples"])
+
+    result = {"live": live, "samples": samples}
+    code = request.args.get("code")
+    if code:
+        result["hourly"] = list(hotspot_usage_hourly_col.find({"code": code.strip().upper(), "hour": {"$gte": since}},
+                                                              {"_id": 0}).sort("hour", 1))
+    return jsonify({"success": True, "data": result})
 
 
 @app.route("/admin/wifi-sessions/<id>", methods=["DELETE"])
@@ -1657,7 +2480,9 @@ def delete_wifi_session(id):
     if not admin or admin.get("role") != "super_admin":
         return jsonify({"success": False, "error": "Unauthorized"}), 403
     
-    wifi_sessions_col.delete_one({"_id": ObjectId(id)})
+    deleted = wifi_sessions_col.find_one_and_delete({"_id": ObjectId(id)}, projection={"status": 1})
+    if deleted and deleted.get("status") == "active":
+        wifi_counters.add(active_users=-1)
     return jsonify({"success": True, "message": "Deleted"})
 
 
@@ -1670,16 +2495,97 @@ def admin_generate_voucher():
     hours = int(data.get("hours", 1))
     code = "VOU-" + str(uuid.uuid4())[:8].upper()
     
-    vouchers_col.insert_one({
+    inserted = vouchers_col.insert_one({
         "code": code,
         "duration_hours": hours,
         "status": "active",
         "created_at": datetime.datetime.now(),
         "created_by": admin.get("username")
     })
+    access_codes.register(code, "voucher", voucher_id=inserted.inserted_id)
     return jsonify({"success": True, "code": code})
 
 
+@app.route("/admin/vouchers/batches", methods=["POST"])
+def create_voucher_batch():
+    """
+    Generate a sheet of vouchers in one go.
+    Body: {"count": 500, "hours": 1, "label": "Reseller X", "site": "...", "provision": true}
+    With provision, every code is pushed to the site's MikroTik in one pipelined call.
+    """
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    data = request.get_json() or {}
+    try:
+        count = int(data.get("count", 0))
+        hours = int(data.get("hours", 1))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "count and hours must be numbers"}), 400
+    if not 1 <= count <= config.VOUCHER_BATCH_MAX or hours < 1:
+        return jsonify({"success": False, "error": f"count must be 1-{config.VOUCHER_BATCH_MAX} and hours >= 1"}), 400
+
+    site = fleet.resolve(data.get("site"))
+    batch, vouchers = create_batch(vouchers_col, access_codes, count, hours, admin.get("username"),
+                                   label=data.get("label"), site=site)
+
+    if data.get("provision"):
+        router = fleet.get(site)
+        if router.type != 'mikrotik':
+            batch["provisioned"] = {"site": site, "error": "TP-Link authorizes by MAC at login; nothing to pre-provision"}
+        else:
+            profile = wifi_plans.profile_for(None)
+            users = [{"name": v["code"], "password": v["code"], "profile": profile,
+                      "limit_uptime": uptime_limit(hours * 3600)} for v in vouchers]
+            try:
+                failed = router.bridge.add_hotspot_users(users)
+                failed_codes = {name for name, _ in failed}
+                vouchers_col.update_many(
+                    {"batch_id": batch["batch_id"], "code": {"$nin": list(failed_codes)}},
+                    {"$set": {"provisioned_site": site}}
+                )
+                batch["provisioned"] = {"site": site, "pushed": len(users) - len(failed), "failed": len(failed),
+                                        "at": datetime.datetime.now()}
+            except Exception as e:
+                batch["provisioned"] = {"site": site, "error": f"Router unreachable: {e}"}
+
+    voucher_batches_col.insert_one(batch)
+    batch.pop("_id", None)
+    export = f"/admin/vouchers/batches/{batch['batch_id']}/export"
+    return jsonify({"success": True, "batch": batch,
+                    "export": {"csv": f"{export}?format=csv", "sheet": f"{export}?format=sheet"}})
+
+
+@app.route("/admin/vouchers/batches", methods=["GET"])
+def list_voucher_batches():
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    batches = list(voucher_batches_col.find({}, {"_id": 0}).sort("created_at", -1).limit(50))
+    return jsonify({"success": True, "data": batches})
+
+
+@app.route("/admin/vouchers/batches/<batch_id>/export", methods=["GET"])
+def export_voucher_batch(batch_id):
+    """Stream a batch as CSV (?format=csv) or a printable sheet (?format=sheet)."""
+    admin = get_authenticated_user()
+    if not admin or admin.get("role") not in ["admin", "super_admin"]:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+
+    batch = voucher_batches_col.find_one({"batch_id": batch_id})
+    if not batch:
+        return jsonify({"success": False, "error": "Batch not found"}), 404
+
+    cursor = vouchers_col.find({"batch_id": batch_id}, {"_id": 0, "code": 1, "duration_hours": 1, "status": 1,
+                                                        "batch_id": 1, "created_at": 1}).sort("code", 1).batch_size(500)
+    if request.args.get("format") == "sheet":
+        return Response(stream_sheet(batch, cursor), mimetype="text/html")
+    return Response(stream_csv(cursor), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename=vouchers-{batch_id}.csv"})
+
+
 # ================= DASHBOARD STATS =================
 @app.route("/admin/stats/charts", methods=["GET"])
 def get_admin_charts_data():
@@ -1,39 +1,204 @@
 import routeros_api
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from routeros_api.exceptions import RouterOsApiConnectionError, RouterOsApiFatalCommunicationError
 from config import config
 
-class MikrotikBridge:
-    def __init__(self):
-        self.host = config.MIKROTIK_HOST
-        self.username = config.MIKROTIK_USER
-        self.password = config.MIKROTIK_PASS
-        self.port = config.MIKROTIK_PORT
-        self.connection = None
-
-    def connect(self):
+# Marks hotspot users created by this backend (reconciliation never touches other users)
+MANAGED_COMMENT = "tinditech"
+
+# Hotspot user profiles this backend creates are named "<prefix>-<plan>"
+PROFILE_PREFIX = "tinditech"
+
+
+def uptime_limit(seconds):
+    """Seconds -> RouterOS duration ("1d2h30m"); at least one minute."""
+    seconds = max(60, int(seconds))
+    parts = []
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60), ("s", 1)):
+        if seconds >= size:
+            parts.append(f"{seconds // size}{unit}")
+            seconds %= size
+    return "".join(parts)
+
+
+# Errors that mean the connection itself is gone (router rebooted, link dropped, timeout)
+CONNECTION_ERRORS = (RouterOsApiConnectionError, RouterOsApiFatalCommunicationError, OSError)
+
+
+class RouterOsConnectionPool:
+    """
+    Bounded, thread-safe pool of logged-in RouterOS API connections.
+    Connections stay open between calls (no TCP connect + login per operation),
+    idle ones are pinged to keep them alive, and dead ones are replaced transparently.
+    """
+
+    def __init__(self, host, username, password, port, max_size=4, timeout=10, keepalive=60):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.max_size = max_size
+        self.timeout = timeout      # Per-operation socket timeout (seconds)
+        self.keepalive = keepalive  # Ping connections idle longer than this
+        self._idle = deque()        # (RouterOsApiPool, last_used)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._keepalive_thread = None
+        self._closed = False
+        self.stats = {"opened": 0, "reused": 0, "reconnects": 0, "errors": 0}
+
+    def _open(self):
+        conn = routeros_api.RouterOsApiPool(
+            self.host,
+            username=self.username,
+            password=self.password,
+            port=self.port,
+            plaintext_login=True
+        )
+        conn.socket_timeout = self.timeout
+        conn.get_api()  # TCP connect + login
+        self.stats["opened"] += 1
+        self._ensure_keepalive()
+        return conn
+
+    @staticmethod
+    def _discard(conn):
         try:
-            self.connection = routeros_api.RouterOsApiPool(
-                self.host, 
-                username=self.username, 
-                password=self.password,
-                port=self.port,
-                plaintext_login=True 
-            )
-            return self.connection.get_api()
-        except Exception as e:
-            if config.DEBUG: print(f"[MIKROTIK] Connection Failed: {e}")
-            return None
+            conn.disconnect()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _ping(conn):
+        conn.get_api().get_resource('/system/identity').get()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection; yields the RouterOS api object."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free RouterOS connection to {self.host} within {self.timeout}s")
+
+        conn = None
+        try:
+            with self._lock:
+                if self._idle:
+                    conn, _ = self._idle.pop()  # Most recently used = most likely alive
+            if conn is not None and conn.connected:
+                self.stats["reused"] += 1
+            else:
+                conn = self._open()
+
+            conn.set_timeout(timeout or self.timeout)
+            try:
+                yield conn.get_api()
+            except CONNECTION_ERRORS:
+                self.stats["errors"] += 1
+                self._discard(conn)
+                conn = None
+                raise
+        finally:
+            if conn is not None:
+                if conn.connected and not self._closed:
+                    with self._lock:
+                        self._idle.append((conn, time.time()))
+                else:
+                    self._discard(conn)
+            self._slots.release()
+
+    def run(self, operation, timeout=None):
+        """
+        Run operation(api). A dead pooled connection (e.g. after a router reboot)
+        is replaced and the operation retried once on a fresh connection.
+        """
+        try:
+            with self.connection(timeout) as api:
+                return operation(api)
+        except CONNECTION_ERRORS as e:
+            if config.DEBUG: print(f"[MIKROTIK] Connection to {self.host} lost ({e}), reconnecting")
+            self.stats["reconnects"] += 1
+            self._drop_idle()
+            with self.connection(timeout) as api:
+                return operation(api)
+
+    def _drop_idle(self):
+        """After a failure assume every idle connection to this router is stale too."""
+        with self._lock:
+            stale = list(self._idle)
+            self._idle.clear()
+        for conn, _ in stale:
+            self._discard(conn)
+
+    def _ensure_keepalive(self):
+        if self._keepalive_thread and self._keepalive_thread.is_alive():
+            return
+        self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name=f"routeros-keepalive-{self.host}", daemon=True)
+        self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while not self._closed:
+            time.sleep(self.keepalive / 2)
+            now = time.time()
+            with self._lock:
+                due = [item for item in self._idle if now - item[1] >= self.keepalive]
+
+            for item in due:
+                # A connection being pinged counts as checked out, so connection() cannot
+                # open another one in its place and push the pool over max_size
+                if not self._slots.acquire(blocking=False):
+                    break  # Pool busy: its connections are in use anyway
+                try:
+                    with self._lock:
+                        if item not in self._idle:
+                            continue  # Checked out (or dropped) meanwhile
+                        self._idle.remove(item)
+                    conn = item[0]
+                    try:
+                        conn.set_timeout(self.timeout)
+                        self._ping(conn)
+                        with self._lock:
+                            self._idle.appendleft((conn, time.time()))
+                    except Exception:
+                        self._discard(conn)
+                finally:
+                    self._slots.release()
+
+    def close(self):
+        self._closed = True
+        self._drop_idle()
+
+    def metrics(self):
+        with self._lock:
+            idle = len(self._idle)
+        return dict(self.stats, idle=idle, max_size=self.max_size)
+
+
+class MikrotikBridge:
+    def __init__(self, host=None, username=None, password=None, port=None):
+        self.host = host or config.MIKROTIK_HOST
+        self.username = username or config.MIKROTIK_USER
+        self.password = password if password is not None else config.MIKROTIK_PASS
+        self.port = int(port or config.MIKROTIK_PORT)
+        self.pool = RouterOsConnectionPool(
+            self.host, self.username, self.password, self.port,
+            max_size=config.MIKROTIK_POOL_SIZE,
+            timeout=config.MIKROTIK_TIMEOUT,
+            keepalive=config.MIKROTIK_KEEPALIVE
+        )
 
     def add_hotspot_user(self, username, password, profile="default", limit_uptime=None):
         """
         Add a user to MikroTik Hotspot.
-        limit_uptime: String "1h", "30m", etc. or None
+        limit_uptime: String "1h", "30m", etc. or None. The router logs the
+        user out once their connected time reaches it. Time disconnected does
+        not count, so this is only a backstop: SessionExpiryScheduler removes
+        the user at the session's expiry_time.
         """
-        api = self.connect()
-        if not api: return False, "Connection failed"
-
-        try:
+        def _add(api):
             hotspot_users = api.get_resource('/ip/hotspot/user')
-            
+
             # Check if exists
             existing = hotspot_users.get(name=username)
             if existing:
@@ -41,39 +206,127 @@ class MikrotikBridge:
                 params = {}
                 if limit_uptime: params['limit-uptime'] = limit_uptime
                 if profile: params['profile'] = profile
-                
+
                 hotspot_users.set(id=existing[0]['id'], **params)
+                if limit_uptime:
+                    # The new limit is the time remaining, so the uptime already used starts again from zero
+                    hotspot_users.call('reset-counters', {'numbers': existing[0]['id']})
                 if config.DEBUG: print(f"[MIKROTIK] Updated user {username}")
             else:
                 # Create New
                 params = {
                     'name': username,
                     'password': password,
-                    'profile': profile
+                    'profile': profile,
+                    'comment': MANAGED_COMMENT
                 }
                 if limit_uptime: params['limit-uptime'] = limit_uptime
-                
+
                 hotspot_users.add(**params)
                 if config.DEBUG: print(f"[MIKROTIK] Created user {username}")
-                
+
+        try:
+            self.pool.run(_add)
             return True, "User authorized on Router"
-            
         except Exception as e:
             if config.DEBUG: print(f"[MIKROTIK] Error adding user: {e}")
             return False, str(e)
-        finally:
-            if self.connection: self.connection.disconnect()
 
     def remove_user(self, username):
-        api = self.connect()
-        if not api: return
+        """Remove a hotspot user by name. A user that is already gone counts as removed."""
+        def _remove(api):
+            hotspot_users = api.get_resource('/ip/hotspot/user')
+            for user in hotspot_users.get(name=username):
+                hotspot_users.remove(id=user['id'])
+
         try:
-            list_users = api.get_resource('/ip/hotspot/user')
-            list_users.remove(name=username)
-        except:
-            pass
-        finally:
-            if self.connection: self.connection.disconnect()
+            self.pool.run(_remove)
+            return True, "User removed from Router"
+        except Exception as e:
+            if config.DEBUG: print(f"[MIKROTIK] Error removing user {username}: {e}")
+            return False, str(e)
+
+    def list_hotspot_users(self):
+        """Every /ip/hotspot/user entry in one API call."""
+        return self.pool.run(lambda api: list(api.get_resource('/ip/hotspot/user').get()))
+
+    def add_hotspot_users(self, users, profile="default"):
+        """
+        Create many hotspot users on one connection. The adds are pipelined:
+        all commands are sent before the first reply is read.
+        users: list of {"name", "password", optional "limit_uptime"}
+        """
+        def _add_all(api):
+            hotspot_users = api.get_resource('/ip/hotspot/user')
+            pending = []
+            for user in users:
+                params = {'name': user['name'], 'password': user['password'],
+                          'profile': user.get('profile') or profile, 'comment': MANAGED_COMMENT}
+                if user.get('limit_uptime'): params['limit-uptime'] = user['limit_uptime']
+                pending.append(hotspot_users.add_async(**params))
+
+            failed = []
+            for user, promise in zip(users, pending):
+                try:
+                    promise.get()
+                except CONNECTION_ERRORS:
+                    raise
+                except Exception as e:
+                    failed.append((user['name'], str(e)))
+            return failed
+
+        return self.pool.run(_add_all)
+
+    def remove_hotspot_users(self, ids):
+        """Remove hotspot users by .id in a single command (RouterOS accepts a comma-separated list)."""
+        if not ids:
+            return
+        self.pool.run(lambda api: api.get_resource('/ip/hotspot/user').remove(id=",".join(ids)))
+
+    def remove_hotspot_users_by_name(self, names):
+        """Bulk revocation: one listing plus one remove call. Returns how many users were removed."""
+        wanted = set(names)
+        ids = [user['id'] for user in self.list_hotspot_users() if user.get('name') in wanted]
+        self.remove_hotspot_users(ids)
+        return len(ids)
+
+    def ensure_hotspot_profiles(self, profiles):
+        """
+        Make the router's hotspot user profiles match `profiles`
+        ({name: {"rate_limit": "2M/5M" or None, "shared_users": 1}}) in one
+        listing plus one command per profile that is missing or different.
+        Returns {"added": n, "updated": n}.
+        """
+        def _sync(api):
+            resource = api.get_resource('/ip/hotspot/user/profile')
+            existing = {p.get('name'): p for p in resource.get()}
+            result = {"added": 0, "updated": 0}
+            for name, spec in profiles.items():
+                wanted = {'rate-limit': spec.get('rate_limit') or '',
+                          'shared-users': str(spec.get('shared_users') or 1)}
+                current = existing.get(name)
+                if current is None:
+                    resource.add(name=name, **{k: v for k, v in wanted.items() if v})
+                    result["added"] += 1
+                elif any((current.get(k) or '') != v for k, v in wanted.items()):
+                    resource.set(id=current['id'], **wanted)
+                    result["updated"] += 1
+            return result
+
+        return self.pool.run(_sync)
+
+    def list_hotspot_active(self):
+        """Every connected hotspot host (/ip/hotspot/active, with byte counters and uptime) in one API call."""
+        return self.pool.run(lambda api: list(api.get_resource('/ip/hotspot/active').get()))
+
+    def hotspot_stats(self):
+        """Configured users and currently connected hosts, counted on the router."""
+        def _stats(api):
+            return {
+                "users": len(api.get_resource('/ip/hotspot/user').get()),
+                "active": len(api.get_resource('/ip/hotspot/active').get())
+            }
+        return self.pool.run(_stats)
 
 # Singleton
 mikrotik = MikrotikBridge()
@@ -1,11 +1,317 @@
 import base64
+import os
 import requests
+import threading
 import time
-from datetime import datetime, timedelta
+import uuid
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from config import config
 
-# Token cache to avoid regenerating on every request
-_token_cache = {"token": None, "expires_at": None}
+# Worker-local mirror of the shared token (epoch seconds) so hot paths do no I/O
+_token_cache = {"token": None, "expires_at": None, "refresh_at": None}
+
+TOKEN_REFRESH_MARGIN = 300  # Refresh 5 minutes before Daraja expires the token
+TOKEN_LEASE_SECONDS = 15    # Max time one refresher may hold the refresh lease
+
+
+class LocalTokenStore:
+    """In-process token store (scripts, single worker). Same interface as MongoTokenStore."""
+
+    def __init__(self):
+        self._doc = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            return dict(self._doc) if self._doc.get("token") else None
+
+    def try_lease(self, owner, seconds):
+        now = time.time()
+        with self._lock:
+            if self._doc.get("lease_until") and self._doc["lease_until"] > now:
+                return False
+            self._doc.update(lease_owner=owner, lease_until=now + seconds)
+            return True
+
+    def save(self, owner, token, expires_at, refresh_at):
+        with self._lock:
+            self._doc.update(token=token, expires_at=expires_at, refresh_at=refresh_at,
+                             lease_owner=None, lease_until=None)
+
+    def release(self, owner):
+        with self._lock:
+            if self._doc.get("lease_owner") == owner:
+                self._doc.update(lease_owner=None, lease_until=None)
+
+
+class MongoTokenStore:
+    """
+    Token shared by every worker through one MongoDB document.
+    A lease on the document makes sure only one worker in the deployment
+    calls the OAuth endpoint per validity window.
+    """
+
+    def __init__(self, collection, key="daraja"):
+        self.col = collection
+        self.key = key
+
+    def load(self):
+        doc = self.col.find_one({"_id": self.key})
+        return doc if doc and doc.get("token") else None
+
+    def try_lease(self, owner, seconds):
+        now = time.time()
+        try:
+            # Matches when nobody holds the lease (or it lapsed); inserts the doc on first use.
+            # If another worker holds it, the upsert collides on _id and we lose the race.
+            self.col.update_one(
+                {"_id": self.key, "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]},
+                {"$set": {"lease_owner": owner, "lease_until": now + seconds}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def save(self, owner, token, expires_at, refresh_at):
+        self.col.update_one(
+            {"_id": self.key},
+            {"$set": {
+                "token": token,
+                "expires_at": expires_at,
+                "refresh_at": refresh_at,
+                "lease_owner": None,
+                "lease_until": None,
+                "updated_at": datetime.now()
+            }},
+            upsert=True
+        )
+
+    def release(self, owner):
+        self.col.update_one(
+            {"_id": self.key, "lease_owner": owner},
+            {"$set": {"lease_owner": None, "lease_until": None}}
+        )
+
+
+class DarajaClient:
+    """
+    Pooled, keep-alive HTTP client for the Safaricom Daraja API.
+    Every M-Pesa call (OAuth, STK Push, STK Query, B2C) goes through one
+    requests.Session so TCP/TLS connections are reused between calls.
+    """
+
+    ENDPOINTS = {
+        "oauth": "/oauth/v1/generate?grant_type=client_credentials",
+        "stkpush": "/mpesa/stkpush/v1/processrequest",
+        "stkquery": "/mpesa/stkpushquery/v1/query",
+        "b2c": "/mpesa/b2c/v1/paymentrequest",
+    }
+
+    # (connect, read) timeouts per endpoint
+    TIMEOUTS = {
+        "oauth": (5, 10),
+        "stkpush": (5, 15),
+        "stkquery": (5, 10),
+        "b2c": (5, 30),
+    }
+
+    def __init__(self, base_url=None, pool_maxsize=None):
+        self.base_url = (base_url or config.MPESA_API_URL).rstrip('/')
+        self.pool_maxsize = pool_maxsize or config.MPESA_POOL_MAXSIZE
+        self.session = requests.Session()
+        self.token_store = LocalTokenStore()
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._token_lock = threading.Lock()  # Single-flight refresh within this worker
+        self._lock = threading.Lock()
+        self._token_refreshes = 0
+        self._calls = {name: 0 for name in self.ENDPOINTS}
+        self._errors = 0
+
+        # Idempotent calls can safely be retried on read errors and gateway errors.
+        # (Daraja answers HTTP 500 for "transaction is being processed", so 500 is not retried.)
+        idempotent = Retry(
+            total=3, connect=3, read=2, status=2,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False
+        )
+        # Money-moving calls are only retried when the request never reached Safaricom
+        # (connect errors), otherwise the customer could get two STK prompts.
+        non_idempotent = Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.5)
+
+        self.adapters = [
+            self._mount(["oauth", "stkquery"], idempotent),
+            self._mount(["stkpush", "b2c"], non_idempotent),
+        ]
+
+    def _mount(self, endpoints, retries):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=retries)
+        for name in endpoints:
+            path = self.ENDPOINTS[name].split('?')[0]
+            self.session.mount(f"{self.base_url}{path}", adapter)
+        return adapter
+
+    def request(self, endpoint, payload=None, access_token=None, auth=None):
+        """Send a request to a Daraja endpoint over the pooled session."""
+        url = f"{self.base_url}{self.ENDPOINTS[endpoint]}"
+        timeout = self.TIMEOUTS[endpoint]
+        with self._lock:
+            self._calls[endpoint] += 1
+
+        try:
+            if payload is None:
+                return self.session.get(url, auth=auth, timeout=timeout)
+
+            headers = {'Content-Type': 'application/json'}
+            if access_token:
+                headers['Authorization'] = f'Bearer {access_token}'
+            return self.session.post(url, json=payload, headers=headers, timeout=timeout)
+        except requests.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def get_access_token(self, consumer_key=None, consumer_secret=None, force_refresh=False, stale_token=None):
+        """
+        Return a valid OAuth token, refreshing it at most once per validity window.
+        stale_token: a token Daraja just rejected (401); only that token is replaced,
+        so a burst of 401s still triggers a single refresh.
+        """
+        now = time.time()
+        cached = _token_cache["token"]
+        if (not force_refresh and cached and cached != stale_token
+                and _token_cache["refresh_at"] and now < _token_cache["refresh_at"]):
+            return cached
+
+        consumer_key = consumer_key or config.MPESA_CONSUMER_KEY
+        consumer_secret = consumer_secret or config.MPESA_CONSUMER_SECRET
+
+        with self._token_lock:
+            deadline = time.time() + 2 * TOKEN_LEASE_SECONDS
+            while True:
+                now = time.time()
+                try:
+                    doc = self.token_store.load()
+                    usable = doc and doc["token"] != stale_token and now < doc["expires_at"]
+                    if usable and not force_refresh and now < doc["refresh_at"]:
+                        self._remember(doc)
+                        return doc["token"]
+
+                    if self.token_store.try_lease(self._owner, TOKEN_LEASE_SECONDS):
+                        return self._refresh(consumer_key, consumer_secret)
+                except PyMongoError as e:
+                    if config.DEBUG: print(f"[M-PESA] Token store unavailable, fetching directly: {e}")
+                    return self._fetch_token(consumer_key, consumer_secret)
+
+                # Another worker is refreshing. A token still inside its validity window
+                # remains good to use (proactive refresh), otherwise wait for the new one.
+                if usable:
+                    self._remember(doc)
+                    return doc["token"]
+                if time.time() > deadline:
+                    if config.DEBUG: print("[M-PESA] Timed out waiting for token refresh")
+                    return None
+                time.sleep(0.2)
+
+    def _refresh(self, consumer_key, consumer_secret):
+        try:
+            token, expires_in = self._fetch_token(consumer_key, consumer_secret, with_expiry=True)
+        except Exception:
+            self.token_store.release(self._owner)
+            raise
+        if not token:
+            self.token_store.release(self._owner)
+            return None
+
+        now = time.time()
+        doc = {
+            "token": token,
+            "expires_at": now + expires_in,
+            "refresh_at": now + max(expires_in - TOKEN_REFRESH_MARGIN, expires_in / 2)
+        }
+        self._remember(doc)
+        try:
+            self.token_store.save(self._owner, **doc)
+        except PyMongoError as e:
+            if config.DEBUG: print(f"[M-PESA] Could not share refreshed token: {e}")
+        return token
+
+    def _fetch_token(self, consumer_key, consumer_secret, with_expiry=False):
+        """Call the Daraja OAuth endpoint."""
+        try:
+            if config.DEBUG: print("[M-PESA] Generating new access token...")
+            response = self.request("oauth", auth=(consumer_key, consumer_secret))
+            response.raise_for_status()
+            result = response.json()
+            token = result['access_token']
+            expires_in = int(result.get('expires_in', 3599))
+            with self._lock:
+                self._token_refreshes += 1
+            if config.DEBUG: print("[M-PESA] Token generated and shared successfully")
+        except requests.Timeout:
+            if config.DEBUG: print("[M-PESA] Timeout while generating access token")
+            token, expires_in = None, 0
+        except (requests.RequestException, KeyError, ValueError) as e:
+            if config.DEBUG: print(f"[M-PESA] Error generating access token: {e}")
+            token, expires_in = None, 0
+
+        return (token, expires_in) if with_expiry else token
+
+    def _remember(self, doc):
+        _token_cache["token"] = doc["token"]
+        _token_cache["expires_at"] = doc["expires_at"]
+        _token_cache["refresh_at"] = doc["refresh_at"]
+
+    def call(self, endpoint, payload):
+        """Authenticated POST; a 401 forces one token refresh and a single replay."""
+        access_token = self.get_access_token()
+        if not access_token:
+            raise requests.RequestException("Failed to generate access token - check M-Pesa credentials")
+
+        response = self.request(endpoint, payload, access_token=access_token)
+        if response.status_code == 401:
+            if config.DEBUG: print("[M-PESA] Access token rejected (401), refreshing")
+            access_token = self.get_access_token(stale_token=access_token)
+            if access_token:
+                response = self.request(endpoint, payload, access_token=access_token)
+        return response
+
+    def metrics(self):
+        """Connection reuse metrics (urllib3 pool counters + per-endpoint call counts)."""
+        connections = 0
+        requests_sent = 0
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None: continue
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+
+        with self._lock:
+            calls = dict(self._calls)
+            errors = self._errors
+            refreshes = self._token_refreshes
+
+        return {
+            "base_url": self.base_url,
+            "calls": calls,
+            "errors": errors,
+            "token_refreshes": refreshes,
+            "http_requests": requests_sent,
+            "connections_opened": connections,
+            "connection_reuse_ratio": round(1 - connections / requests_sent, 3) if requests_sent else None
+        }
+
+
+# Singleton
+daraja = DarajaClient()
+
 
 def get_mpesa_password(shortcode, passkey):
     """Generates the password for STK Push"""
@@ -15,96 +321,61 @@ def get_mpesa_password(shortcode, passkey):
     return encoded_string, timestamp
 
 def get_access_token(consumer_key, consumer_secret, force_refresh=False):
-    """Generates OAuth access token from Daraja API with caching"""
-    
-    # Check cache first (tokens valid for ~1 hour, we cache for 50 min)
-    if not force_refresh and _token_cache["token"] and _token_cache["expires_at"]:
-        if datetime.now() < _token_cache["expires_at"]:
-            if config.DEBUG: print("[M-PESA] Using cached access token")
-            return _token_cache["token"]
-    
-    api_url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    
-    try:
-        if config.DEBUG: print("[M-PESA] Generating new access token...")
-        # Add timeout: 5s connection, 10s read
-        response = requests.get(api_url, auth=(consumer_key, consumer_secret), timeout=(5, 10))
-        response.raise_for_status()
-        result = response.json()
-        token = result['access_token']
-        
-        # Cache token for 50 minutes (expires in 60)
-        _token_cache["token"] = token
-        _token_cache["expires_at"] = datetime.now() + timedelta(minutes=50)
-        if config.DEBUG: print("[M-PESA] Token generated and cached successfully")
-        
-        return token
-    except requests.Timeout:
-        if config.DEBUG: print("[M-PESA] Timeout while generating access token")
-        return None
-    except requests.RequestException as e:
-        if config.DEBUG: print(f"[M-PESA] Error generating access token: {e}")
-        return None
+    """Returns the shared OAuth access token from Daraja (refreshed once per validity window)"""
+    return daraja.get_access_token(consumer_key, consumer_secret, force_refresh=force_refresh)
+
+def is_simulation_mode():
+    """True when the Daraja keys are placeholders (no real Safaricom calls are made)"""
+    consumer_key = config.MPESA_CONSUMER_KEY or ""
+    consumer_secret = config.MPESA_CONSUMER_SECRET or ""
+    return "your_" in consumer_key or "your_" in consumer_secret or len(consumer_key) < 10
 
 def initiate_stk_push(phone_number, amount, account_reference="TindiTech", transaction_desc="Order Payment"):
-    """Initiates an STK Push to the customer's phone with retry logic"""
-    
+    """Initiates an STK Push to the customer's phone (connect errors retried by the pooled client)"""
+
     # 1. Get Configs
     consumer_key = config.MPESA_CONSUMER_KEY
     consumer_secret = config.MPESA_CONSUMER_SECRET
     shortcode = config.MPESA_SHORTCODE
     passkey = config.MPESA_PASSKEY
     callback_url = config.MPESA_CALLBACK_URL
-    
+
     if not all([consumer_key, consumer_secret, shortcode, passkey]):
         return {"success": False, "error": "M-Pesa credentials missing in config"}
 
     # 2. Validation & Simulation Check
-    keys_are_placeholders = (
-        "your_" in consumer_key or 
-        "your_" in consumer_secret or 
-        len(consumer_key) < 10
-    )
-
-    if keys_are_placeholders:
+    if is_simulation_mode():
         # SIMULATION MODE: Return success immediately without calling Safaricom
         if config.DEBUG: print("[M-PESA] Using Simulation Mode (Real keys not set)")
         timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
         return {
-            "success": True, 
-            "message": "STK Push Simulation Successful", 
-            "checkout_request_id": f"ws_CO_DM_{timestamp}_0000"
+            "success": True,
+            "message": "STK Push Simulation Successful",
+            "checkout_request_id": f"ws_CO_DM_{timestamp}_{uuid.uuid4().hex[:8]}"
         }
 
-    # 3. Get Access Token (with caching)
-    access_token = get_access_token(consumer_key, consumer_secret)
-    if not access_token:
+    # 3. Get Access Token (shared across workers)
+    if not get_access_token(consumer_key, consumer_secret):
         return {"success": False, "error": "Failed to generate access token - check M-Pesa credentials"}
 
     # 4. Generate Password
     password, timestamp = get_mpesa_password(shortcode, passkey)
 
-    # 5. Prepare Request Headers
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-
-    # 6. Format phone number (Ensure 254...)
+    # 5. Format phone number (Ensure 254...)
     phone_number = phone_number.replace('+', '').replace(' ', '').strip()
-    
+
     # Handle 07... -> 2547...
     if phone_number.startswith('0') and len(phone_number) == 10:
         phone_number = '254' + phone_number[1:]
     # Handle 25407... -> 2547... (Common Double Prefix Error)
     elif phone_number.startswith('2540') and len(phone_number) == 13:
         phone_number = '254' + phone_number[4:]
-    
+
     # Validate phone format
     if not phone_number.startswith('254') or len(phone_number) != 12:
         return {"success": False, "error": f"Invalid phone number format. Expected 254XXXXXXXXX, got {phone_number}"}
 
-    # 7. Prepare Payload
+    # 6. Prepare Payload
     payload = {
         "BusinessShortCode": shortcode,
         "Password": password,
@@ -119,47 +390,79 @@ def initiate_stk_push(phone_number, amount, account_reference="TindiTech", trans
         "TransactionDesc": transaction_desc
     }
 
-    # 8. Send Request with Retry Logic
-    api_url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-    max_retries = 3
-    
-    for attempt in range(max_retries):
-        try:
-            if config.DEBUG: print(f"[M-PESA] STK Push attempt {attempt + 1}/{max_retries}")
-            
-            # Add timeout: 5s connection, 15s read
-            response = requests.post(api_url, json=payload, headers=headers, timeout=(5, 15))
-            response_data = response.json()
-            
-            if response.status_code == 200 and response_data.get('ResponseCode') == '0':
-                if config.DEBUG: print("[M-PESA] STK Push successful")
-                return {
-                    "success": True, 
-                    "message": "STK Push initiated successfully", 
-                    "checkout_request_id": response_data.get('CheckoutRequestID')
-                }
-            else:
-                error_msg = response_data.get('errorMessage') or response_data.get('ResponseDescription', 'STK Push failed')
-                if config.DEBUG: print(f"[M-PESA] STK Push failed: {error_msg}")
-                return {"success": False, "error": error_msg}
-                
-        except requests.Timeout:
-            if config.DEBUG: print(f"[M-PESA] Timeout on attempt {attempt + 1}")
-            if attempt < max_retries - 1:
-                wait_time = 0.5 * (attempt + 1)  # Exponential backoff: 0.5s, 1s
-                if config.DEBUG: print(f"[M-PESA] Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                continue
-            return {"success": False, "error": "Request timeout - Safaricom API is slow. Please try again."}
-            
-        except requests.RequestException as e:
-            if config.DEBUG: print(f"[M-PESA] Network error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                wait_time = 0.5 * (attempt + 1)
-                if config.DEBUG: print(f"[M-PESA] Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                continue
-            return {"success": False, "error": f"Network error: {str(e)}. Check your internet connection."}
-    
-    # Should never reach here, but just in case
-    return {"success": False, "error": "Maximum retries exceeded"}
+    # 7. Send Request (retry policy lives on the pooled client)
+    try:
+        if config.DEBUG: print("[M-PESA] Sending STK Push")
+        response = daraja.call("stkpush", payload)
+        response_data = response.json()
+
+        if response.status_code == 200 and response_data.get('ResponseCode') == '0':
+            if config.DEBUG: print("[M-PESA] STK Push successful")
+            return {
+                "success": True,
+                "message": "STK Push initiated successfully",
+                "checkout_request_id": response_data.get('CheckoutRequestID'),
+                "merchant_request_id": response_data.get('MerchantRequestID')
+            }
+        else:
+            error_msg = response_data.get('errorMessage') or response_data.get('ResponseDescription', 'STK Push failed')
+            if config.DEBUG: print(f"[M-PESA] STK Push failed: {error_msg}")
+            return {"success": False, "error": error_msg}
+
+    except requests.Timeout:
+        if config.DEBUG: print("[M-PESA] Timeout sending STK Push")
+        return {"success": False, "error": "Request timeout - Safaricom API is slow. Please try again."}
+
+    except requests.RequestException as e:
+        if config.DEBUG: print(f"[M-PESA] Network error sending STK Push: {e}")
+        return {"success": False, "error": f"Network error: {str(e)}. Check your internet connection."}
+
+    except ValueError:
+        if config.DEBUG: print(f"[M-PESA] Invalid response from Safaricom: {response.status_code}")
+        return {"success": False, "error": "Invalid response from Safaricom"}
+
+def query_stk_push(checkout_request_id):
+    """Queries the status of an STK Push (Daraja STK Push Query API)"""
+    consumer_key = config.MPESA_CONSUMER_KEY
+    consumer_secret = config.MPESA_CONSUMER_SECRET
+    shortcode = config.MPESA_SHORTCODE
+    passkey = config.MPESA_PASSKEY
+
+    if not all([consumer_key, consumer_secret, shortcode, passkey]):
+        return {"success": False, "error": "M-Pesa credentials missing in config"}
+
+    if not get_access_token(consumer_key, consumer_secret):
+        return {"success": False, "error": "Failed to generate access token - check M-Pesa credentials"}
+
+    password, timestamp = get_mpesa_password(shortcode, passkey)
+    payload = {
+        "BusinessShortCode": shortcode,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id
+    }
+
+    try:
+        response = daraja.call("stkquery", payload)
+        response_data = response.json()
+    except requests.RequestException as e:
+        if config.DEBUG: print(f"[M-PESA] STK Query error for {checkout_request_id}: {e}")
+        return {"success": False, "error": str(e)}
+    except ValueError:
+        return {"success": False, "error": "Invalid response from Safaricom"}
+
+    if response.status_code == 200 and response_data.get('ResponseCode') == '0':
+        return {
+            "success": True,
+            "result_code": response_data.get('ResultCode'),
+            "result_desc": response_data.get('ResultDesc'),
+            "merchant_request_id": response_data.get('MerchantRequestID'),
+            "checkout_request_id": response_data.get('CheckoutRequestID')
+        }
+
+    # e.g. errorCode 500.001.1001 "The transaction is being processed"
+    return {
+        "success": False,
+        "error": response_data.get('errorMessage') or response_data.get('ResponseDescription', 'STK Query failed'),
+        "error_code": response_data.get('errorCode')
+    }
@@ -0,0 +1,157 @@
+"""
+Local Omada controller stand-in for development and benchmarking OmadaBridge.
+
+Implements login (token + TPOMADA_SESSIONID cookie) and the External Portal
+auth call, with configurable latency, failure rate and session lifetime, so
+session expiry and re-login can be exercised on demand.
+
+Usage:
+    python omada_simulator.py --port 5056 --latency-ms 40 --session-ttl 30
+
+Point the backend at it:
+    ROUTER_TYPE=tplink TPLINK_URL=http://localhost:5056 TPLINK_SITE_ID=default
+
+Benchmark the bridge against an in-process simulator (no backend needed):
+    python omada_simulator.py --bench 500 --latency-ms 40
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+import uuid
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+settings = {
+    "latency_ms": 0,       # Added to every API response
+    "session_ttl": 1800,   # Seconds before a login expires (the controller default is 30 min)
+    "failure_rate": 0.0,   # Auth calls answered with a non-session errorCode
+    "username": None,      # Require these credentials (None = accept any)
+    "password": None
+}
+
+sessions = {}  # token -> {"cookie": ..., "expires_at": ...}
+authorized = {}  # mac -> expires_at
+stats = {"logins": 0, "auth": 0, "expired": 0, "rejected": 0, "failed": 0}
+lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with lock:
+        stats[key] += n
+
+
+def _simulate_latency():
+    if settings["latency_ms"]:
+        time.sleep(settings["latency_ms"] / 1000)
+
+
+def _session_valid():
+    """Both the Csrf-Token header and the session cookie must match a live login."""
+    token = request.headers.get("Csrf-Token")
+    with lock:
+        session = sessions.get(token)
+    if not session or session["cookie"] != request.cookies.get("TPOMADA_SESSIONID"):
+        return False
+    if session["expires_at"] < time.time():
+        with lock:
+            sessions.pop(token, None)
+        return False
+    return True
+
+
+@app.route("/<site_id>/api/v2/login", methods=["POST"])
+def login(site_id):
+    _simulate_latency()
+    data = request.get_json() or {}
+    if settings["username"] and (data.get("username"), data.get("password")) != (settings["username"], settings["password"]):
+        _count("rejected")
+        return jsonify({"errorCode": -30109, "msg": "Invalid username or password."})
+
+    token, cookie = uuid.uuid4().hex, uuid.uuid4().hex
+    with lock:
+        sessions[token] = {"cookie": cookie, "expires_at": time.time() + settings["session_ttl"]}
+    _count("logins")
+    res = jsonify({"errorCode": 0, "msg": "Log in successfully.", "result": {"roleType": 0, "token": token}})
+    res.set_cookie("TPOMADA_SESSIONID", cookie)
+    return res
+
+
+@app.route("/<site_id>/api/v2/hotspot/extPortal/auth", methods=["POST"])
+def ext_portal_auth(site_id):
+    _simulate_latency()
+    if not _session_valid():
+        _count("expired")
+        return jsonify({"errorCode": -1200, "msg": "Login required."}), 401
+
+    data = request.get_json() or {}
+    if not data.get("mac"):
+        return jsonify({"errorCode": -1001, "msg": "Invalid request parameters."})
+    if random.random() < settings["failure_rate"]:
+        _count("failed")
+        return jsonify({"errorCode": -41001, "msg": "Client is not connected."})
+
+    with lock:
+        authorized[data["mac"]] = time.time() + int(data.get("period") or 0) * 60
+    _count("auth")
+    return jsonify({"errorCode": 0, "msg": "Success."})
+
+
+@app.route("/sim/expire", methods=["POST"])
+def expire_sessions():
+    """Expire every login now (simulates a controller restart or session timeout)."""
+    with lock:
+        count = len(sessions)
+        sessions.clear()
+    return jsonify({"expired": count})
+
+
+@app.route("/sim/stats", methods=["GET"])
+def sim_stats():
+    with lock:
+        return jsonify({"settings": settings, "stats": stats, "sessions": len(sessions), "authorized": len(authorized)})
+
+
+def bench(port, count):
+    """Authorize `count` MACs one call at a time, then as one batch, through OmadaBridge."""
+    from tplink_utils import OmadaBridge
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    threading.Thread(target=lambda: app.run(host="127.0.0.1", port=port, threaded=True), daemon=True).start()
+    time.sleep(1)
+    bridge = OmadaBridge(f"http://127.0.0.1:{port}", "default", settings["username"] or "admin", settings["password"] or "")
+    macs = [f"02:00:00:{i >> 16 & 255:02X}:{i >> 8 & 255:02X}:{i & 255:02X}" for i in range(count)]
+
+    start = time.time()
+    failed = sum(1 for mac in macs if not bridge.authorize_client(mac, 60)[0])
+    sequential = time.time() - start
+    print(f"sequential: {count} in {sequential:.2f}s ({count / sequential:.0f}/s), {failed} failed")
+
+    start = time.time()
+    failed = bridge.authorize_clients(macs, 60)
+    batched = time.time() - start
+    print(f"batched:    {count} in {batched:.2f}s ({count / batched:.0f}/s), {len(failed)} failed "
+          f"(pool_size={bridge.pool_size})")
+    print(f"bridge: {bridge.metrics()}")
+    print(f"controller: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Omada controller stand-in")
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--latency-ms", type=int, default=settings["latency_ms"])
+    parser.add_argument("--session-ttl", type=int, default=settings["session_ttl"])
+    parser.add_argument("--failure-rate", type=float, default=settings["failure_rate"])
+    parser.add_argument("--username", default=None)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--bench", type=int, default=0, help="Run the OmadaBridge benchmark with this many MACs")
+    args = parser.parse_args()
+
+    settings.update({k: v for k, v in vars(args).items() if k not in ("port", "bench")})
+    if args.bench:
+        bench(args.port, args.bench)
+    else:
+        print(f"[OMADA-SIM] Listening on :{args.port} with {settings}")
+        app.run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,118 @@
+"""
+STK Push reconciliation for lost M-Pesa callbacks.
+
+Pending registry entries older than `stale_after` are checked with the Daraja
+STK Push Query API (rate limited) and the result is applied through the same
+code path as /api/mpesa/callback. Completed entries whose target update never
+landed (worker died before the batched write) are re-queued.
+
+Run one pass by hand (e.g. against the local Daraja stand-in):
+    python payment_reconciler.py
+"""
+import datetime
+from config import config
+from mpesa_utils import query_stk_push, is_simulation_mode
+from worker_utils import PeriodicWorker, TokenBucket
+
+# Daraja answers this while the customer has not yet acted on the prompt
+STILL_PROCESSING = "500.001.1001"
+
+
+class StkReconciler:
+    def __init__(self, payments_col, apply_result, requeue, query=query_stk_push,
+                 stale_after=120, give_up_after=3600, batch_size=20, rate=2):
+        self.payments_col = payments_col
+        self.apply_result = apply_result  # apply_stk_result from main (callback path)
+        self.requeue = requeue            # requeue_payment_update from main
+        self.query = query
+        self.stale_after = stale_after
+        self.give_up_after = give_up_after
+        self.batch_size = batch_size
+        self.limiter = TokenBucket(rate)
+        self.stats = {"queried": 0, "resolved": 0, "still_pending": 0, "gave_up": 0, "errors": 0, "requeued": 0}
+
+    def run_once(self):
+        """One reconciliation pass. Returns the outcome counts for this pass."""
+        now = datetime.datetime.now()
+        outcome = {"queried": 0, "resolved": 0, "still_pending": 0, "gave_up": 0, "errors": 0, "requeued": 0}
+
+        if not is_simulation_mode():
+            # Uses the {status, created_at} index; next_query_at spaces out retries per payment
+            stale = self.payments_col.find({
+                "status": "pending",
+                "created_at": {"$lte": now - datetime.timedelta(seconds=self.stale_after)},
+                "$or": [{"next_query_at": None}, {"next_query_at": {"$lte": now}}]
+            }).sort("created_at", 1).limit(self.batch_size)
+
+            for payment in list(stale):
+                self._reconcile(payment, outcome)
+
+        # Completed entries whose batched target write never landed (partial {completed_at} index on applied: False)
+        unapplied = self.payments_col.find({
+            "status": {"$in": ["paid", "failed"]},
+            "applied": False,
+            "completed_at": {"$lte": now - datetime.timedelta(seconds=60)}
+        }).sort("completed_at", 1).limit(self.batch_size)
+        for payment in unapplied:
+            self.requeue(payment)
+            outcome["requeued"] += 1
+
+        for key, value in outcome.items():
+            self.stats[key] += value
+        if config.DEBUG and any(outcome.values()):
+            print(f"[M-PESA] Reconciliation pass: {outcome}")
+        return outcome
+
+    def _reconcile(self, payment, outcome):
+        checkout_id = payment["checkout_request_id"]
+        age = (datetime.datetime.now() - payment["created_at"]).total_seconds()
+
+        self.limiter.acquire()
+        result = self.query(checkout_id)
+        outcome["queried"] += 1
+
+        if result.get("success") and result.get("result_code") is not None:
+            self.apply_result({
+                "CheckoutRequestID": checkout_id,
+                "MerchantRequestID": result.get("merchant_request_id") or payment.get("merchant_request_id"),
+                "ResultCode": result["result_code"],
+                "ResultDesc": result.get("result_desc"),
+                "Source": "stk_query"
+            })
+            outcome["resolved"] += 1
+            return
+
+        if age > self.give_up_after:
+            # No definitive answer from Safaricom: release the order / session as failed
+            self.apply_result({
+                "CheckoutRequestID": checkout_id,
+                "MerchantRequestID": payment.get("merchant_request_id"),
+                "ResultCode": -1,
+                "ResultDesc": f"No M-Pesa result after {int(age // 60)} minutes ({result.get('error')})",
+                "Source": "stk_query"
+            })
+            outcome["gave_up"] += 1
+            return
+
+        attempts = payment.get("query_attempts", 0) + 1
+        backoff = min(self.stale_after * (2 ** attempts), 900)
+        self.payments_col.update_one({"_id": payment["_id"]}, {
+            "$set": {
+                "query_attempts": attempts,
+                "next_query_at": datetime.datetime.now() + datetime.timedelta(seconds=backoff),
+                "last_query_error": result.get("error")
+            }
+        })
+        if result.get("error_code") == STILL_PROCESSING:
+            outcome["still_pending"] += 1
+        else:
+            outcome["errors"] += 1
+
+    def worker(self, lease_col, interval=30):
+        """Background loop; the lease keeps it to one gunicorn worker per deployment."""
+        return PeriodicWorker("stk-reconciler", self.run_once, interval, lease_col=lease_col)
+
+
+if __name__ == "__main__":
+    import main
+    print(main.stk_reconciler.run_once())
@@ -0,0 +1,199 @@
+import datetime
+import random
+import threading
+import atexit
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import config
+from worker_utils import WORKER_ID
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class ProvisioningQueue:
+    """
+    Durable router provisioning jobs (hotspot user / MAC authorization).
+    /wifi/login enqueues and answers immediately; a pool of worker threads
+    claims jobs from MongoDB, calls `provision(job) -> (bool, msg)` with at
+    most `per_router` calls in flight per router, and retries failures with
+    exponential backoff. One job per code+MAC: enqueueing again while a job
+    is queued or running is a no-op, so portal retries do not pile up work.
+    """
+
+    def __init__(self, jobs_col, provision, workers=4, per_router=2, max_attempts=5,
+                 base_delay=2, max_delay=300, lease_seconds=60, poll_interval=1.0):
+        self.jobs = jobs_col
+        self.provision = provision
+        self.workers = workers
+        self.per_router = per_router
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds  # Running jobs of a crashed worker are reclaimed after this
+        self.poll_interval = poll_interval
+        self.stats = {"enqueued": 0, "deduplicated": 0, "succeeded": 0, "retried": 0, "failed": 0}
+        self._in_flight = {}  # router -> running jobs in this process
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    @staticmethod
+    def job_id(code, mac_address):
+        return f"{code}:{mac_address}"
+
+    def enqueue(self, code, mac_address, duration_hours, router=None, profile=None):
+        """Queue provisioning for a login. Returns the job's current status."""
+        now = datetime.datetime.now()
+        job_id = self.job_id(code, mac_address)
+        fields = {
+            "status": "queued",
+            "router": router or config.ROUTER_TYPE,
+            "duration_hours": duration_hours,
+            "profile": profile,
+            "attempts": 0,
+            "next_run_at": now,
+            "error": None,
+            "updated_at": now
+        }
+
+        # A finished job for the same code+MAC is re-armed (re-login after a router reboot, another site)
+        job = self.jobs.find_one_and_update(
+            {"_id": job_id, "status": {"$nin": list(ACTIVE_STATES)}},
+            {"$set": fields, "$unset": {"finished_at": ""}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job:
+            self.stats["enqueued"] += 1
+            self._wakeup.set()
+            return job["status"]
+
+        try:
+            existing = self.jobs.find_one_and_update(
+                {"_id": job_id},
+                {"$setOnInsert": dict(fields, code=code, mac_address=mac_address, created_at=now)},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            existing = self.jobs.find_one({"_id": job_id})
+
+        if existing:
+            self.stats["deduplicated"] += 1
+            return existing["status"]
+
+        self.stats["enqueued"] += 1
+        self._wakeup.set()
+        return "queued"
+
+    def status(self, code):
+        """Latest provisioning job for an access code (any MAC)."""
+        return self.jobs.find_one({"code": code}, sort=[("updated_at", -1)])
+
+    # --- Workers ---
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"provisioning-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                if config.DEBUG: print(f"[PROVISION] Claim failed: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._execute(job)
+            finally:
+                with self._lock:
+                    self._in_flight[job["router"]] -= 1
+
+    def _claim(self):
+        now = datetime.datetime.now()
+        with self._lock:
+            busy = [router for router, n in self._in_flight.items() if n >= self.per_router]
+
+        job = self.jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "queued", "next_run_at": {"$lte": now}},
+                    {"status": "running", "locked_until": {"$lt": now}}
+                ],
+                "router": {"$nin": busy}
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "locked_by": WORKER_ID,
+                    "locked_until": now + datetime.timedelta(seconds=self.lease_seconds),
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("next_run_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if not job:
+            return None
+
+        with self._lock:
+            if self._in_flight.get(job["router"], 0) >= self.per_router:
+                # Another thread filled this router's slots after our filter was built; hand the job back
+                self.jobs.update_one(
+                    {"_id": job["_id"], "locked_by": WORKER_ID},
+                    {"$set": {"status": "queued"}, "$inc": {"attempts": -1}}
+                )
+                return None
+            self._in_flight[job["router"]] = self._in_flight.get(job["router"], 0) + 1
+        return job
+
+    def _execute(self, job):
+        try:
+            success, message = self.provision(job)
+        except Exception as e:
+            success, message = False, str(e)
+
+        now = datetime.datetime.now()
+        owned = {"_id": job["_id"], "locked_by": WORKER_ID, "status": "running"}
+
+        if success:
+            self.stats["succeeded"] += 1
+            self.jobs.update_one(owned, {"$set": {"status": "done", "error": None, "finished_at": now, "updated_at": now}})
+            return
+
+        if job["attempts"] >= self.max_attempts:
+            self.stats["failed"] += 1
+            if config.DEBUG: print(f"[PROVISION] Giving up on {job['_id']} after {job['attempts']} attempts: {message}")
+            self.jobs.update_one(owned, {"$set": {"status": "failed", "error": message, "finished_at": now, "updated_at": now}})
+            return
+
+        # Exponential backoff with jitter so a recovering router is not hit by every job at once
+        delay = min(self.max_delay, self.base_delay * 2 ** (job["attempts"] - 1)) * random.uniform(0.8, 1.2)
+        self.stats["retried"] += 1
+        self.jobs.update_one(owned, {"$set": {
+            "status": "queued",
+            "error": message,
+            "next_run_at": now + datetime.timedelta(seconds=delay),
+            "updated_at": now
+        }})
+
+    def metrics(self):
+        with self._lock:
+            in_flight = {router: n for router, n in self._in_flight.items() if n}
+        return dict(self.stats, in_flight=in_flight)
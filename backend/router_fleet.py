@@ -0,0 +1,121 @@
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from config import config
+from mikrotik_utils import MikrotikBridge, mikrotik
+from tplink_utils import OmadaBridge, tplink
+
+# site: hotspot location id, type: 'mikrotik' | 'tplink', bridge: MikrotikBridge / OmadaBridge
+Router = namedtuple("Router", ["site", "type", "bridge"])
+
+
+class RouterFleet:
+    """
+    Registry of hotspot routers by site. Each MikroTik router gets its own
+    bridge (and so its own persistent connection pool).
+
+    fan_out() runs an operation on many sites in parallel and returns once
+    every site answered or `timeout` passed; sites that did not finish are
+    reported as timed out instead of holding up the rest. Periodic jobs pass
+    a `kind` (e.g. "reconcile"): a site still running the previous fan-out of
+    the same kind is skipped, so one slow router cannot pile up threads.
+    Other kinds and one-off operations (revokes, admin calls) still run there.
+    """
+
+    def __init__(self, routers, default_site, max_workers=8, timeout=15):
+        self.routers = {router.site: router for router in routers}
+        self.default_site = default_site if default_site in self.routers else next(iter(self.routers))
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fleet")
+        self._busy = set()  # (kind, site) still running
+        self._lock = threading.Lock()
+        self.stats = {"fan_outs": 0, "timeouts": 0, "skipped_busy": 0, "errors": 0}
+
+    @classmethod
+    def from_config(cls):
+        """
+        ROUTERS is a JSON list, e.g.
+        [{"site": "westlands", "type": "mikrotik", "host": "10.10.1.1", "port": 8728, "user": "api", "password": "..."},
+         {"site": "cbd", "type": "tplink", "url": "https://10.20.0.2:8043", "site_id": "cbd", "user": "admin", "password": "..."}]
+        Without it the single router from MIKROTIK_* / TPLINK_* is the only site.
+        """
+        specs = json.loads(config.ROUTERS) if config.ROUTERS else []
+        routers = []
+        for spec in specs:
+            router_type = spec.get("type", "mikrotik")
+            if router_type == "mikrotik":
+                bridge = MikrotikBridge(spec["host"], spec.get("user"), spec.get("password"), spec.get("port"))
+            elif router_type == "tplink":
+                bridge = OmadaBridge(spec["url"], spec.get("site_id"), spec.get("user"), spec.get("password"))
+            else:
+                raise ValueError(f"Unknown router type for site {spec.get('site')}: {router_type}")
+            routers.append(Router(spec["site"], router_type, bridge))
+
+        if not routers:
+            bridge = tplink if config.ROUTER_TYPE == "tplink" else mikrotik
+            routers.append(Router(config.DEFAULT_SITE, config.ROUTER_TYPE, bridge))
+
+        return cls(routers, config.DEFAULT_SITE, max_workers=config.FLEET_WORKERS, timeout=config.FLEET_TIMEOUT)
+
+    def resolve(self, site):
+        """Known site id, or the default site for unknown/missing ones."""
+        return site if site in self.routers else self.default_site
+
+    def get(self, site=None):
+        return self.routers[self.resolve(site)]
+
+    def router_type(self, site=None):
+        return self.get(site).type
+
+    def sites(self, router_type=None):
+        return [site for site, router in self.routers.items() if router_type is None or router.type == router_type]
+
+    def _run(self, operation, router, kind):
+        try:
+            return operation(router)
+        finally:
+            if kind:
+                with self._lock:
+                    self._busy.discard((kind, router.site))
+
+    def fan_out(self, operation, sites=None, timeout=None, kind=None):
+        """
+        Call operation(router) for each site in parallel (every site if `sites` is None).
+        Returns {site: {"success": True, "result": ...} | {"success": False, "error": ...}}.
+        """
+        self.stats["fan_outs"] += 1
+        futures, results = {}, {}
+        for site in (self.sites() if sites is None else sites):
+            router = self.routers.get(site)
+            if not router:
+                results[site] = {"success": False, "error": "Unknown site"}
+                continue
+            if kind:
+                with self._lock:
+                    if (kind, site) in self._busy:
+                        self.stats["skipped_busy"] += 1
+                        results[site] = {"success": False, "error": f"Site still busy with the previous {kind}"}
+                        continue
+                    self._busy.add((kind, site))
+            futures[self._executor.submit(self._run, operation, router, kind)] = site
+
+        done, not_done = wait(futures, timeout=timeout or self.timeout)
+        for future in done:
+            site = futures[future]
+            try:
+                results[site] = {"success": True, "result": future.result()}
+            except Exception as e:
+                self.stats["errors"] += 1
+                results[site] = {"success": False, "error": str(e)}
+        for future in not_done:
+            self.stats["timeouts"] += 1
+            results[futures[future]] = {"success": False, "error": "Timed out"}
+        return results
+
+    def metrics(self):
+        pools = {site: router.bridge.pool.metrics() for site, router in self.routers.items() if router.type == "mikrotik"}
+        controllers = {site: router.bridge.metrics() for site, router in self.routers.items() if router.type == "tplink"}
+        with self._lock:
+            busy = sorted(f"{kind}:{site}" for kind, site in self._busy)
+        return dict(self.stats, sites=len(self.routers), busy=busy, pools=pools, controllers=controllers)
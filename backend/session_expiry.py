@@ -0,0 +1,159 @@
+import atexit
+import datetime
+import heapq
+import threading
+from config import config
+from db_utils import acquire_lease
+from worker_utils import WORKER_ID
+
+
+class SessionExpiryScheduler:
+    """
+    Expires Wi-Fi sessions on time.
+
+    Sessions ending within `horizon` seconds are kept in a min-heap ordered by
+    expiry_time, loaded with one indexed query on status+expiry_time. The
+    thread sleeps until the earliest expiry, then marks the due sessions
+    `expired` with one update_many per batch and removes their hotspot users
+    via `revoke(session)`. Reloading also picks up anything that expired while
+    no process was running, so missed expiries are caught up on restart.
+    A MongoDB lease keeps enforcement to one process of the deployment.
+    This is what ends a session on time: the hotspot user's limit-uptime
+    counts only connected time, so it is a backstop for a missed revoke.
+    `on_expired(count)` is told how many sessions each batch expired.
+    """
+
+    LEASE_NAME = "wifi-session-expiry"
+
+    def __init__(self, sessions_col, revoke, lease_col=None, horizon=3600, reload_interval=60, batch_size=500,
+                 on_expired=None):
+        self.sessions = sessions_col
+        self.revoke = revoke
+        self.on_expired = on_expired
+        self.lease_col = lease_col
+        self.horizon = horizon
+        self.reload_interval = reload_interval
+        self.batch_size = batch_size
+        self.stats = {"loaded": 0, "expired": 0, "revoked": 0, "revoke_errors": 0, "batches": 0}
+        self._heap = []       # (expiry_time, session _id)
+        self._expiry = {}     # session _id -> expiry_time (latest wins; stale heap entries are skipped)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._owner = False
+        self._thread = None
+
+    def schedule(self, session_id, expiry_time):
+        """
+        Register a newly activated (or extended) session without waiting for the next reload.
+        Only the lease owner keeps a heap; in other processes this is a no-op and the owner
+        picks the session up on its next reload (within `reload_interval`).
+        """
+        if not self._owner or expiry_time > datetime.datetime.now() + datetime.timedelta(seconds=self.horizon):
+            return
+        with self._lock:
+            self._expiry[session_id] = expiry_time
+            heapq.heappush(self._heap, (expiry_time, session_id))
+        self._wakeup.set()
+
+    def load(self):
+        """Rebuild the heap from every active session that ends within the horizon (or already ended)."""
+        cutoff = datetime.datetime.now() + datetime.timedelta(seconds=self.horizon)
+        cursor = self.sessions.find(
+            {"status": "active", "expiry_time": {"$lte": cutoff}},
+            {"expiry_time": 1}
+        )
+        expiry = {s["_id"]: s["expiry_time"] for s in cursor}
+        heap = [(t, _id) for _id, t in expiry.items()]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap, self._expiry = heap, expiry
+        self.stats["loaded"] = len(heap)
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                expiry_time, session_id = heapq.heappop(self._heap)
+                if self._expiry.get(session_id) == expiry_time:
+                    del self._expiry[session_id]
+                    due.append(session_id)
+        return due
+
+    def expire_due(self):
+        """Expire every session that is due now. Returns the number expired."""
+        now = datetime.datetime.now()
+        total = 0
+        while True:
+            ids = self._pop_due(now)
+            if not ids:
+                return total
+
+            # Re-check in the database: a session extended since loading is left alone
+            guard = {"_id": {"$in": ids}, "status": "active", "expiry_time": {"$lte": now}}
+            sessions = list(self.sessions.find(guard, {"code": 1, "mpesa_code": 1, "mac_address": 1, "site": 1}))
+            if not sessions:
+                continue
+
+            guard["_id"] = {"$in": [s["_id"] for s in sessions]}
+            result = self.sessions.update_many(guard, {"$set": {"status": "expired", "expired_at": now}})
+            self.stats["batches"] += 1
+            self.stats["expired"] += result.modified_count
+            total += result.modified_count
+            if self.on_expired and result.modified_count:
+                self.on_expired(result.modified_count)
+
+            for session in sessions:
+                try:
+                    self.revoke(session)
+                    self.stats["revoked"] += 1
+                except Exception as e:
+                    self.stats["revoke_errors"] += 1
+                    if config.DEBUG: print(f"[EXPIRY] Revoke failed for {session['_id']}: {e}")
+
+            if config.DEBUG: print(f"[EXPIRY] Expired {result.modified_count} Wi-Fi sessions")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="wifi-session-expiry", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        next_reload = datetime.datetime.now()
+        while not self._stop.is_set():
+            try:
+                now = datetime.datetime.now()
+                if now >= next_reload:
+                    self._owner = self.lease_col is None or acquire_lease(
+                        self.lease_col, self.LEASE_NAME, WORKER_ID, self.reload_interval * 2)
+                    if self._owner:
+                        self.load()
+                    else:
+                        with self._lock:
+                            self._heap, self._expiry = [], {}  # Lease moved on (or never held)
+                    next_reload = now + datetime.timedelta(seconds=self.reload_interval)
+
+                if self._owner:
+                    self.expire_due()
+            except Exception as e:
+                if config.DEBUG: print(f"[EXPIRY] Pass failed: {e}")
+
+            # Sleep until the earliest expiry or the next reload, whichever comes first
+            wake_at = next_reload
+            with self._lock:
+                if self._owner and self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+            self._wakeup.wait(max(0.05, (wake_at - datetime.datetime.now()).total_seconds()))
+            self._wakeup.clear()
+
+    def metrics(self):
+        with self._lock:
+            scheduled = len(self._expiry)
+            next_expiry = self._heap[0][0] if self._heap else None
+        return dict(self.stats, owner=self._owner, scheduled=scheduled, next_expiry=next_expiry)
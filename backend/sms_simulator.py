@@ -0,0 +1,190 @@
+"""
+Local SMS gateway stand-in for development and testing the SMS dispatcher.
+
+Implements the bulk send API used by HttpSmsProvider and posts delivery
+reports back to the callback URL, with configurable latency, rate limit
+(HTTP 429 + Retry-After), rejection and non-delivery rates.
+
+Usage:
+    python sms_simulator.py --port 5057 --rate 20 --latency-ms 100
+
+Point the backend at it:
+    SMS_PROVIDER=http SMS_API_URL=http://localhost:5057
+    SMS_CALLBACK_URL=http://localhost:5000/sms/delivery
+
+Read what a number received (e.g. an OTP in an end-to-end test):
+    curl http://localhost:5057/sim/messages?to=%2B254712345678
+
+Benchmark the dispatcher against an in-process simulator (uses a scratch
+sms_outbox_bench collection in MONGODB_URI; no backend needed):
+    python sms_simulator.py --bench 1000 --rate 200
+"""
+import argparse
+import collections
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+settings = {
+    "latency_ms": 0,          # Added to every API response
+    "rate": 0,                # Messages per second accepted (0 = unlimited)
+    "max_batch": 100,         # Larger batches are refused with HTTP 400
+    "reject_rate": 0.0,       # Messages rejected at submission (invalid number)
+    "undelivered_rate": 0.0,  # Accepted messages reported as failed
+    "dlr_delay": 1.0,         # Seconds until the delivery report
+    "api_key": None           # Require this bearer token (None = accept any)
+}
+
+messages = collections.deque(maxlen=10000)
+stats = {"calls": 0, "accepted": 0, "rejected": 0, "throttled": 0, "dlr_sent": 0, "dlr_failed": 0}
+lock = threading.Lock()
+window = {"start": time.time(), "count": 0}  # One-second rate window
+dlr_pool = ThreadPoolExecutor(max_workers=8)
+dlr_session = requests.Session()
+
+
+def _count(key, n=1):
+    with lock:
+        stats[key] += n
+
+
+def _simulate_latency():
+    if settings["latency_ms"]:
+        time.sleep(settings["latency_ms"] / 1000)
+
+
+def _take_rate(n):
+    """Returns seconds to wait if `n` more messages would exceed the rate, else 0."""
+    if not settings["rate"]:
+        return 0
+    with lock:
+        now = time.time()
+        if now - window["start"] >= 1:
+            window["start"], window["count"] = now, 0
+        if window["count"] + n > max(settings["rate"], n):
+            return max(0.1, 1 - (now - window["start"]))
+        window["count"] += n
+        return 0
+
+
+def _report(callback_url, message):
+    time.sleep(settings["dlr_delay"])
+    delivered = random.random() >= settings["undelivered_rate"]
+    try:
+        dlr_session.post(callback_url, timeout=5, json={
+            "message_id": message["message_id"],
+            "status": "delivered" if delivered else "failed",
+            "error": None if delivered else "Absent subscriber"
+        })
+        _count("dlr_sent")
+    except requests.RequestException:
+        _count("dlr_failed")
+
+
+@app.route("/v1/messages/bulk", methods=["POST"])
+def send_bulk():
+    _simulate_latency()
+    _count("calls")
+    if settings["api_key"] and request.headers.get("Authorization") != f"Bearer {settings['api_key']}":
+        return jsonify({"error": "Invalid API key"}), 401
+
+    data = request.get_json() or {}
+    batch = data.get("messages") or []
+    if not batch or len(batch) > settings["max_batch"]:
+        return jsonify({"error": f"Send 1-{settings['max_batch']} messages per call"}), 400
+
+    retry_after = _take_rate(len(batch))
+    if retry_after:
+        _count("throttled")
+        res = jsonify({"error": "Too many requests"})
+        res.headers["Retry-After"] = f"{retry_after:.1f}"
+        return res, 429
+
+    results = []
+    for item in batch:
+        if not str(item.get("to", "")).startswith("+") or random.random() < settings["reject_rate"]:
+            _count("rejected")
+            results.append({"ref": item.get("ref"), "status": "rejected", "error": "Invalid destination"})
+            continue
+        message = {"message_id": uuid.uuid4().hex, "to": item["to"], "text": item.get("text"),
+                   "sender": data.get("sender"), "at": time.time()}
+        with lock:
+            messages.append(message)
+        _count("accepted")
+        results.append({"ref": item.get("ref"), "status": "accepted", "message_id": message["message_id"]})
+        if data.get("callback_url"):
+            dlr_pool.submit(_report, data["callback_url"], message)
+    return jsonify({"results": results})
+
+
+@app.route("/sim/messages", methods=["GET"])
+def sim_messages():
+    """Most recent messages, optionally only those sent to ?to=."""
+    to = request.args.get("to")
+    with lock:
+        found = [m for m in messages if not to or m["to"] == to]
+    return jsonify({"messages": found[-50:]})
+
+
+@app.route("/sim/stats", methods=["GET"])
+def sim_stats():
+    with lock:
+        return jsonify({"settings": settings, "stats": stats, "stored": len(messages)})
+
+
+def bench(port, count):
+    """Queue `count` SMS through SmsDispatcher and time until all are sent."""
+    import certifi
+    from pymongo import MongoClient
+    from config import config
+    from sms_utils import HttpSmsProvider, SmsDispatcher
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    threading.Thread(target=lambda: app.run(host="127.0.0.1", port=port, threaded=True), daemon=True).start()
+    time.sleep(1)
+    outbox = MongoClient(config.MONGODB_URI, tlsCAFile=certifi.where())["TindiTech"]["sms_outbox_bench"]
+    outbox.drop()
+    provider = HttpSmsProvider(f"http://127.0.0.1:{port}", settings["api_key"] or "", "BENCH",
+                               max_batch=settings["max_batch"])
+    dispatcher = SmsDispatcher(outbox, provider, workers=2, rate=settings["rate"] or 1000, poll_interval=0.1)
+
+    start = time.time()
+    for i in range(count):
+        dispatcher.send(f"0712{i:06d}", f"Bench message {i}")
+    queued = time.time() - start
+    dispatcher.start()
+    while outbox.count_documents({"status": {"$in": ["queued", "sending"]}}):
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    print(f"queued {count} in {queued:.2f}s; all sent after {elapsed:.2f}s ({count / elapsed:.0f}/s)")
+    print(f"dispatcher: {dispatcher.metrics()}")
+    print(f"gateway: {stats}")
+    outbox.drop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local SMS gateway stand-in")
+    parser.add_argument("--port", type=int, default=5057)
+    parser.add_argument("--latency-ms", type=int, default=settings["latency_ms"])
+    parser.add_argument("--rate", type=float, default=settings["rate"])
+    parser.add_argument("--max-batch", type=int, default=settings["max_batch"])
+    parser.add_argument("--reject-rate", type=float, default=settings["reject_rate"])
+    parser.add_argument("--undelivered-rate", type=float, default=settings["undelivered_rate"])
+    parser.add_argument("--dlr-delay", type=float, default=settings["dlr_delay"])
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--bench", type=int, default=0, help="Run the SmsDispatcher benchmark with this many messages")
+    args = parser.parse_args()
+
+    settings.update({k: v for k, v in vars(args).items() if k not in ("port", "bench")})
+    if args.bench:
+        bench(args.port, args.bench)
+    else:
+        print(f"[SMS-SIM] Listening on :{args.port} with {settings}")
+        app.run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,316 @@
+import atexit
+import datetime
+import random
+import re
+import threading
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from pymongo import ReturnDocument
+from config import config
+from worker_utils import TokenBucket, WORKER_ID
+
+
+def to_msisdn(phone):
+    """Phone as entered ("0712 345 678", "+254712345678") -> "+254712345678", or None if unusable."""
+    digits = re.sub(r"\D", "", str(phone or ""))
+    if digits.startswith("0") and len(digits) == 10:
+        digits = config.SMS_COUNTRY_CODE + digits[1:]
+    elif len(digits) == 9 and digits[0] in "17":
+        digits = config.SMS_COUNTRY_CODE + digits
+    return f"+{digits}" if 10 <= len(digits) <= 15 else None
+
+
+class SmsProviderError(Exception):
+    """The whole batch was not accepted (provider down, throttled, bad credentials)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SmsProvider:
+    """
+    Interface for an SMS gateway.
+    send_batch([{"ref", "to", "text"}]) -> {ref: (accepted, provider message id or error)}
+    and raises SmsProviderError when the call as a whole failed.
+    """
+
+    name = "base"
+    max_batch = 1
+    delivery_reports = False  # True if the gateway calls back /sms/delivery
+
+    def send_batch(self, messages):
+        raise NotImplementedError
+
+
+class ConsoleProvider(SmsProvider):
+    """Development provider: prints the messages (DEBUG only) and accepts them."""
+
+    name = "console"
+    max_batch = 100
+
+    def send_batch(self, messages):
+        for message in messages:
+            if config.DEBUG:
+                print(f"\n[MOCK SMS] To: {message['to']}")
+                print(f"[MOCK SMS] Message: {message['text']}\n")
+        return {message["ref"]: (True, None) for message in messages}
+
+
+class HttpSmsProvider(SmsProvider):
+    """
+    Bulk HTTP gateway: POST {url}/v1/messages/bulk with up to `max_batch`
+    messages per call over a keep-alive session. sms_simulator.py implements
+    the same API for local testing.
+    """
+
+    name = "http"
+    delivery_reports = True
+
+    def __init__(self, url, api_key, sender_id, callback_url=None, max_batch=100, timeout=10):
+        self.url = url.rstrip("/")
+        self.sender_id = sender_id
+        self.callback_url = callback_url
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def send_batch(self, messages):
+        try:
+            res = self.session.post(f"{self.url}/v1/messages/bulk", timeout=self.timeout, json={
+                "sender": self.sender_id,
+                "callback_url": self.callback_url,
+                "messages": messages
+            })
+        except requests.RequestException as e:
+            raise SmsProviderError(f"Gateway unreachable: {e}")
+        if res.status_code == 429:
+            raise SmsProviderError("Gateway rate limit", retry_after=float(res.headers.get("Retry-After") or 1))
+        if res.status_code != 200:
+            raise SmsProviderError(f"Gateway error HTTP {res.status_code}: {res.text[:200]}")
+
+        results = {}
+        for row in res.json().get("results", []):
+            accepted = row.get("status") == "accepted"
+            results[row.get("ref")] = (accepted, row.get("message_id") if accepted else row.get("error", "rejected"))
+        return results
+
+
+def build_provider(name=None):
+    """The provider selected by SMS_PROVIDER."""
+    name = name or config.SMS_PROVIDER
+    if name == "http":
+        return HttpSmsProvider(config.SMS_API_URL, config.SMS_API_KEY, config.SMS_SENDER_ID,
+                               callback_url=config.SMS_CALLBACK_URL or None, max_batch=config.SMS_BATCH_SIZE)
+    if name == "console":
+        return ConsoleProvider()
+    raise ValueError(f"Unknown SMS_PROVIDER: {name}")
+
+
+class SmsDispatcher:
+    """
+    Durable outgoing SMS. send() stores the message in sms_outbox and returns
+    at once; worker threads claim queued messages in batches of the
+    provider's max_batch, send each batch in one bulk call, and record what
+    happened to every message:
+
+      queued -> sending -> sent -> delivered | undelivered   (delivery report)
+                        -> queued again with backoff          (gateway failure)
+                        -> failed                             (rejected / out of attempts)
+
+    Calls are throttled to `rate` messages per second per process with a
+    token bucket, and a 429 from the gateway pauses the batch for its
+    Retry-After. A worker that dies mid-batch leaves its messages in
+    `sending`; they are claimed again once the lease runs out.
+
+    A delivery report can beat the worker's `sent` write (the gateway only
+    returns message ids when the batch call returns). Such a report is kept
+    in `reports_col` and applied as soon as its message is marked sent.
+    """
+
+    def __init__(self, outbox_col, provider, workers=1, rate=10, max_attempts=5,
+                 base_delay=5, max_delay=600, lease_seconds=60, poll_interval=1.0, reports_col=None):
+        self.outbox = outbox_col
+        self.reports = reports_col
+        self.provider = provider
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.bucket = TokenBucket(rate, capacity=max(rate, provider.max_batch))
+        self.stats = {"queued": 0, "invalid": 0, "batches": 0, "sent": 0, "retried": 0, "failed": 0,
+                      "throttled": 0, "delivered": 0, "undelivered": 0, "early_reports": 0}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def send(self, phone, text, kind=None):
+        """Queue an SMS. Returns the outbox id, or None if the number is unusable."""
+        to = to_msisdn(phone)
+        if not to:
+            self._count("invalid")
+            if config.DEBUG: print(f"[SMS] Not sending to invalid number {phone!r}")
+            return None
+        now = datetime.datetime.now()
+        message_id = uuid.uuid4().hex
+        self.outbox.insert_one({
+            "_id": message_id,
+            "to": to,
+            "text": text,
+            "kind": kind,
+            "provider": self.provider.name,
+            "status": "queued",
+            "attempts": 0,
+            "next_run_at": now,
+            "created_at": now,
+            "updated_at": now
+        })
+        self._count("queued")
+        self._wakeup.set()
+        return message_id
+
+    def status(self, message_id):
+        return self.outbox.find_one({"_id": message_id}, {"text": 0})
+
+    # --- Workers ---
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"sms-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch_id, batch = self._claim()
+                if batch:
+                    self._deliver(batch_id, batch)
+                    continue
+            except Exception as e:
+                if config.DEBUG: print(f"[SMS] Dispatch failed: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _claim(self):
+        """Mark up to max_batch due messages as ours. Returns (batch id, messages)."""
+        now = datetime.datetime.now()
+        due = {"$or": [
+            {"status": "queued", "next_run_at": {"$lte": now}},
+            {"status": "sending", "locked_until": {"$lt": now}}
+        ]}
+        ids = [m["_id"] for m in self.outbox.find(due, {"_id": 1}).sort("next_run_at", 1).limit(self.provider.max_batch)]
+        if not ids:
+            return None, []
+        batch_id = uuid.uuid4().hex
+        self.outbox.update_many(
+            dict(due, _id={"$in": ids}),
+            {"$set": {"status": "sending", "batch_id": batch_id, "locked_by": WORKER_ID,
+                      "locked_until": now + datetime.timedelta(seconds=self.lease_seconds), "updated_at": now},
+             "$inc": {"attempts": 1}}
+        )
+        # Another worker may have taken some of them between the find and the update
+        return batch_id, list(self.outbox.find({"batch_id": batch_id, "status": "sending"}))
+
+    def _deliver(self, batch_id, batch):
+        self.bucket.acquire(len(batch))
+        try:
+            results = self.provider.send_batch([{"ref": m["_id"], "to": m["to"], "text": m["text"]} for m in batch])
+            error, retry_after = None, None
+        except SmsProviderError as e:
+            results, error, retry_after = {}, str(e), e.retry_after
+        except Exception as e:
+            results, error, retry_after = {}, str(e), None
+        self._count("batches")
+        if retry_after:
+            self._count("throttled")
+
+        now = datetime.datetime.now()
+        owned = {"batch_id": batch_id, "status": "sending"}
+        for message in batch:
+            accepted, detail = results.get(message["_id"], (False, error or "No result from gateway"))
+            if accepted:
+                self._count("sent")
+                fields = {"status": "sent", "sent_at": now, "error": None}
+                if detail:
+                    fields["provider_message_id"] = detail
+                self.outbox.update_one(dict(owned, _id=message["_id"]), {"$set": dict(fields, updated_at=now)})
+                if detail:
+                    self._apply_early_report(detail)
+            elif error is None or (message["attempts"] >= self.max_attempts and not retry_after):
+                # Rejected by the gateway (bad number, ...) or out of attempts
+                self._count("failed")
+                self.outbox.update_one(dict(owned, _id=message["_id"]),
+                                       {"$set": {"status": "failed", "error": detail, "updated_at": now}})
+            else:
+                delay = retry_after or min(self.max_delay, self.base_delay * 2 ** (message["attempts"] - 1)) * random.uniform(0.8, 1.2)
+                self._count("retried")
+                self.outbox.update_one(dict(owned, _id=message["_id"]), {
+                    "$set": {"status": "queued", "error": detail,
+                             "next_run_at": now + datetime.timedelta(seconds=delay), "updated_at": now},
+                    "$inc": {"attempts": -1 if retry_after else 0}  # Being throttled does not use up an attempt
+                })
+        if config.DEBUG and error: print(f"[SMS] Batch of {len(batch)} not sent: {error}")
+
+    def _mark_delivered(self, provider_message_id, delivered, error=None):
+        status = "delivered" if delivered else "undelivered"
+        now = datetime.datetime.now()
+        message = self.outbox.find_one_and_update(
+            {"provider_message_id": provider_message_id, "status": "sent"},
+            {"$set": {"status": status, "error": error, "delivered_at": now, "updated_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if message:
+            self._count(status)
+        return message is not None
+
+    def record_delivery(self, provider_message_id, delivered, error=None):
+        """Apply a delivery report. Returns False if the message is unknown."""
+        if self._mark_delivered(provider_message_id, delivered, error):
+            return True
+        # A repeated report for a message that already has its final status is fine
+        if self.outbox.count_documents({"provider_message_id": provider_message_id}, limit=1):
+            return True
+        if self.reports is None:
+            return False
+
+        # Not marked sent yet: keep the report for _deliver, then look again in case the
+        # sent write landed in between (whichever side writes last applies it)
+        self.reports.update_one(
+            {"_id": provider_message_id},
+            {"$setOnInsert": {"delivered": delivered, "error": error, "created_at": datetime.datetime.now()}},
+            upsert=True
+        )
+        self._count("early_reports")
+        self._apply_early_report(provider_message_id)
+        return True
+
+    def _apply_early_report(self, provider_message_id):
+        if self.reports is None:
+            return
+        report = self.reports.find_one({"_id": provider_message_id})
+        if report and self._mark_delivered(provider_message_id, report["delivered"], report.get("error")):
+            self.reports.delete_one({"_id": provider_message_id})
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return dict(stats, provider=self.provider.name, max_batch=self.provider.max_batch, rate=self.bucket.rate,
+                    delivery_reports=self.provider.delivery_reports)
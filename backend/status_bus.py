@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+
+
+class Subscription:
+    """One waiting client. Holds only the latest payload published for its key."""
+
+    def __init__(self, bus, key):
+        self.bus = bus
+        self.key = key
+        self._event = threading.Event()
+        self._payload = None
+
+    def wait(self, timeout):
+        """Block until a payload is published (returns it) or `timeout` passes (returns None)."""
+        if not self._event.wait(timeout):
+            return None
+        with self.bus._lock:
+            payload, self._payload = self._payload, None
+            self._event.clear()
+        return payload
+
+    def _deliver(self, payload):
+        self._payload = payload
+        self._event.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.bus.unsubscribe(self)
+
+
+class StatusBus:
+    """
+    In-process pub/sub for payment status changes.
+    Request threads block on a key (checkout ID, order ID) at zero database cost
+    until mpesa_callback publishes the new status.
+
+    Each gunicorn worker has its own bus: a publish only wakes clients waiting in
+    the worker that applied the payment. For the others, each worker polls the
+    keys waited on in it (keys(prefix)) with one query per interval and
+    publishes what changed, however many clients are waiting.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, key, limit=None):
+        """Returns None if `limit` clients are already waiting in this process."""
+        sub = Subscription(self, key)
+        with self._lock:
+            if limit is not None and sum(len(subs) for subs in self._subscribers.values()) >= limit:
+                return None
+            self._subscribers.setdefault(key, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.key)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.key]
+
+    def publish(self, key, payload):
+        with self._lock:
+            for sub in self._subscribers.get(key, ()):
+                sub._deliver(payload)
+
+    def keys(self, prefix):
+        """Ids waited on in this process under `prefix` ("wifi:" -> checkout IDs)."""
+        with self._lock:
+            return [key[len(prefix):] for key in self._subscribers if key.startswith(prefix)]
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
+
+
+def sse_stream(bus, key, load_status, is_final, timeout=25, keepalive=10, max_waiting=None, retry=3000):
+    """
+    Server-Sent Events generator.
+    Subscribes first, then reads the current status once (so no publish is missed),
+    then only wakes up for published changes. The stream ends on a final status or
+    after `timeout`; EventSource reconnects by itself after `retry` ms, costing one
+    read per reconnect.
+
+    Every open stream holds a server thread (gthread worker). Routes should answer
+    503 once `max_waiting` streams wait (bus.waiting()), sending the client to its
+    polling fallback; a client that still finds the bus full here gets the current
+    status and reconnects after `retry`.
+    """
+    def generate():
+        sub = bus.subscribe(key, limit=max_waiting)
+        if sub is None:
+            yield f"retry: {retry}\n\n"
+            yield f"data: {json.dumps(load_status())}\n\n"
+            return
+        with sub:
+            yield f"retry: {retry}\n\n"
+            status = load_status()
+            yield f"data: {json.dumps(status)}\n\n"
+            if not status.get("success") or is_final(status):
+                return
+
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                payload = sub.wait(min(keepalive, remaining))
+                if payload is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(payload)}\n\n"
+                if is_final(payload):
+                    return
+
+    return generate()
@@ -1,87 +1,159 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from config import config
-import json
+
+# Omada answers an expired or missing login with HTTP 401 or one of these errorCodes
+SESSION_EXPIRED_CODES = {-1200, -1201}
+
 
 class OmadaBridge:
-    def __init__(self):
-        self.url = config.TPLINK_URL.rstrip('/')
-        self.site_id = config.TPLINK_SITE_ID
-        self.username = config.TPLINK_USER
-        self.password = config.TPLINK_PASS
+    """
+    Client for one Omada controller site.
+
+    Logs in once and keeps the session: the token (sent as Csrf-Token) and
+    the TPOMADA_SESSIONID cookie live on a shared keep-alive requests.Session.
+    When the controller reports the session gone (HTTP 401 or a
+    SESSION_EXPIRED_CODES errorCode) the bridge logs in again and retries the
+    call once. Logins are single-flight: threads that hit the same expired
+    token wait for one re-login instead of each starting their own.
+    """
+
+    def __init__(self, url=None, site_id=None, username=None, password=None, timeout=None, pool_size=None):
+        self.url = (url or config.TPLINK_URL).rstrip('/')
+        self.site_id = site_id or config.TPLINK_SITE_ID
+        self.username = username or config.TPLINK_USER
+        self.password = password if password is not None else config.TPLINK_PASS
+        self.timeout = (5, timeout or config.TPLINK_TIMEOUT)  # (connect, read)
+        self.pool_size = pool_size or config.TPLINK_POOL_SIZE
         self.session = requests.Session()
+        self.session.verify = False  # Controllers ship self-signed certs
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
         self.token = None
-        
+        self.stats = {"logins": 0, "login_failures": 0, "requests": 0, "reauths": 0, "errors": 0}
+        self._login_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._executor = None
+
         # Disable SSL warnings for self-signed controller certs
         requests.packages.urllib3.disable_warnings()
 
-    def login(self):
-        """Authenticate with Omada Controller."""
-        try:
-            # Omada API Login
-            payload = {"username": self.username, "password": self.password}
-            res = self.session.post(
-                f"{self.url}/{self.site_id}/api/v2/login", 
-                json=payload, 
-                verify=False,
-                timeout=10
-            )
-            data = res.json()
-            if data.get("errorCode") == 0:
-                if config.DEBUG: print(f"[TPLINK] Logged in. Token: {self.token[:5]}...")
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def login(self, stale_token=None):
+        """
+        Authenticate with the Omada Controller and cache the token.
+        stale_token: the token that was just rejected; if another thread has
+        already replaced it, that login is reused.
+        """
+        with self._login_lock:
+            if self.token and self.token != stale_token:
                 return True
-            else:
-                if config.DEBUG: print(f"[TPLINK] Login Failed: {data}")
+            self.token = None
+            self.session.cookies.clear()
+            try:
+                payload = {"username": self.username, "password": self.password}
+                res = self.session.post(f"{self.url}/{self.site_id}/api/v2/login", json=payload, timeout=self.timeout)
+                data = res.json()
+            except (requests.RequestException, ValueError) as e:
+                self._count("login_failures")
+                if config.DEBUG: print(f"[TPLINK] Connection Error: {e}")
                 return False
-        except Exception as e:
-            if config.DEBUG: print(f"[TPLINK] Connection Error: {e}")
+
+            token = (data.get("result") or {}).get("token")
+            if data.get("errorCode") == 0 and token:
+                self.token = token
+                self._count("logins")
+                if config.DEBUG: print(f"[TPLINK] Logged in. Token: {token[:5]}...")
+                return True
+
+            self._count("login_failures")
+            if config.DEBUG: print(f"[TPLINK] Login Failed: {data}")
             return False
 
+    def invalidate(self):
+        """Drop the cached session (next call logs in again)."""
+        with self._login_lock:
+            self.token = None
+            self.session.cookies.clear()
+
+    def _post(self, path, payload):
+        """
+        POST to the controller over the cached session; returns the JSON body.
+        Logs in lazily, and once more if the session expired mid-flight.
+        Raises requests.RequestException on network errors and timeouts.
+        """
+        data = {"errorCode": -1, "msg": "Login failed"}
+        for attempt in range(2):
+            token = self.token
+            if not token:
+                if not self.login():
+                    return data
+                token = self.token
+
+            self._count("requests")
+            res = self.session.post(f"{self.url}/{self.site_id}{path}", json=payload,
+                                    headers={"Csrf-Token": token}, timeout=self.timeout)
+            try:
+                data = res.json()
+            except ValueError:
+                data = {"errorCode": -1, "msg": f"HTTP {res.status_code}"}
+
+            if res.status_code != 401 and data.get("errorCode") not in SESSION_EXPIRED_CODES:
+                return data
+            self._count("reauths")
+            if config.DEBUG: print("[TPLINK] Session expired, logging in again")
+            self.login(stale_token=token)
+        return data
+
     def authorize_client(self, mac_address, duration_minutes):
         """Authorize a client MAC for a specific duration."""
-        if not self.token:
-            if not self.login(): return False, "Login failed"
-
+        # Note: Endpoint structure varies by Omada version. This is the
+        # External Portal auth call: we tell the controller to let the MAC through.
+        payload = {
+            "mac": mac_address,
+            "period": duration_minutes,
+            "auth_type": 1  # 1=Voucher/One-time
+        }
         try:
-            # API endpoint to authorize client
-            # Note: Endpoint structure varies by Omada version. Using v2 standard.
-            endpoint = f"{self.url}/{self.site_id}/api/v2/hotspot/login" 
-            # Or /api/v2/sites/{siteId}/hotspot/login depending on version
-            
-            # Simplified for typical Omada Controller External Portal Auth
-            # Actually, standard Omada External Portal requires the Controller to call US back,
-            # OR we call the controller to 'authorize' the client.
-            # Using the 'Operator' API approach.
-            
-            payload = {
-                "mac": mac_address,
-                "period": duration_minutes,
-                "auth_type": 1 # 1=Voucher/One-time
-            }
-            
-            headers = {
-                "Csrf-Token": self.token, # Sometimes needed
-                "Content-Type": "application/json"
-            }
-            
-            # Note: Omada API is complex. This is a generic implementation.
-            # For specific Gateway API:
-            # POST https://controller:8043/{site}/api/v2/hotspot/extPortal/auth
-            
-            real_endpoint = f"{self.url}/{self.site_id}/api/v2/hotspot/extPortal/auth"
-            
-            res = self.session.post(real_endpoint, json=payload, headers=headers, verify=False)
-            data = res.json()
-            
-            if data.get("errorCode") == 0:
-                if config.DEBUG: print(f"[TPLINK] Authorized {mac_address} for {duration_minutes} mins")
-                return True, "Authorized"
-            else:
-                if config.DEBUG: print(f"[TPLINK] Auth Failed: {data}")
-                return False, f"Omada Error: {data.get('msg')}"
-                
-        except Exception as e:
-             if config.DEBUG: print(f"[TPLINK] Request Error: {e}")
-             return False, str(e)
+            data = self._post("/api/v2/hotspot/extPortal/auth", payload)
+        except requests.RequestException as e:
+            self._count("errors")
+            if config.DEBUG: print(f"[TPLINK] Request Error: {e}")
+            return False, str(e)
+
+        if data.get("errorCode") == 0:
+            if config.DEBUG: print(f"[TPLINK] Authorized {mac_address} for {duration_minutes} mins")
+            return True, "Authorized"
+        self._count("errors")
+        if config.DEBUG: print(f"[TPLINK] Auth Failed: {data}")
+        return False, f"Omada Error: {data.get('msg')}"
+
+    def authorize_clients(self, clients, duration_minutes=None):
+        """
+        Authorize many MACs over the one logged-in session.
+        clients: MAC strings (all get duration_minutes) or (mac, minutes) pairs.
+        Calls run concurrently, up to pool_size at a time. Returns [(mac, error)] for failures.
+        """
+        clients = [(c, duration_minutes) if isinstance(c, str) else tuple(c) for c in clients]
+        if not clients:
+            return []
+        if not self.token and not self.login():
+            return [(mac, "Login failed") for mac, _ in clients]
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="omada")
+        results = self._executor.map(lambda c: (c[0], self.authorize_client(*c)), clients)
+        return [(mac, msg) for mac, (ok, msg) in results if not ok]
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, logged_in=self.token is not None)
+
 
 # Singleton
 tplink = OmadaBridge()
@@ -0,0 +1,131 @@
+import csv
+import datetime
+import html
+import io
+import secrets
+import uuid
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+# No 0/O or 1/I/L: codes are read off paper and typed on phones
+CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+CODE_LENGTH = 8
+
+
+def new_code():
+    return "VOU-" + "".join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+
+def create_batch(vouchers_col, access_codes, count, hours, created_by, label=None, site=None):
+    """
+    Generate `count` unique vouchers in one pass.
+
+    Codes are drawn from a cryptographic RNG (31^8 space), so collisions are
+    rare; the unique index on access_codes.code is the arbiter. Access codes
+    are inserted first with insert_many; any code that collides is redrawn and
+    only those are retried. The vouchers then go in with a single insert_many,
+    pointing at pre-assigned ids.
+    """
+    batch_id = "B-" + uuid.uuid4().hex[:10].upper()
+    now = datetime.datetime.now()
+
+    pending = {}
+    while len(pending) < count:
+        pending.setdefault(new_code(), ObjectId())
+
+    accepted = {}
+    while pending:
+        docs = [{"code": code, "kind": "voucher", "voucher_id": voucher_id, "batch_id": batch_id, "created_at": now}
+                for code, voucher_id in pending.items()]
+        failed = set()
+        try:
+            access_codes.col.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") == 11000}
+            if len(failed) != len(e.details.get("writeErrors", [])):
+                raise
+
+        retry = {}
+        for index, doc in enumerate(docs):
+            if index in failed:
+                code = new_code()
+                while code in accepted or code in retry:
+                    code = new_code()
+                retry[code] = doc["voucher_id"]
+            else:
+                accepted[doc["code"]] = doc["voucher_id"]
+        pending = retry
+    access_codes.remember(accepted)
+
+    vouchers = [{
+        "_id": voucher_id,
+        "code": code,
+        "duration_hours": hours,
+        "status": "active",
+        "batch_id": batch_id,
+        "site": site,
+        "created_at": now,
+        "created_by": created_by
+    } for code, voucher_id in accepted.items()]
+    vouchers_col.insert_many(vouchers, ordered=False)
+
+    batch = {
+        "batch_id": batch_id,
+        "label": label,
+        "count": len(vouchers),
+        "duration_hours": hours,
+        "site": site,
+        "created_at": now,
+        "created_by": created_by,
+        "provisioned": None
+    }
+    return batch, vouchers
+
+
+EXPORT_FIELDS = ["code", "duration_hours", "status", "batch_id", "created_at"]
+
+
+def stream_csv(cursor):
+    """Yield CSV text a chunk of rows at a time; memory stays flat for any batch size."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for i, voucher in enumerate(cursor, 1):
+        writer.writerow([voucher.get(field, "") for field in EXPORT_FIELDS])
+        if i % 200 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_sheet(batch, cursor, title="Tindi Tech Wi-Fi"):
+    """Yield a printable HTML sheet of voucher cards (A4, cut along the dashed lines)."""
+    hours = batch.get("duration_hours") or 0
+    if hours >= 24 and hours % 24 == 0:
+        duration = f"{hours // 24} Day{'s' if hours != 24 else ''}"
+    else:
+        duration = f"{hours} Hour{'s' if hours != 1 else ''}"
+    yield f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Vouchers {html.escape(batch['batch_id'])}</title>
+<style>
+  body {{ font-family: Arial, sans-serif; margin: 10mm; }}
+  .grid {{ display: grid; grid-template-columns: repeat(4, 1fr); gap: 0; }}
+  .card {{ border: 1px dashed #999; padding: 8px; text-align: center; page-break-inside: avoid; }}
+  .card h4 {{ margin: 0 0 4px; font-size: 11px; color: #03208f; }}
+  .code {{ font-family: monospace; font-size: 16px; font-weight: bold; letter-spacing: 1px; }}
+  .meta {{ font-size: 10px; color: #555; }}
+  @media print {{ .no-print {{ display: none; }} body {{ margin: 5mm; }} }}
+</style></head><body>
+<p class="no-print">Batch {html.escape(batch['batch_id'])} &middot; {batch['count']} vouchers &middot; <button onclick="window.print()">Print</button></p>
+<div class="grid">
+"""
+    chunk = []
+    for voucher in cursor:
+        chunk.append(f'<div class="card"><h4>{html.escape(title)}</h4>'
+                     f'<div class="code">{html.escape(voucher["code"])}</div>'
+                     f'<div class="meta">{duration} &middot; Enter code at the Wi-Fi login page</div></div>')
+        if len(chunk) == 100:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    yield "\n".join(chunk) + "\n</div></body></html>\n"
@@ -0,0 +1,76 @@
+import datetime
+from config import config
+
+
+class WifiCounters:
+    """
+    Running Wi-Fi totals for /admin/wifi-stats, kept in one document.
+
+    Every state change that moves a total applies an atomic $inc at the
+    moment it happens (payment confirmed, session activated, expired,
+    revoked), so reading the stats is a single find_one. rebuild()
+    recomputes the totals from the collections and overwrites them; it runs
+    periodically to correct any drift (e.g. a crash between a write and its
+    $inc) and on first use.
+
+    Revenue counts M-Pesa purchases only (the plan amount of every session
+    that received a login code); vouchers carry no amount.
+    """
+
+    def __init__(self, collection, key="wifi"):
+        self.col = collection
+        self.key = key
+
+    def add(self, **deltas):
+        """Atomically add to counters, e.g. add(active_users=1)."""
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas:
+            return
+        self.col.update_one(
+            {"_id": self.key},
+            {"$inc": deltas, "$set": {"updated_at": datetime.datetime.now()}},
+            upsert=True
+        )
+
+    def read(self):
+        return self.col.find_one({"_id": self.key})
+
+    def rebuild(self, sessions_col, daily_col=None):
+        """
+        Recount from wifi_sessions and store the result. Returns the new document.
+        daily_col: per-day rollups of sessions already removed from wifi_sessions.
+        """
+        now = datetime.datetime.now()
+        # Rollups first: a batch the rollup job moves between the two reads is then missed
+        # until the next rebuild, never counted twice
+        revenue = count = 0
+        counted_batches = set()
+        if daily_col is not None:
+            for day in daily_col.find({}, {"revenue": 1, "by_type.mpesa": 1, "batches": 1}):
+                revenue += day.get("revenue", 0)
+                count += day.get("by_type", {}).get("mpesa", 0)
+                counted_batches.update(day.get("batches", []))
+
+        active = sessions_col.count_documents({"status": "active", "expiry_time": {"$gt": now}})
+        paid_match = {"mpesa_code": {"$type": "string"}, "type": {"$ne": "voucher"}}
+        # Sessions of a batch already added to wifi_daily but not yet deleted
+        in_flight = [batch for batch in sessions_col.distinct("rollup_batch", {"rollup_batch": {"$exists": True}})
+                     if batch in counted_batches]
+        if in_flight:
+            paid_match["rollup_batch"] = {"$nin": in_flight}
+        paid = list(sessions_col.aggregate([
+            {"$match": paid_match},
+            {"$group": {"_id": None, "revenue": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+        ]))
+        revenue += paid[0]["revenue"] if paid else 0
+        count += paid[0]["count"] if paid else 0
+        totals = {
+            "active_users": active,
+            "total_revenue": revenue,
+            "paid_sessions": count,
+            "rebuilt_at": now,
+            "updated_at": now
+        }
+        self.col.update_one({"_id": self.key}, {"$set": totals}, upsert=True)
+        if config.DEBUG: print(f"[WIFI-STATS] Counters rebuilt: {active} active, revenue {totals['total_revenue']}")
+        return dict(totals, _id=self.key)
@@ -0,0 +1,200 @@
+import datetime
+import math
+import re
+import threading
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import config
+from mikrotik_utils import PROFILE_PREFIX
+
+# Seeded into wifi_plans the first time the catalog is empty
+DEFAULT_PLANS = {
+    "1h": {"duration": 1, "price": 20, "name": "1 Hour Access"},
+    "2h": {"duration": 2, "price": 30, "name": "2 Hours Access"},
+    "3h": {"duration": 3, "price": 40, "name": "3 Hours Access"},
+    "6h": {"duration": 6, "price": 70, "name": "6 Hours Access"},
+    "12h": {"duration": 12, "price": 100, "name": "12 Hours Access"},
+    "24h": {"duration": 24, "price": 150, "name": "24 Hours Access"},
+    "1w": {"duration": 168, "price": 800, "name": "1 Week Access"},
+    "1m": {"duration": 720, "price": 2500, "name": "1 Month Access"}  # 30 days
+}
+
+PLAN_ID = re.compile(r"^[a-z0-9_-]{1,20}$")
+MAX_DURATION = 24 * 366  # Hours; far beyond any plan, and keeps expiry arithmetic in range
+RATE_LIMIT = re.compile(r"^\d+[kKM]?(/\d+[kKM]?)?$")  # RouterOS rx/tx, e.g. "2M/5M"
+
+
+def hotspot_profile(plan_id, plan=None):
+    """RouterOS hotspot user profile for a plan (vouchers have no plan)."""
+    if plan and plan.get("profile"):
+        return plan["profile"]  # An existing router profile chosen by the admin
+    if plan_id is None:
+        return config.HOTSPOT_VOUCHER_PROFILE
+    return f"{PROFILE_PREFIX}-{plan_id}"
+
+
+def validate_plan(fields, partial=False):
+    """Clean plan fields from an admin request. Returns (plan, error)."""
+    plan = {}
+    try:
+        if "name" in fields or not partial:
+            plan["name"] = str(fields.get("name") or "").strip()
+            if not plan["name"]:
+                return None, "name is required"
+        if "duration" in fields or not partial:
+            plan["duration"] = float(fields.get("duration"))
+            if not math.isfinite(plan["duration"]) or not 0 < plan["duration"] <= MAX_DURATION:
+                return None, f"duration (hours) must be positive and at most {MAX_DURATION}"
+            if plan["duration"].is_integer():
+                plan["duration"] = int(plan["duration"])
+        if "price" in fields or not partial:
+            price = fields.get("price")
+            price = float(price) if not isinstance(price, bool) else math.nan  # JSON true is not a price
+            if not math.isfinite(price) or not price.is_integer():
+                return None, "price must be a whole number"
+            plan["price"] = int(price)
+            if plan["price"] < 1:
+                return None, "price must be at least 1"
+    except (TypeError, ValueError):
+        return None, "duration and price must be numbers"
+    if "rate_limit" in fields:
+        plan["rate_limit"] = str(fields["rate_limit"] or "").strip() or None
+        if plan["rate_limit"] and not RATE_LIMIT.match(plan["rate_limit"]):
+            return None, 'rate_limit must look like "2M/5M" (upload/download)'
+    if "profile" in fields:
+        plan["profile"] = str(fields["profile"] or "").strip() or None
+    if "active" in fields:
+        plan["active"] = bool(fields["active"])
+    elif not partial:
+        plan["active"] = True
+    return plan, None
+
+
+class PlanCatalog:
+    """
+    Wi-Fi plans stored in the wifi_plans collection, served from a per-worker
+    in-memory snapshot.
+
+    Request handlers only read the snapshot. Each worker calls refresh()
+    periodically, which reads one tiny version document and reloads the
+    plans only when the version has moved; every admin change bumps it, so
+    an edit reaches all workers within one interval without a restart. Until the
+    first load succeeds, lookups try to load once and otherwise fall back
+    to DEFAULT_PLANS.
+    """
+
+    VERSION_KEY = "wifi_plans"
+
+    def __init__(self, plans_col, versions_col):
+        self.plans = plans_col
+        self.versions = versions_col
+        self.version = None
+        self.stats = {"polls": 0, "reloads": 0}
+        self._snapshot = {plan_id: dict(plan, active=True) for plan_id, plan in DEFAULT_PLANS.items()}
+        self._lock = threading.Lock()
+
+    # --- Snapshot ---
+
+    def _current_version(self):
+        doc = self.versions.find_one({"_id": self.VERSION_KEY}, {"version": 1})
+        return doc["version"] if doc else 0
+
+    def refresh(self, force=False):
+        """Reload the snapshot if the stored version changed. Returns True if it reloaded."""
+        with self._lock:
+            self.stats["polls"] += 1
+            version = self._current_version()
+            if not force and version == self.version:
+                return False
+            if version == 0:
+                self._seed()  # First run: store the built-in plans
+                version = self._current_version()
+            snapshot = {}
+            for doc in self.plans.find({}):
+                plan_id = doc.pop("_id")
+                doc.pop("updated_at", None)
+                snapshot[plan_id] = doc
+            self._snapshot = snapshot  # Swapped whole; readers never see a half-built catalog
+            self.version = version
+            self.stats["reloads"] += 1
+        if config.DEBUG: print(f"[PLANS] Loaded {len(snapshot)} Wi-Fi plans (version {version})")
+        return True
+
+    def _ensure_loaded(self):
+        if self.version is None:
+            try:
+                self.refresh()
+            except Exception as e:
+                if config.DEBUG: print(f"[PLANS] Catalog not loaded, using defaults: {e}")
+
+    def get(self, plan_id, active_only=True):
+        self._ensure_loaded()
+        plan = self._snapshot.get(plan_id)
+        if plan is None or (active_only and not plan.get("active", True)):
+            return None
+        return plan
+
+    def active(self):
+        """plan_id -> {duration, price, name} for every plan on sale."""
+        self._ensure_loaded()
+        return {pid: {"duration": p["duration"], "price": p["price"], "name": p["name"]}
+                for pid, p in self._snapshot.items() if p.get("active", True)}
+
+    def profile_for(self, plan_id):
+        """Hotspot profile for a session's plan (None = voucher)."""
+        if plan_id is None:
+            return hotspot_profile(None)
+        return hotspot_profile(plan_id, self.get(plan_id, active_only=False))
+
+    def hotspot_profiles(self):
+        """Profiles the routers should carry: one per plan (retired ones too, for sessions still running)."""
+        self._ensure_loaded()
+        profiles = {hotspot_profile(pid, p): {"rate_limit": p.get("rate_limit") or config.HOTSPOT_DEFAULT_RATE_LIMIT}
+                    for pid, p in self._snapshot.items() if not p.get("profile")}
+        if config.HOTSPOT_VOUCHER_PROFILE.startswith(PROFILE_PREFIX):
+            profiles[config.HOTSPOT_VOUCHER_PROFILE] = {"rate_limit": config.HOTSPOT_DEFAULT_RATE_LIMIT}
+        return profiles
+
+    # --- Admin writes (each bumps the version) ---
+
+    def _bump(self):
+        self.versions.update_one({"_id": self.VERSION_KEY}, {"$inc": {"version": 1}}, upsert=True)
+        self.refresh()
+
+    def _seed(self):
+        now = datetime.datetime.now()
+        for plan_id, plan in DEFAULT_PLANS.items():
+            self.plans.update_one({"_id": plan_id},
+                                  {"$setOnInsert": dict(plan, active=True, updated_at=now)}, upsert=True)
+        self.versions.update_one({"_id": self.VERSION_KEY}, {"$max": {"version": 1}}, upsert=True)
+
+    def list_all(self):
+        """Every plan including retired ones, straight from the database (admin pages)."""
+        plans = []
+        for doc in self.plans.find({}).sort("price", 1):
+            doc["plan_id"] = doc.pop("_id")
+            plans.append(doc)
+        return plans
+
+    def create(self, plan_id, plan):
+        """Returns False if the plan id is taken."""
+        try:
+            self.plans.insert_one(dict(plan, _id=plan_id, updated_at=datetime.datetime.now()))
+        except DuplicateKeyError:
+            return False
+        self._bump()
+        return True
+
+    def update(self, plan_id, fields):
+        """Returns the updated plan, or None if it does not exist."""
+        doc = self.plans.find_one_and_update(
+            {"_id": plan_id},
+            {"$set": dict(fields, updated_at=datetime.datetime.now())},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            self._bump()
+        return doc
+
+    def metrics(self):
+        return dict(self.stats, version=self.version, plans=len(self._snapshot))
@@ -0,0 +1,109 @@
+import datetime
+import uuid
+from pymongo.errors import DuplicateKeyError
+from config import config
+
+
+class SessionRollup:
+    """
+    Folds finished Wi-Fi sessions into one summary document per day, then
+    deletes them from wifi_sessions.
+
+    A session is rolled up once it has been over (expired or revoked) for
+    `retention_days`, keyed by the day it started. Each pass works in batches:
+      1. stamp up to `batch_size` sessions with a batch id
+      2. $inc the day documents, guarded on the batch id so a retried batch
+         is never counted twice
+      3. delete the stamped sessions
+    A crash between steps leaves stamped sessions behind; the next pass
+    finishes those batches first. Failed payments past the pending TTL are
+    removed the same way and counted as `failed`.
+    """
+
+    def __init__(self, sessions_col, daily_col, retention_days=7, failed_ttl=86400, batch_size=1000):
+        self.sessions = sessions_col
+        self.daily = daily_col
+        self.retention_days = retention_days
+        self.failed_ttl = failed_ttl
+        self.batch_size = batch_size
+        self.stats = {"runs": 0, "rolled_up": 0, "batches": 0}
+
+    @staticmethod
+    def _day(session):
+        started = session.get("start_time") or session.get("created_at") or session.get("expiry_time")
+        return started.strftime("%Y-%m-%d") if started else "unknown"
+
+    def _summarize(self, sessions):
+        """day -> $inc fields for one batch."""
+        days = {}
+        for s in sessions:
+            inc = days.setdefault(self._day(s), {})
+
+            def add(field, value=1):
+                inc[field] = inc.get(field, 0) + value
+
+            if s.get("status") == "failed":
+                add("failed")
+                continue
+            add("sessions")
+            add(f"by_type.{s.get('type') or 'mpesa'}")
+            add(f"by_status.{s['status']}")
+            if s.get("site"):
+                add(f"by_site.{s['site']}")
+            if s.get("type") != "voucher":
+                add(f"plans.{s.get('plan_id') or 'unknown'}")
+                add("revenue", s.get("amount") or 0)
+            hours = s.get("duration_hours")
+            if hours is None and s.get("start_time") and s.get("expiry_time"):
+                hours = round((s["expiry_time"] - s["start_time"]).total_seconds() / 3600, 2)
+            add("hours_sold", hours or 0)
+        return days
+
+    def _apply(self, batch_id):
+        sessions = list(self.sessions.find({"rollup_batch": batch_id}))
+        now = datetime.datetime.now()
+        for day, inc in self._summarize(sessions).items():
+            try:
+                # Matches only if this batch is not yet counted; otherwise the upsert hits the existing _id
+                self.daily.update_one(
+                    {"_id": day, "batches": {"$ne": batch_id}},
+                    {"$inc": inc, "$set": {"updated_at": now},
+                     "$push": {"batches": {"$each": [batch_id], "$slice": -500}}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass  # Already counted by an earlier attempt
+        self.sessions.delete_many({"rollup_batch": batch_id})
+        self.stats["batches"] += 1
+        self.stats["rolled_up"] += len(sessions)
+        return len(sessions)
+
+    def run_once(self):
+        """Roll up every eligible session. Returns the number removed."""
+        total = 0
+        # Finish batches a previous pass stamped but did not delete
+        for batch_id in self.sessions.distinct("rollup_batch", {"rollup_batch": {"$exists": True}}):
+            total += self._apply(batch_id)
+
+        now = datetime.datetime.now()
+        finished_before = now - datetime.timedelta(days=self.retention_days)
+        eligible = {"rollup_batch": {"$exists": False}, "$or": [
+            {"status": "expired", "expiry_time": {"$lt": finished_before}},
+            {"status": "revoked", "revoked_at": {"$lt": finished_before}},
+            {"status": "failed", "created_at": {"$lt": now - datetime.timedelta(seconds=self.failed_ttl)}}
+        ]}
+        while True:
+            ids = [s["_id"] for s in self.sessions.find(eligible, {"_id": 1}).limit(self.batch_size)]
+            if not ids:
+                break
+            batch_id = uuid.uuid4().hex
+            self.sessions.update_many({"_id": {"$in": ids}, "rollup_batch": {"$exists": False}},
+                                      {"$set": {"rollup_batch": batch_id}})
+            total += self._apply(batch_id)
+
+        self.stats["runs"] += 1
+        if config.DEBUG and total: print(f"[ROLLUP] Rolled up {total} finished Wi-Fi sessions")
+        return total
+
+    def days(self, limit=30):
+        return list(self.daily.find({}, {"batches": 0}).sort("_id", -1).limit(limit))
@@ -0,0 +1,80 @@
+import atexit
+import os
+import threading
+import time
+import uuid
+from config import config
+from db_utils import acquire_lease, release_lease
+
+# Identifies this process when competing for deployment-wide leases
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1, timeout=None):
+        """Block until `tokens` are available. Returns False if `timeout` elapses first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class PeriodicWorker:
+    """
+    Runs `task()` every `interval` seconds in a daemon thread.
+    With `lease_col`, a MongoDB lease makes the task run in only one
+    gunicorn worker of the deployment at a time.
+    """
+
+    def __init__(self, name, task, interval, lease_col=None, lease_seconds=None):
+        self.name = name
+        self.task = task
+        self.interval = interval
+        self.lease_col = lease_col
+        self.lease_seconds = lease_seconds or max(interval * 2, 30)
+        self.runs = 0
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self.lease_col is not None:
+            release_lease(self.lease_col, self.name, WORKER_ID)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.lease_col is None or acquire_lease(self.lease_col, self.name, WORKER_ID, self.lease_seconds):
+                    self.task()
+                    self.runs += 1
+            except Exception as e:
+                self.last_error = str(e)
+                if config.DEBUG: print(f"[WORKER] {self.name} failed: {e}")
+            self._stop.wait(self.interval)